@@ -0,0 +1,115 @@
+import re
+
+from llm.tokens import count_tokens
+from model.route import LLMRoutes
+
+# XHS topics are `#name[话题]#`, plain hashtags end at whitespace or the next one
+HASHTAG = re.compile(r'#[^#\s]{1,30}?(?:\[[^\]]{1,6}\])?#|#[^#\s]{1,30}')
+# the same emoji (with its variation selector or skin tone) repeated, kept once
+REPEATED_EMOJI = re.compile(r'([\U0001F000-\U0001FAFF☀-➿][️\U0001F3FB-\U0001F3FF]?)\1+')
+PROMO_LINE = re.compile(r'关注|点赞|收藏|私信|戳我|主页|评论区|链接|优惠券|团购|下单|合作|广告|薯宝|宝子们')
+# a promo word inside a long line is usually part of the itinerary
+PROMO_MAX_LENGTH = 40
+BLANK_LINES = re.compile(r'\n{3,}')
+
+# a line opening a day or a section of an itinerary
+SECTION_START = re.compile(
+    r'^\s*(?:[Dd]ay\s*\d+|D\d+\b|第[一二三四五六七八九十\d]+[天日站]|[一二三四五六七八九十]+、|【[^】]{1,20}】|📅|📍?\s*Day)'
+)
+
+SENTENCE_END = re.compile(r'(?<=[。！？!?；;])')
+
+# notes longer than this are structured in chunks
+CHUNK_TOKENS = 3000
+# a first line longer than this share of a chunk is not a title and is not repeated
+HEADER_SHARE = 10
+
+
+def clean_note_text(text: str) -> str:
+    # hashtags, repeated emoji and short promotional lines carry no route content
+    lines = []
+    for line in text.splitlines():
+        line = REPEATED_EMOJI.sub(r'\1', HASHTAG.sub('', line)).strip()
+        if len(line) <= PROMO_MAX_LENGTH and PROMO_LINE.search(line):
+            continue
+        lines.append(line)
+    return BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
+
+def split_sections(text: str) -> list[str]:
+    sections, current = [], []
+    for line in text.splitlines():
+        if current and SECTION_START.match(line):
+            sections.append('\n'.join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append('\n'.join(current))
+    return sections
+
+
+def split_by_tokens(text: str, max_tokens: int) -> list[str]:
+    # at sentence ends where possible, a sentence over the limit is cut at the longest prefix that fits
+    pieces = []
+    for sentence in SENTENCE_END.split(text):
+        while count_tokens(sentence) > max_tokens:
+            low, high = 1, len(sentence)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if count_tokens(sentence[:middle]) <= max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            pieces.append(sentence[:low])
+            sentence = sentence[low:]
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def chunk_note_text(text: str, max_tokens: int = CHUNK_TOKENS) -> list[str]:
+    # whole days or sections per chunk, a section over the limit is cut between lines, and a line over it between
+    # sentences. A short first line, usually the title of the note, heads every chunk
+    if count_tokens(text) <= max_tokens:
+        return [text]
+
+    header, _, body = text.partition('\n')
+    if not body.strip() or count_tokens(header) > max_tokens // HEADER_SHARE:
+        header, body = '', text
+    budget = max_tokens - count_tokens(header)
+
+    pieces = []
+    for section in split_sections(body):
+        if count_tokens(section) <= budget:
+            pieces.append(section)
+            continue
+        for line in section.splitlines():
+            pieces.extend([line] if count_tokens(line) <= budget else split_by_tokens(line, budget))
+
+    chunks, chunk, chunk_tokens = [], [], 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if chunk and chunk_tokens + tokens > budget:
+            chunks.append('\n'.join(chunk))
+            chunk, chunk_tokens = [], 0
+        chunk.append(piece)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append('\n'.join(chunk))
+    return [f'{header}\n{chunk}' if header else chunk for chunk in chunks]
+
+
+def merge_routes(parts: list[LLMRoutes]) -> LLMRoutes:
+    # a route continued from the previous chunk under the same title gets the new locations appended
+    routes = []
+    for part in parts:
+        for index, route in enumerate(part.routes):
+            previous = routes[-1] if routes and index == 0 else None
+            if previous is not None and previous.title == route.title:
+                known = {location.name for location in previous.locations}
+                previous.locations.extend(location for location in route.locations if location.name not in known)
+                previous.total_duration = (previous.total_duration or 0) + (route.total_duration or 0) or None
+                previous.end_time = route.end_time or previous.end_time
+            else:
+                routes.append(route.model_copy(deep=True))
+    return LLMRoutes(routes=routes)
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime
+
+import numpy as np
+from dotenv import load_dotenv
+
+from analyze.minhash import BANDS, MinHasher
+from logger.logger import logger
+from metrics.metrics import NEAR_DUPLICATE_NOTES
+from model.note import NoteFingerprint
+from persistent.clickhouse_client import ClickhouseClient
+
+SHINGLE = 3
+# share of equal signature rows: reposts with a few lines edited or hashtags added are above 0.75, distinct
+# itineraries of the same city written from the same template stay below 0.6
+MIN_SIMILARITY = 0.75
+# short captions share most of their shingles with unrelated ones
+MIN_TEXT_LENGTH = 80
+# band candidates checked for an already structured note, the most similar first
+MAX_CANDIDATES = 20
+
+NON_WORD = re.compile(r'[\W_]+')
+
+# notes sharing a band that are similar enough and not duplicates themselves, the most similar first
+CANDIDATES_QUERY = """
+SELECT f.note_id AS note_id,
+       arrayCount((a, b) -> a = b, f.signature, {signature:Array(UInt32)}) / length(f.signature) AS similarity
+FROM citywalk_aide.note_fingerprints AS f FINAL
+WHERE hasAny(f.bands, {bands:Array(UInt64)})
+  AND f.note_id != {note_id:String}
+  AND f.duplicate_of = ''
+  AND similarity >= {min_similarity:Float32}
+ORDER BY similarity DESC, f.created_at
+LIMIT {limit:UInt32}
+"""
+
+# which of the candidates were structured, only their ids are looked up
+STRUCTURED_QUERY = """
+SELECT DISTINCT note_id
+FROM (
+    SELECT note_id FROM citywalk_aide.routes WHERE note_id IN {note_ids:Array(String)}
+    UNION ALL
+    SELECT note_id FROM citywalk_aide.note_structurings FINAL
+    WHERE note_id IN {note_ids:Array(String)} AND skipped = 0
+)
+"""
+
+# the LLM calls avoided, and the routes and locations the duplicates would have added, taken from their originals
+REPORT_QUERY = """
+SELECT count() AS notes,
+       countIf(f.duplicate_of != '') AS duplicates,
+       sumIf(o.routes, f.duplicate_of != '') AS routes,
+       sumIf(o.locations, f.duplicate_of != '') AS locations
+FROM (SELECT note_id, duplicate_of FROM citywalk_aide.note_fingerprints FINAL) AS f
+LEFT JOIN (
+    SELECT r.note_id AS note_id, uniqExact(r.id) AS routes, count(l.id) AS locations
+    FROM citywalk_aide.routes AS r FINAL
+    LEFT JOIN (SELECT id, route_id FROM citywalk_aide.locations FINAL) AS l ON l.route_id = toString(r.id)
+    GROUP BY r.note_id
+) AS o ON o.note_id = f.duplicate_of
+"""
+
+
+def text_shingles(text: str) -> frozenset:
+    text = NON_WORD.sub('', text.lower())
+    return frozenset(text[i:i + SHINGLE] for i in range(max(len(text) - SHINGLE + 1, 1)))
+
+
+def band_keys(signature: np.ndarray, bands: int = BANDS) -> list[int]:
+    # one key per band of rows, the band number is hashed in so that equal rows of different bands do not match
+    rows_per_band = len(signature) // bands
+    return [
+        int.from_bytes(hashlib.blake2b(
+            signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes(), digest_size=8,
+            salt=band.to_bytes(2, 'little'),
+        ).digest(), 'little')
+        for band in range(bands)
+    ]
+
+
+class NoteDeduplicator:
+    # notes whose text is nearly the same as an already structured note are not sent to the LLM, the routes of the
+    # original stand for them
+    def __init__(self, clickhouse_client: ClickhouseClient, min_similarity: float = MIN_SIMILARITY,
+                 min_text_length: int = MIN_TEXT_LENGTH):
+        self.clickhouse_client = clickhouse_client
+        self.hasher = MinHasher()
+        self.min_similarity = min_similarity
+        self.min_text_length = min_text_length
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'checked': 0, 'duplicates': 0}
+
+    def nearest(self, note_id: str, signature: np.ndarray, bands: list[int]) -> str:
+        # the most similar already structured note sharing a band: the band candidates first, then only their ids
+        # are checked against the structured notes
+        candidates = [row.note_id for row in self.clickhouse_client.select(CANDIDATES_QUERY, params={
+            'note_id': note_id,
+            'signature': signature.tolist(),
+            'bands': bands,
+            'min_similarity': self.min_similarity,
+            'limit': MAX_CANDIDATES,
+        })]
+        if not candidates:
+            return ''
+
+        structured = {row.note_id for row in self.clickhouse_client.select(STRUCTURED_QUERY,
+                                                                           params={'note_ids': candidates})}
+        return next((candidate for candidate in candidates if candidate in structured), '')
+
+    def check(self, note_id: str, text: str) -> str:
+        # the note this one duplicates, or '' if it has to be structured. The fingerprint is recorded either way
+        if len(text) < self.min_text_length:
+            return ''
+
+        signature = self.hasher.signatures([text_shingles(text)])[0]
+        bands = band_keys(signature)
+        try:
+            duplicate_of = self.nearest(note_id, signature, bands)
+            self.clickhouse_client.insert([NoteFingerprint(
+                note_id=note_id,
+                signature=signature.tolist(),
+                bands=bands,
+                length=len(text),
+                duplicate_of=duplicate_of,
+                created_at=datetime.now().replace(microsecond=0),
+            )])
+        except Exception as e:
+            logger.error(f'Error checking note ID {note_id} for near-duplicates: {e}')
+            return ''
+
+        with self.lock:
+            self.stats['checked'] += 1
+            self.stats['duplicates'] += bool(duplicate_of)
+        NEAR_DUPLICATE_NOTES.inc(result='duplicate' if duplicate_of else 'unique')
+        return duplicate_of
+
+    def log_summary(self):
+        if self.stats['checked']:
+            logger.info(f'Skipped {self.stats["duplicates"]} near-duplicate notes of {self.stats["checked"]} checked')
+
+
+def report(clickhouse_client: ClickhouseClient) -> dict:
+    row = next(iter(clickhouse_client.select(REPORT_QUERY)))
+    result = {'notes': row.notes, 'duplicates': row.duplicates, 'routes': row.routes, 'locations': row.locations}
+    logger.info(f'{result["duplicates"]} of {result["notes"]} fingerprinted notes were near-duplicates: '
+                f'{result["duplicates"]} LLM calls, {result["routes"]} routes and {result["locations"]} locations '
+                f'not written')
+    return result
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    report(ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL')))
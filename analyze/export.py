@@ -1,18 +1,230 @@
+import tempfile
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from clickhouse_driver import Client
+
+from logger.logger import logger
+from metrics.metrics import StageTimer
 from persistent.hdfs_client import HDFSClient
 
+EXPORT_PATH = '/user/data'
+# versions of a table kept after an export: the new one, and the previous one a reader may still be iterating
+KEEP_VERSIONS = 2
+
+# the city column is encoded in the partition directory (city=...), not in the files
+ROUTE_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('note_id', pa.string()),
+    ('title', pa.string()),
+    ('summary', pa.string()),
+    ('tags', pa.list_(pa.string())),
+    ('start_time', pa.string()),
+    ('end_time', pa.string()),
+    ('total_duration', pa.int32()),
+    ('liked_count', pa.int32()),
+    ('notes', pa.string()),
+    ('published_at', pa.date32()),
+    ('created_at', pa.timestamp('s')),
+])
+
+LOCATION_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('route_id', pa.string()),
+    ('order', pa.int32()),
+    ('name', pa.string()),
+    ('description', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('geohash', pa.string()),
+    ('poi_id', pa.string()),
+    ('address', pa.string()),
+    ('tags', pa.list_(pa.string())),
+    ('entry_fee', pa.float64()),
+    ('time_range', pa.string()),
+    ('duration', pa.int32()),
+    ('activities', pa.list_(pa.struct([
+        ('name', pa.string()),
+        ('description', pa.string()),
+        ('duration', pa.int32()),
+        ('optional', pa.uint8()),
+    ]))),
+    ('transportation', pa.list_(pa.struct([
+        ('mode', pa.string()),
+        ('distance', pa.float64()),
+        ('duration', pa.int32()),
+        ('notes', pa.string()),
+    ]))),
+    ('created_at', pa.timestamp('s')),
+])
+
+ROUTES_QUERY = """
+SELECT toString(r.id), r.note_id, r.title, r.summary, r.tags, r.start_time, r.end_time, r.total_duration,
+       if(s.note_id = '', r.liked_count, s.liked_count), r.notes, r.published_at, r.created_at
+FROM citywalk_aide.routes AS r FINAL
+LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) AS s ON s.note_id = r.note_id
+WHERE r.city = %(city)s
+"""
+
+LOCATIONS_QUERY = """
+SELECT toString(l.id), l.route_id, l.order, l.name, l.description, l.latitude, l.longitude, l.geohash, l.poi_id,
+       l.address, l.tags,
+       l.entry_fee, l.time_range, l.duration, l.activities, l.transportation, l.created_at
+FROM citywalk_aide.locations AS l FINAL
+WHERE l.route_id IN (SELECT toString(id) FROM citywalk_aide.routes WHERE city = %(city)s)
+"""
+
+TABLES = {
+    'routes': (ROUTES_QUERY, ROUTE_SCHEMA),
+    'locations': (LOCATIONS_QUERY, LOCATION_SCHEMA),
+}
+
+
+def iter_batches(clickhouse_client: Client, query: str, schema: pa.Schema, params: dict, block_size: int):
+    rows = []
+    for row in clickhouse_client.execute_iter(query, params, settings={'max_block_size': block_size}):
+        rows.append(row)
+        if len(rows) >= block_size:
+            yield to_record_batch(rows, schema)
+            rows = []
+
+    if rows:
+        yield to_record_batch(rows, schema)
+
+
+def to_record_batch(rows: list, schema: pa.Schema) -> pa.RecordBatch:
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def write_part(hdfs_client: HDFSClient, path: str, schema: pa.Schema, batches: list) -> int:
+    # spooled to a local file so the upload can be retried, one row group per block
+    with tempfile.TemporaryFile() as buffer:
+        with pq.ParquetWriter(buffer, schema, compression='zstd') as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+
+        buffer.seek(0)
+        hdfs_client.write_stream(path, buffer)
+    return sum(batch.num_rows for batch in batches)
+
+
+def export_table(clickhouse_client: Client, hdfs_client: HDFSClient, table: str, cities: list[str],
+                 base_path: str = EXPORT_PATH, block_size: int = 10000, blocks_per_file: int = 10) -> int:
+    # a city is split into part files of at most blocks_per_file blocks, so neither the export nor a reader of
+    # the partition holds more than one part
+    query, schema = TABLES[table]
+    table_path = f'{base_path}/{table}'
+    version = datetime.now().strftime('%Y%m%d%H%M%S')
+    staging_path = f'{table_path}/.{version}'
+    total = 0
+
+    for city in cities:
+        rows, part, batches = 0, 0, []
+        for batch in iter_batches(clickhouse_client, query, schema, {'city': city}, block_size):
+            batches.append(batch)
+            if len(batches) >= blocks_per_file:
+                rows += write_part(hdfs_client, f'{staging_path}/city={city}/part-{part:05d}.parquet', schema, batches)
+                part, batches = part + 1, []
+        # an empty city still gets a part, so its partition exists
+        if batches or not part:
+            rows += write_part(hdfs_client, f'{staging_path}/city={city}/part-{part:05d}.parquet', schema, batches)
+
+        logger.info(f'Exported {rows} {table} of city {city}')
+        total += rows
+
+    # the rename publishes the version at once, readers resolve the latest version when they start
+    hdfs_client.rename(staging_path, f'{table_path}/{version}')
+    remove_old_versions(hdfs_client, table_path)
+
+    return total
+
+
+def table_versions(hdfs_client: HDFSClient, table_path: str) -> list[str]:
+    # published versions, oldest first. Staging directories start with a dot
+    return sorted(name for name in hdfs_client.list_files(table_path) if name.isdigit())
+
+
+def remove_old_versions(hdfs_client: HDFSClient, table_path: str):
+    # the partitions of the unversioned layout go with the previous version, once a reader cannot be on them anymore;
+    # staging directories older than the new version are left over from failed exports
+    versions = table_versions(hdfs_client, table_path)
+    keep = versions[-KEEP_VERSIONS:]
+    for name in hdfs_client.list_files(table_path):
+        if name in keep:
+            continue
+        stale = name.isdigit() or name.startswith('.') and name[1:] < keep[-1] or \
+            name.startswith('city=') and len(versions) >= KEEP_VERSIONS
+        if stale:
+            hdfs_client.delete_file(f'{table_path}/{name}', recursive=True)
+            logger.info(f'Removed export {table_path}/{name}')
+
+
+def current_table_path(hdfs_client: HDFSClient, table: str, base_path: str = EXPORT_PATH) -> str:
+    # the latest published version, or the table directory itself for exports written before versions
+    table_path = f'{base_path}/{table}'
+    versions = table_versions(hdfs_client, table_path)
+    return f'{table_path}/{versions[-1]}' if versions else table_path
+
+
+def iter_table(hdfs_client: HDFSClient, table: str, columns: list[str] = None, cities: list[str] = None,
+               base_path: str = EXPORT_PATH):
+    # one version throughout, an export published meanwhile does not change the files being read
+    table_path = current_table_path(hdfs_client, table, base_path)
+    file_columns = [column for column in columns if column != 'city'] if columns else None
+
+    for partition in hdfs_client.list_files(table_path):
+        if not partition.startswith('city='):
+            continue
+        city = partition[len('city='):]
+        if cities and city not in cities:
+            continue
+
+        for file_name in hdfs_client.list_files(f'{table_path}/{partition}'):
+            if not file_name.endswith('.parquet'):
+                continue
+
+            # streamed to a local seekable file, parquet then reads the footer and one row group at a time
+            with tempfile.TemporaryFile() as buffer:
+                with hdfs_client.read_stream(f'{table_path}/{partition}/{file_name}') as chunks:
+                    for chunk in chunks:
+                        buffer.write(chunk)
+                buffer.seek(0)
+
+                parquet_file = pq.ParquetFile(buffer)
+                if not parquet_file.num_row_groups:
+                    continue
+                for batch in parquet_file.iter_batches(columns=file_columns):
+                    if columns is None or 'city' in columns:
+                        batch = batch.append_column('city', pa.array([city] * batch.num_rows, type=pa.string()))
+                    yield batch
+
+
+def load_table(hdfs_client: HDFSClient, table: str, columns: list[str] = None, cities: list[str] = None,
+               base_path: str = EXPORT_PATH) -> pd.DataFrame:
+    batches = list(iter_table(hdfs_client, table, columns, cities, base_path))
+    if not batches:
+        schema = TABLES[table][1]
+        return pd.DataFrame(columns=columns or schema.names + ['city'])
+
+    frame = pa.Table.from_batches(batches).to_pandas()
+    return frame[columns] if columns else frame
+
+
 if __name__ == '__main__':
     clickhouse_client = Client('localhost')
     hdfs_client = HDFSClient('http://localhost:50070', 'root')
 
-    routes_query = "SELECT * FROM citywalk_aide.routes"
-    locations_query = "SELECT * FROM citywalk_aide.locations"
-
-    routes_df = clickhouse_client.query_dataframe(routes_query)
-    locations_df = clickhouse_client.query_dataframe(locations_query)
-
-    routes_csv_data = routes_df.to_csv(index=False)
-    locations_csv_data = locations_df.to_csv(index=False)
+    cities = [row[0] for row in clickhouse_client.execute('SELECT DISTINCT city FROM citywalk_aide.routes')]
 
-    hdfs_client.write_file('/user/data/routes.csv', routes_csv_data)
-    hdfs_client.write_file('/user/data/locations.csv', locations_csv_data)
+    stages = StageTimer('Export')
+    for table in TABLES:
+        with stages.stage(table):
+            total = export_table(clickhouse_client, hdfs_client, table, cities)
+        logger.info(f'Exported {total} {table} to {EXPORT_PATH}/{table}')
+    stages.log_summary()
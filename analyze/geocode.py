@@ -0,0 +1,219 @@
+import csv
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+
+from common.constant import GEOCODE_CACHE_PATH
+from logger.logger import logger
+from metrics.metrics import GEOCODE_LOOKUPS
+from model.route import Location
+from utils.geo import location_geohash
+
+# "五大道（马场道入口）", "解放桥(天津站旁)" and "天津·五大道" are all the same landmark
+BRACKETS = re.compile(r'[(（\[【<《][^)）\]】>》]*[)）\]】>》]')
+SEPARATORS = re.compile(r'[\s·•・\-—_,，。.、!！?？~～"“”\'‘’]+')
+
+
+def normalize_name(city: str, name: str) -> str:
+    name = unicodedata.normalize('NFKC', name or '').lower()
+    name = BRACKETS.sub('', name)
+    # "天津·五大道" and "天津市五大道" drop the city, "天津之眼" is a landmark of its own
+    prefix = re.match(rf'{re.escape(city)}(市|市?{SEPARATORS.pattern})', name) if city else None
+    if prefix and len(name) > prefix.end():
+        name = name[prefix.end():]
+    return SEPARATORS.sub('', name)
+
+
+class GeocodeError(Exception):
+    pass
+
+
+class Geocoder(ABC):
+    name = 'geocoder'
+
+    @abstractmethod
+    def geocode(self, city: str, name: str) -> Optional[tuple[float, float]]:
+        ...
+
+
+class GazetteerGeocoder(Geocoder):
+    # a CSV file with the columns city,name,latitude,longitude
+    name = 'gazetteer'
+
+    def __init__(self, path: str):
+        self.places = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                key = (row['city'], normalize_name(row['city'], row['name']))
+                self.places[key] = (float(row['latitude']), float(row['longitude']))
+
+    def geocode(self, city: str, name: str) -> Optional[tuple[float, float]]:
+        return self.places.get((city, normalize_name(city, name)))
+
+
+class AMapGeocoder(Geocoder):
+    # AMap geocoding API, the coordinates are GCJ-02 like the maps the notes are written with
+    name = 'amap'
+    URL = 'https://restapi.amap.com/v3/geocode/geo'
+
+    def __init__(self, key: str, timeout: int = 10, retries: int = 2, backoff: float = 0.5):
+        self.key = key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+
+    def geocode(self, city: str, name: str) -> Optional[tuple[float, float]]:
+        params = {'key': self.key, 'address': name, 'city': city, 'output': 'JSON'}
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.get(self.URL, params=params, timeout=self.timeout)
+                response.raise_for_status()
+                data = response.json()
+                break
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f'Error geocoding {city} {name} (attempt {attempt + 1}): {e}')
+                time.sleep(self.backoff * 2 ** attempt)
+
+        # an invalid key, an exhausted quota or throttling come back as HTTP 200 with status 0, they raise so that the
+        # name is retried and not cached as not found
+        if data.get('status') != '1':
+            raise GeocodeError(f'AMap error geocoding {city} {name}: {data.get("info")} ({data.get("infocode")})')
+        if not data.get('geocodes'):
+            return None
+        longitude, latitude = data['geocodes'][0]['location'].split(',')
+        return float(latitude), float(longitude)
+
+
+class GeocodeCache:
+    # every name is resolved once ever, names that could not be resolved are cached too
+    def __init__(self, path: str = GEOCODE_CACHE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocodes (
+            city TEXT NOT NULL,
+            name TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL,
+            geocoder TEXT NOT NULL,
+            resolved_at REAL NOT NULL,
+            PRIMARY KEY (city, name)
+        )
+        """)
+
+    def get_many(self, keys: list[tuple[str, str]]) -> dict:
+        found = {}
+        with self.lock:
+            for city, name in keys:
+                row = self.conn.execute('SELECT latitude, longitude FROM geocodes WHERE city = ? AND name = ?',
+                                        (city, name)).fetchone()
+                if row is not None:
+                    found[(city, name)] = None if row[0] is None else (row[0], row[1])
+        return found
+
+    def put_many(self, coordinates: dict, geocoder: str):
+        now = time.time()
+        rows = [
+            (city, name, *(coordinate or (None, None)), geocoder, now)
+            for (city, name), coordinate in coordinates.items()
+        ]
+        with self.lock:
+            self.conn.executemany("""
+            INSERT INTO geocodes (city, name, latitude, longitude, geocoder, resolved_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (city, name) DO UPDATE SET
+                latitude = excluded.latitude,
+                longitude = excluded.longitude,
+                geocoder = excluded.geocoder,
+                resolved_at = excluded.resolved_at
+            """, rows)
+
+
+class LocationEnricher:
+    def __init__(self, geocoder: Geocoder, cache: GeocodeCache, max_workers: int = 4):
+        self.geocoder = geocoder
+        self.cache = cache
+        # the geocoding service is rate-limited, this bounds the concurrent requests of a batch
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # notes structured concurrently share the lookups of the same landmark
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def resolve(self, keys: set[tuple[str, str]]) -> dict:
+        coordinates = self.cache.get_many(list(keys))
+        GEOCODE_LOOKUPS.inc(len(coordinates), result='cache_hit')
+
+        missing = [key for key in keys if key not in coordinates]
+        if not missing:
+            return coordinates
+
+        futures, owned = {}, []
+        with self.lock:
+            for key in missing:
+                if key not in self.in_flight:
+                    self.in_flight[key] = self.executor.submit(self.geocoder.geocode, *key)
+                    owned.append(key)
+                futures[key] = self.in_flight[key]
+
+        resolved = {}
+        for key, future in futures.items():
+            try:
+                resolved[key] = future.result()
+                if key in owned:
+                    GEOCODE_LOOKUPS.inc(result='resolved' if resolved[key] else 'not_found')
+            except Exception as e:
+                # not cached, the next batch retries it
+                if key in owned:
+                    logger.error(f'Error geocoding {key[0]} {key[1]}: {e}')
+                    GEOCODE_LOOKUPS.inc(result='error')
+
+        self.cache.put_many({key: resolved[key] for key in owned if key in resolved}, self.geocoder.name)
+        with self.lock:
+            for key in owned:
+                self.in_flight.pop(key, None)
+        coordinates.update(resolved)
+        return coordinates
+
+    def enrich(self, city: str, locations: list[Location]) -> int:
+        # only locations the LLM left without coordinates, the geohash follows the new coordinates
+        pending = [location for location in locations if not location.latitude and not location.longitude]
+        keys = {(city, normalize_name(city, location.name)) for location in pending}
+        keys.discard((city, ''))
+        if not keys:
+            return 0
+
+        coordinates = self.resolve(keys)
+        enriched = 0
+        for location in pending:
+            coordinate = coordinates.get((city, normalize_name(city, location.name)))
+            if coordinate:
+                location.latitude, location.longitude = coordinate
+                location.geohash = location_geohash(*coordinate)
+                enriched += 1
+        return enriched
+
+
+def new_enricher() -> Optional[LocationEnricher]:
+    # GEOCODER=gazetteer reads GEOCODER_GAZETTEER, GEOCODER=amap needs GEOCODER_KEY, unset disables the stage
+    geocoder = os.getenv('GEOCODER', '')
+    if geocoder == 'gazetteer':
+        return LocationEnricher(GazetteerGeocoder(os.getenv('GEOCODER_GAZETTEER')), GeocodeCache())
+    if geocoder == 'amap':
+        return LocationEnricher(AMapGeocoder(os.getenv('GEOCODER_KEY')), GeocodeCache(),
+                                int(os.getenv('GEOCODER_CONCURRENCY', 4)))
+    return None
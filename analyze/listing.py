@@ -0,0 +1,89 @@
+import os
+from datetime import datetime
+
+from clickhouse_orm import Database
+
+from logger.logger import logger
+from model.route import RouteListing
+from persistent.clickhouse_client import ClickhouseClient
+
+# every city's routes ranked by likes, or those of the given cities, with the note cover joined once here instead of on every /search request
+LISTINGS_QUERY = """
+INSERT INTO citywalk_aide.route_listings (city, rank, id, note_id, title, summary, tags, start_time, end_time,
+                                          total_duration, liked_count, notes, published_at, created_at, cover, version)
+SELECT city,
+       row_number() OVER (PARTITION BY city ORDER BY liked_count DESC, id) AS rank,
+       id, note_id, title, summary, tags, start_time, end_time, total_duration, liked_count, notes, published_at,
+       created_at, cover, {version:DateTime} AS version
+FROM (
+    SELECT r.id AS id,
+           any(r.note_id) AS note_id,
+           any(r.city) AS city,
+           any(r.title) AS title,
+           any(r.summary) AS summary,
+           any(r.tags) AS tags,
+           any(r.start_time) AS start_time,
+           any(r.end_time) AS end_time,
+           any(r.total_duration) AS total_duration,
+           any(if(s.note_id = '', r.liked_count, s.liked_count)) AS liked_count,
+           any(r.notes) AS notes,
+           any(r.published_at) AS published_at,
+           any(r.created_at) AS created_at,
+           any(n.cover) AS cover
+    FROM citywalk_aide.routes r FINAL
+    JOIN citywalk_aide.note_infos n ON n.id = r.note_id
+    LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) s ON s.note_id = r.note_id
+    WHERE r.title <> '' AND (empty({cities:Array(String)}) OR r.city IN {cities:Array(String)})
+    GROUP BY r.id
+)
+"""
+
+# the version readers currently take for each city
+VERSIONS_QUERY = """
+SELECT city, version
+FROM citywalk_aide.route_listing_counts FINAL
+WHERE empty({cities:Array(String)}) OR city IN {cities:Array(String)}
+"""
+
+# written after the listings, so readers switch to the new version only once all its rows are in. A city listed
+# before that has no route left gets a zero count, otherwise readers would keep serving its old version
+COUNTS_QUERY = """
+INSERT INTO citywalk_aide.route_listing_counts (city, total, version)
+SELECT city, count() AS total, {version:DateTime} AS version
+FROM citywalk_aide.route_listings
+WHERE version = {version:DateTime}
+GROUP BY city
+UNION ALL
+SELECT city, 0 AS total, {version:DateTime} AS version
+FROM citywalk_aide.route_listing_counts FINAL
+WHERE total > 0
+  AND (empty({cities:Array(String)}) OR city IN {cities:Array(String)})
+  AND city NOT IN (SELECT city FROM citywalk_aide.route_listings WHERE version = {version:DateTime})
+"""
+
+# a reader that took the previous version of a city may still be paging through it, so that one is kept and only
+# the versions before it are deleted. Cities that were not refreshed are not in the map and keep all their rows
+CLEANUP_QUERY = """
+ALTER TABLE citywalk_aide.route_listings DELETE WHERE version < {previous:Map(String, DateTime)}[city]
+"""
+
+
+def refresh_route_listings(clickhouse_client: Database, cities: list[str] = None) -> int:
+    # all cities by default, e.g. after a full structuring run, or only the given ones when their routes or likes
+    # changed
+    cities = sorted(set(cities or []))
+    version = datetime.now().replace(microsecond=0)
+    previous = {row.city: row.version for row in clickhouse_client.select(VERSIONS_QUERY, params={'cities': cities})}
+
+    clickhouse_client.raw(LISTINGS_QUERY, params={'version': version, 'cities': cities})
+    clickhouse_client.raw(COUNTS_QUERY, params={'version': version, 'cities': cities})
+    if previous:
+        clickhouse_client.raw(CLEANUP_QUERY, params={'previous': previous})
+
+    total = clickhouse_client.count(RouteListing, 'version = {version:DateTime}', params={'version': version})
+    logger.info(f'Refreshed route listings of {len(cities) or "all"} cities, {total} routes of version {version}')
+    return total
+
+
+if __name__ == '__main__':
+    refresh_route_listings(ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL')))
@@ -0,0 +1,155 @@
+import hashlib
+import io
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from analyze.export import EXPORT_PATH
+from analyze.geocode import normalize_name
+from logger.logger import logger
+from persistent.hdfs_client import HDFSClient
+
+NUM_PERM = 64
+# 16 bands of 4 rows: routes sharing about half of their stops end up in a common bucket
+BANDS = 16
+SEED = 1
+MERSENNE_PRIME = (1 << 31) - 1
+# a bucket this large is a handful of generic stops shared by everything, not a signal
+MAX_BUCKET_SIZE = 500
+# routes per vectorized batch, bounds the (permutations x tokens) matrix
+BATCH_ROUTES = 20000
+
+SIGNATURES_PATH = f'{EXPORT_PATH}/signatures/part-00000.parquet'
+
+
+def token_hash(token: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=4).digest(), 'little')
+
+
+def route_token_sets(locations_df: pd.DataFrame) -> dict:
+    # a stop is its POI id, or its normalized name for locations without a POI yet
+    poi_ids = locations_df['poi_id'].fillna('') if 'poi_id' in locations_df else pd.Series('', index=locations_df.index)
+    tokens = [
+        f'poi:{poi_id}' if poi_id else f'name:{normalize_name("", name)}'
+        for name, poi_id in zip(locations_df['name'].fillna(''), poi_ids)
+    ]
+    frame = pd.DataFrame({'route_id': locations_df['route_id'].to_numpy(), 'token': tokens})
+    frame = frame[frame['token'] != 'name:']
+    return {route_id: frozenset(group) for route_id, group in frame.groupby('route_id')['token']}
+
+
+def fingerprint(tokens: frozenset) -> str:
+    return hashlib.blake2b('\n'.join(sorted(tokens)).encode('utf-8'), digest_size=8).hexdigest()
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, seed: int = SEED):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.seed = seed
+        # h(x) = (a * x + b) mod p, a 32-bit token times a 31-bit a stays below 2^63
+        self.a = rng.integers(1, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, MERSENNE_PRIME, num_perm, dtype=np.uint64)[:, None]
+
+    def signatures(self, token_sets: list[frozenset]) -> np.ndarray:
+        signatures = np.full((len(token_sets), self.num_perm), MERSENNE_PRIME, dtype=np.uint32)
+        for start in range(0, len(token_sets), BATCH_ROUTES):
+            batch = token_sets[start:start + BATCH_ROUTES]
+            lengths = np.array([len(tokens) for tokens in batch])
+            hashes = np.array([token_hash(token) for tokens in batch for token in tokens], dtype=np.uint64)
+            if not len(hashes):
+                continue
+
+            # tokens of a route are contiguous, the min over each run of columns is the route's signature
+            permuted = (self.a * hashes + self.b) % MERSENNE_PRIME
+            rows = np.flatnonzero(lengths)
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))[rows]
+            signatures[start + rows] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        return signatures
+
+
+def lsh_candidates(route_ids: list[str], signatures: np.ndarray, bands: int = BANDS) -> dict:
+    # routes landing in the same bucket of any band share stops, only they get the location comparison
+    rows_per_band = signatures.shape[1] // bands
+    candidates = {route_id: set() for route_id in route_ids}
+    located = np.flatnonzero((signatures != MERSENNE_PRIME).any(axis=1))
+
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[located, band * rows_per_band:(band + 1) * rows_per_band])
+        _, buckets, counts = np.unique(keys.view(f'V{keys.itemsize * rows_per_band}').ravel(),
+                                       return_inverse=True, return_counts=True)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.cumsum(counts)[:-1]
+        for members in np.split(located[order], bounds):
+            if 2 <= len(members) <= MAX_BUCKET_SIZE:
+                for row1, row2 in combinations(members, 2):
+                    candidates[route_ids[row1]].add(route_ids[row2])
+                    candidates[route_ids[row2]].add(route_ids[row1])
+    return candidates
+
+
+class SignatureStore:
+    # signatures of the previous run, reused for every route whose stops did not change
+    def __init__(self, hdfs_client: HDFSClient, path: str = SIGNATURES_PATH):
+        self.hdfs_client = hdfs_client
+        self.path = path
+
+    def load(self, hasher: MinHasher) -> dict:
+        if not self.hdfs_client.exists(self.path):
+            return {}
+
+        table = pq.read_table(io.BytesIO(self.hdfs_client.read_bytes(self.path)))
+        metadata = table.schema.metadata or {}
+        if metadata.get(b'num_perm') != str(hasher.num_perm).encode() or \
+                metadata.get(b'seed') != str(hasher.seed).encode():
+            logger.info('MinHash parameters changed, signatures are recomputed')
+            return {}
+
+        signatures = np.array(table.column('signature').to_pylist(), dtype=np.uint32)
+        return {
+            route_id: (route_fingerprint, signature)
+            for route_id, route_fingerprint, signature in zip(table.column('route_id').to_pylist(),
+                                                              table.column('fingerprint').to_pylist(), signatures)
+        }
+
+    def save(self, hasher: MinHasher, route_ids: list[str], fingerprints: list[str], signatures: np.ndarray):
+        schema = pa.schema([
+            ('route_id', pa.string()),
+            ('fingerprint', pa.string()),
+            ('signature', pa.list_(pa.uint32())),
+        ], metadata={'num_perm': str(hasher.num_perm), 'seed': str(hasher.seed)})
+        table = pa.Table.from_arrays([
+            pa.array(route_ids, type=pa.string()),
+            pa.array(fingerprints, type=pa.string()),
+            pa.array(list(signatures), type=pa.list_(pa.uint32())),
+        ], schema=schema)
+
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression='zstd')
+        buffer.seek(0)
+        self.hdfs_client.write_stream(self.path, buffer)
+
+
+def route_signatures(token_sets: dict, hasher: MinHasher, previous: dict = None) -> tuple[list, list, np.ndarray]:
+    previous = previous or {}
+    route_ids = list(token_sets)
+    fingerprints = [fingerprint(token_sets[route_id]) for route_id in route_ids]
+    signatures = np.empty((len(route_ids), hasher.num_perm), dtype=np.uint32)
+
+    changed = []
+    for row, (route_id, route_fingerprint) in enumerate(zip(route_ids, fingerprints)):
+        cached = previous.get(route_id)
+        if cached is not None and cached[0] == route_fingerprint:
+            signatures[row] = cached[1]
+        else:
+            changed.append(row)
+
+    if changed:
+        signatures[changed] = hasher.signatures([token_sets[route_ids[row]] for row in changed])
+    logger.info(f'MinHash signatures of {len(route_ids)} routes, {len(changed)} computed, '
+                f'{len(route_ids) - len(changed)} reused')
+    return route_ids, fingerprints, signatures
@@ -0,0 +1,212 @@
+import os
+from collections import defaultdict
+from datetime import datetime
+from itertools import combinations
+from uuid import NAMESPACE_URL, uuid5
+
+import pandas as pd
+from clickhouse_driver import Client
+
+from analyze.export import load_table
+from analyze.geocode import normalize_name
+from logger.logger import logger
+from metrics.metrics import StageTimer
+from model.route import Poi, Location
+from persistent.clickhouse_client import ClickhouseClient
+from persistent.hdfs_client import HDFSClient
+from utils.geo import distance_m, location_geohash
+
+POI_NAMESPACE = uuid5(NAMESPACE_URL, 'citywalk-aide/poi')
+
+# names sharing enough character bigrams are the same place, unless both have coordinates further apart than this
+NAME_SIMILARITY = 0.6
+MAX_DISTANCE_M = 500
+# a bigram shared by more names than this ("公园", "博物") is too common to block on
+MAX_BLOCK_SIZE = 200
+
+LATEST_POIS_QUERY = """
+SELECT id, city, aliases
+FROM citywalk_aide.pois FINAL
+WHERE version = (SELECT max(version) FROM citywalk_aide.pois)
+"""
+
+LOCATION_POIS_TABLE = 'citywalk_aide.location_pois'
+
+
+def name_ngrams(name: str, n: int = 2) -> set[str]:
+    if len(name) <= n:
+        return {name}
+    return {name[i:i + n] for i in range(len(name) - n + 1)}
+
+
+def is_same_name(name1: str, ngrams1: set[str], name2: str, ngrams2: set[str]) -> bool:
+    shorter, longer = sorted((name1, name2), key=len)
+    # "五大道" and "五大道风情区"
+    if len(shorter) >= 3 and shorter in longer:
+        return True
+    return len(ngrams1 & ngrams2) / len(ngrams1 | ngrams2) >= NAME_SIMILARITY
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+
+    def find(self, item: int) -> int:
+        while self.parents[item] != item:
+            self.parents[item] = self.parents[self.parents[item]]
+            item = self.parents[item]
+        return item
+
+    def union(self, item1: int, item2: int):
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 != root2:
+            self.parents[max(root1, root2)] = min(root1, root2)
+
+
+def name_groups(locations_df: pd.DataFrame) -> pd.DataFrame:
+    # one row per (city, normalized name), with the most common spelling and the median of the known coordinates
+    frame = locations_df.assign(normalized=[
+        normalize_name(city, name) for city, name in zip(locations_df['city'], locations_df['name'].fillna(''))
+    ])
+    frame = frame[frame['normalized'] != '']
+    located = frame[(frame['latitude'] != 0) | (frame['longitude'] != 0)]
+
+    groups = frame.groupby(['city', 'normalized']).agg(
+        name=('name', lambda names: names.value_counts().index[0]),
+        location_count=('id', 'size'),
+    )
+    coordinates = located.groupby(['city', 'normalized'])[['latitude', 'longitude']].median()
+    return groups.join(coordinates).fillna({'latitude': 0.0, 'longitude': 0.0}).reset_index()
+
+
+def cluster_city(groups: pd.DataFrame) -> list[int]:
+    # n-gram blocking: only names sharing a bigram are compared, instead of every pair of the city
+    names = list(groups['normalized'])
+    ngrams = [name_ngrams(name) for name in names]
+    coordinates = list(zip(groups['latitude'], groups['longitude']))
+
+    blocks = defaultdict(list)
+    for row, grams in enumerate(ngrams):
+        for gram in grams:
+            blocks[gram].append(row)
+
+    clusters = UnionFind(len(names))
+    compared = set()
+    for rows in blocks.values():
+        if len(rows) > MAX_BLOCK_SIZE:
+            continue
+        for row1, row2 in combinations(rows, 2):
+            if (row1, row2) in compared:
+                continue
+            compared.add((row1, row2))
+
+            if not is_same_name(names[row1], ngrams[row1], names[row2], ngrams[row2]):
+                continue
+            (lat1, lng1), (lat2, lng2) = coordinates[row1], coordinates[row2]
+            if (lat1 or lng1) and (lat2 or lng2) and distance_m(lat1, lng1, lat2, lng2) > MAX_DISTANCE_M:
+                continue
+            clusters.union(row1, row2)
+
+    return [clusters.find(row) for row in range(len(names))]
+
+
+def build_pois(locations_df: pd.DataFrame, version: datetime) -> tuple[list[Poi], dict]:
+    pois, aliases = [], {}
+    for city, groups in name_groups(locations_df).groupby('city'):
+        groups = groups.reset_index(drop=True)
+        groups['cluster'] = cluster_city(groups)
+
+        for _, cluster in groups.groupby('cluster'):
+            # the most common name of the cluster is canonical, the id stays stable as long as it does
+            cluster = cluster.sort_values('location_count', ascending=False)
+            canonical = cluster.iloc[0]
+            located = cluster[(cluster['latitude'] != 0) | (cluster['longitude'] != 0)]
+            latitude, longitude = (located.iloc[0]['latitude'], located.iloc[0]['longitude']) \
+                if len(located) else (0.0, 0.0)
+
+            poi = Poi(
+                id=str(uuid5(POI_NAMESPACE, f'{city}/{canonical["normalized"]}')),
+                city=city,
+                name=canonical['name'],
+                aliases=list(cluster['normalized']),
+                latitude=latitude,
+                longitude=longitude,
+                geohash=location_geohash(latitude, longitude),
+                location_count=int(cluster['location_count'].sum()),
+                version=version,
+            )
+            pois.append(poi)
+            aliases.update({(city, alias): poi.id for alias in poi.aliases})
+
+    return pois, aliases
+
+
+def assign_locations(clickhouse_client: Client, locations_df: pd.DataFrame, aliases: dict) -> int:
+    rows = []
+    for location_id, city, name, poi_id in locations_df[['id', 'city', 'name', 'poi_id']].itertuples(index=False):
+        new_poi_id = aliases.get((city, normalize_name(city, name or '')), '')
+        if new_poi_id != poi_id:
+            rows.append((location_id, new_poi_id))
+    if not rows:
+        return 0
+
+    # a Join table makes the assignments available to joinGet, so one mutation rewrites every changed location
+    clickhouse_client.execute(f"""
+    CREATE TABLE IF NOT EXISTS {LOCATION_POIS_TABLE} (location_id String, poi_id String)
+    ENGINE = Join(ANY, LEFT, location_id)
+    """)
+    clickhouse_client.execute(f'TRUNCATE TABLE {LOCATION_POIS_TABLE}')
+    clickhouse_client.execute(f'INSERT INTO {LOCATION_POIS_TABLE} (location_id, poi_id) VALUES', rows)
+    clickhouse_client.execute(f"""
+    ALTER TABLE citywalk_aide.locations
+    UPDATE poi_id = joinGet('{LOCATION_POIS_TABLE}', 'poi_id', toString(id))
+    WHERE toString(id) IN (SELECT location_id FROM {LOCATION_POIS_TABLE})
+    """, settings={'allow_nondeterministic_mutations': 1})
+    return len(rows)
+
+
+class PoiMatcher:
+    # assigns poi ids at structure time, names unknown to the last clustering run get one on the next run
+    def __init__(self, clickhouse_client: ClickhouseClient):
+        self.clickhouse_client = clickhouse_client
+        self.aliases = {}
+
+    def load(self):
+        # swapped as a whole, notes being structured keep matching against the previous aliases meanwhile
+        self.aliases = {
+            (row.city, alias): row.id
+            for row in self.clickhouse_client.select(LATEST_POIS_QUERY)
+            for alias in row.aliases
+        }
+        logger.info(f'Loaded {len(self.aliases)} POI aliases')
+
+    def match(self, city: str, locations: list[Location]) -> int:
+        matched = 0
+        for location in locations:
+            location.poi_id = self.aliases.get((city, normalize_name(city, location.name)), '')
+            matched += location.poi_id != ''
+        return matched
+
+
+def cluster_and_store_pois():
+    stages = StageTimer('POI clustering')
+    version = datetime.now().replace(microsecond=0)
+    hdfs_client = HDFSClient(os.getenv('HDFS_URL', 'http://localhost:50070'), 'root')
+
+    with stages.stage('load'):
+        locations_df = load_table(hdfs_client, 'locations',
+                                  columns=['id', 'city', 'name', 'latitude', 'longitude', 'poi_id'])
+    with stages.stage('cluster'):
+        pois, aliases = build_pois(locations_df, version)
+    logger.info(f'Clustered {len(locations_df)} locations into {len(pois)} POIs, {len(aliases)} names')
+
+    with stages.stage('store'):
+        ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL')).insert(pois, batch_size=10000)
+    with stages.stage('assign'):
+        changed = assign_locations(Client(os.getenv('CLICKHOUSE_HOST', 'localhost')), locations_df, aliases)
+    logger.info(f'Reassigned {changed} locations')
+    stages.log_summary()
+
+
+if __name__ == '__main__':
+    cluster_and_store_pois()
@@ -0,0 +1,170 @@
+import json
+import math
+import os
+import random
+import re
+import threading
+from datetime import datetime
+
+import numpy as np
+from dotenv import load_dotenv
+
+from common.constant import PREFILTER_MODEL_PATH
+from logger.logger import logger
+from metrics.metrics import PREFILTER_NOTES, PREFILTER_TOKENS_SAVED
+from model.note import NoteStructuring
+from persistent.clickhouse_client import ClickhouseClient
+
+TIME_PATTERN = re.compile(r'\d{1,2}\s*[:：点]\s*\d{0,2}|早上|上午|中午|下午|傍晚|晚上|[🕐-🕧⏰]')
+PLACE_PATTERN = re.compile(r'📍|🚩|[^\s，。、]{1,8}?(?:路|街|巷|桥|公园|广场|博物馆|寺|庙|塔|馆|站|湖|山|古镇|书店)')
+SEQUENCE_PATTERN = re.compile(r'→|->|➡️|⬇️|第[一二三四五六七八九十\d]+站|[Dd]ay\s*\d|[①-⑩]|(?:^|\n)\s*\d{1,2}\s*[.、)）]')
+ROUTE_PATTERN = re.compile(r'路线|攻略|行程|一日游|半日游|citywalk|city walk|打卡|出发|到达|顺路|逛', re.IGNORECASE)
+TRANSPORT_PATTERN = re.compile(r'步行|骑行|地铁|公交|打车|开车|\d+\s*分钟|\d+\s*(?:公里|km)')
+
+FEATURES = ('time_markers', 'place_markers', 'sequence_markers', 'route_words', 'transport_words', 'lines', 'length')
+
+# hand-set weights on log counts: a note with a few times, places and steps is well above 0.5, a caption of a single
+# line without any of them is well below 0.1
+HEURISTIC_WEIGHTS = (0.9, 0.7, 0.6, 0.5, 0.4, 0.3, 0.25)
+HEURISTIC_BIAS = -4.0
+
+DEFAULT_THRESHOLD = 0.1
+# share of the notes below the threshold that are still structured, so that calibration sees labels on both sides
+DEFAULT_EXPLORE_RATE = 0.02
+MIN_CALIBRATION_SAMPLES = 200
+
+
+def note_features(text: str) -> list[float]:
+    counts = (
+        len(TIME_PATTERN.findall(text)),
+        len(PLACE_PATTERN.findall(text)),
+        len(SEQUENCE_PATTERN.findall(text)),
+        len(ROUTE_PATTERN.findall(text)),
+        len(TRANSPORT_PATTERN.findall(text)),
+        text.count('\n') + 1,
+        len(text),
+    )
+    return [math.log1p(count) for count in counts]
+
+
+class NotePrefilter:
+    # decides whether a note is worth a structured LLM call, from its text alone. The weights are the heuristic ones
+    # until `calibrate` fits them on past LLM outcomes, a lower threshold trades cost for recall
+    def __init__(self, weights: tuple = HEURISTIC_WEIGHTS, bias: float = HEURISTIC_BIAS,
+                 threshold: float = DEFAULT_THRESHOLD, explore_rate: float = DEFAULT_EXPLORE_RATE):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = bias
+        self.threshold = threshold
+        self.explore_rate = explore_rate
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'scored': 0, 'skipped': 0, 'explored': 0, 'tokens_saved': 0}
+
+    @classmethod
+    def load(cls, path: str = PREFILTER_MODEL_PATH, threshold: float = None):
+        # the calibrated model if there is one, PREFILTER_THRESHOLD overrides its threshold
+        threshold = threshold if threshold is not None else os.getenv('PREFILTER_THRESHOLD')
+        explore_rate = float(os.getenv('PREFILTER_EXPLORE_RATE', DEFAULT_EXPLORE_RATE))
+        if not os.path.exists(path):
+            return cls(threshold=float(threshold or DEFAULT_THRESHOLD), explore_rate=explore_rate)
+
+        with open(path, 'r', encoding='utf-8') as f:
+            model = json.load(f)
+        if tuple(model['features']) != FEATURES:
+            logger.warning(f'Prefilter model {path} was trained on other features, using the heuristic weights')
+            return cls(threshold=float(threshold or DEFAULT_THRESHOLD), explore_rate=explore_rate)
+        logger.info(f'Loaded prefilter model trained on {model["samples"]} notes at {model["trained_at"]}')
+        return cls(model['weights'], model['bias'], float(threshold or model['threshold']), explore_rate)
+
+    def score(self, features: list[float]) -> float:
+        return float(1 / (1 + np.exp(-(self.weights @ np.asarray(features) + self.bias))))
+
+    def should_structure(self, score: float, tokens: int) -> bool:
+        with self.lock:
+            self.stats['scored'] += 1
+            if score >= self.threshold:
+                result = 'structured'
+            elif random.random() < self.explore_rate:
+                self.stats['explored'] += 1
+                result = 'explored'
+            else:
+                self.stats['skipped'] += 1
+                self.stats['tokens_saved'] += tokens
+                result = 'skipped'
+
+        PREFILTER_NOTES.inc(result=result)
+        if result == 'skipped':
+            PREFILTER_TOKENS_SAVED.inc(tokens)
+        return result != 'skipped'
+
+    def log_summary(self):
+        stats = self.stats
+        if not stats['scored']:
+            return
+        logger.info(f'Prefilter skipped {stats["skipped"]} of {stats["scored"]} notes '
+                    f'({stats["skipped"] / stats["scored"]:.1%}) at threshold {self.threshold:.2f}, '
+                    f'~{stats["tokens_saved"]} prompt tokens not sent, {stats["explored"]} structured to explore')
+
+
+def evaluate(scores: np.ndarray, labels: np.ndarray, threshold: float) -> tuple[float, float]:
+    # recall of the notes with routes and share of the notes skipped
+    kept = scores >= threshold
+    return float(kept[labels].mean()), float(1 - kept.mean())
+
+
+def calibrate(clickhouse_client: ClickhouseClient, target_recall: float = 0.97,
+              path: str = PREFILTER_MODEL_PATH) -> dict:
+    # fits the weights on the notes the LLM was called for, labelled by whether it found routes, and picks the
+    # highest threshold that keeps target_recall of them
+    from sklearn.linear_model import LogisticRegression
+
+    query = """
+    SELECT *
+    FROM citywalk_aide.note_structurings FINAL
+    WHERE skipped = 0
+    """
+    # outcomes written before a feature change are left out
+    rows = [row for row in clickhouse_client.select(query, model_class=NoteStructuring)
+            if len(row.features) == len(FEATURES)]
+    features = np.asarray([row.features for row in rows], dtype=np.float64)
+    labels = np.asarray([row.routes > 0 for row in rows], dtype=bool)
+    if len(rows) < MIN_CALIBRATION_SAMPLES or labels.all() or not labels.any():
+        logger.warning(f'Not enough labelled notes to calibrate the prefilter: {len(rows)}, {labels.sum()} with routes')
+        return {}
+
+    regression = LogisticRegression(class_weight='balanced', max_iter=1000).fit(features, labels)
+    scores = regression.predict_proba(features)[:, 1]
+    threshold = float(np.quantile(scores[labels], 1 - target_recall))
+    recall, skip_rate = evaluate(scores, labels, threshold)
+
+    heuristic = NotePrefilter()
+    heuristic_scores = np.asarray([heuristic.score(row) for row in features])
+    heuristic_recall, heuristic_skip_rate = evaluate(heuristic_scores, labels, DEFAULT_THRESHOLD)
+
+    model = {
+        'features': list(FEATURES),
+        'weights': regression.coef_[0].tolist(),
+        'bias': float(regression.intercept_[0]),
+        'threshold': threshold,
+        'recall': recall,
+        'skip_rate': skip_rate,
+        'samples': len(rows),
+        'trained_at': datetime.now().replace(microsecond=0).isoformat(),
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(model, f, indent=2)
+
+    logger.info(f'Calibrated the prefilter on {len(rows)} notes ({labels.mean():.1%} with routes): threshold '
+                f'{threshold:.3f} keeps {recall:.1%} of the route notes and skips {skip_rate:.1%} of the calls, '
+                f'the heuristic kept {heuristic_recall:.1%} and skipped {heuristic_skip_rate:.1%}')
+    return model
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    calibrate(ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL')),
+              float(os.getenv('PREFILTER_TARGET_RECALL', 0.97)))
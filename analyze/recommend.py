@@ -1,41 +1,37 @@
-import io
+import os
+
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+from analyze.export import load_table
+from analyze.minhash import MinHasher, SignatureStore, lsh_candidates, route_signatures, route_token_sets
+from common.similarity import WEIGHT_CITY, WEIGHT_DESCRIPTION, WEIGHT_LIKES, WEIGHT_LOCATION_NAME, WEIGHT_TIME, \
+    chinese_stopwords
+from metrics.metrics import StageTimer
+from model.route import RouteRecommendation
+from persistent.clickhouse_client import ClickhouseClient
 from persistent.hdfs_client import HDFSClient
 import schedule
 import time
-import json
 from datetime import datetime
 
-hdfs_client = HDFSClient('http://localhost:50070', 'root')
-routes_df = pd.read_csv(io.StringIO(hdfs_client.read_file('/user/data/routes.csv')))
-locations_df = pd.read_csv(io.StringIO(hdfs_client.read_file('/user/data/locations.csv')))
-recommend_result_path = '/user/data/recommend_result.json'
-
-
-def load_chinese_stopwords():
-    stopwords = []
-    with open('chinese_stopwords.txt', 'r', encoding='utf-8') as f:
-        stopwords = [line.strip() for line in f.readlines()]
-    return stopwords
+hdfs_client = HDFSClient(os.getenv('HDFS_URL', 'http://localhost:50070'), 'root')
 
 
-chinese_stopwords = load_chinese_stopwords()
+def load_data():
+    routes_df = load_table(hdfs_client, 'routes', columns=['id', 'city', 'summary', 'liked_count', 'published_at'])
+    locations_df = load_table(hdfs_client, 'locations', columns=['route_id', 'name', 'poi_id'])
+    return routes_df, locations_df
 
 
 def calculate_time_similarity(pub_date1, pub_date2):
-    date_format = "%Y-%m-%d"
-    pub1 = datetime.strptime(pub_date1, date_format)
-    pub2 = datetime.strptime(pub_date2, date_format)
-    delta = abs((pub1 - pub2).days)
+    delta = abs((pub_date1 - pub_date2).days)
     max_delta = 365
     return 1 - (delta / max_delta)
 
 
-def calculate_likes_similarity(likes1, likes2):
-    max_likes = max(routes_df['liked_count'])
+def calculate_likes_similarity(likes1, likes2, max_likes):
     return 1 - abs(likes1 - likes2) / max_likes
 
 
@@ -48,10 +44,7 @@ def calculate_description_similarity(desc1, desc2):
     return cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
 
 
-def calculate_location_name_similarity(route_id1, route_id2):
-    locations1 = locations_df[locations_df['route_id'] == route_id1]['name'].dropna().values
-    locations2 = locations_df[locations_df['route_id'] == route_id2]['name'].dropna().values
-
+def calculate_location_name_similarity(locations1, locations2):
     if len(locations1) == 0 or len(locations2) == 0:
         return 0.0
 
@@ -61,7 +54,32 @@ def calculate_location_name_similarity(route_id1, route_id2):
     return np.mean(similarity)
 
 
-def calculate_city_similarity(route_id1, route_id2):
+def load_poi_sets(locations_df):
+    if 'poi_id' not in locations_df:
+        return {}
+    located = locations_df[locations_df['poi_id'].fillna('') != '']
+    return {route_id: set(poi_ids) for route_id, poi_ids in located.groupby('route_id')['poi_id']}
+
+
+def calculate_location_similarity(location_names, poi_sets, route_id1, route_id2):
+    # routes stopping at the same POIs, Jaccard of the POI ids, names only for routes without POIs yet
+    pois1, pois2 = poi_sets.get(route_id1), poi_sets.get(route_id2)
+    if pois1 and pois2:
+        return len(pois1 & pois2) / len(pois1 | pois2)
+    return calculate_location_name_similarity(location_names.get(route_id1, []), location_names.get(route_id2, []))
+
+
+def find_candidates(locations_df, signature_store=None):
+    # routes sharing stops according to MinHash LSH, the others score 0 on the location component
+    hasher = MinHasher()
+    previous = signature_store.load(hasher) if signature_store is not None else {}
+    route_ids, fingerprints, signatures = route_signatures(route_token_sets(locations_df), hasher, previous)
+    if signature_store is not None:
+        signature_store.save(hasher, route_ids, fingerprints, signatures)
+    return lsh_candidates(route_ids, signatures)
+
+
+def calculate_city_similarity(routes_df, route_id1, route_id2):
     city1 = routes_df[routes_df['id'] == route_id1]['city'].dropna().values
     city2 = routes_df[routes_df['id'] == route_id2]['city'].dropna().values
 
@@ -71,9 +89,14 @@ def calculate_city_similarity(route_id1, route_id2):
     return 1.0 if city1[0] == city2[0] else 0.0
 
 
-def calculate_all_recommendations():
+def calculate_all_recommendations(routes_df, locations_df, candidates=None):
     recommendations_dict = {}
     total_routes = len(routes_df)
+    max_likes = max(routes_df['liked_count'])
+    poi_sets = load_poi_sets(locations_df)
+    location_names = locations_df.dropna(subset=['name']).groupby('route_id')['name'].apply(list).to_dict()
+    if candidates is None:
+        candidates = find_candidates(locations_df)
 
     for idx, current_route in routes_df.iterrows():
         current_route_id = current_route['id']
@@ -87,13 +110,17 @@ def calculate_all_recommendations():
 
             try:
                 time_similarity = calculate_time_similarity(current_route['published_at'], route['published_at'])
-                likes_similarity = calculate_likes_similarity(current_route['liked_count'], route['liked_count'])
+                likes_similarity = calculate_likes_similarity(current_route['liked_count'], route['liked_count'],
+                                                               max_likes)
                 description_similarity = calculate_description_similarity(current_route['summary'], route['summary'])
-                location_name_similarity = calculate_location_name_similarity(current_route_id, route['id'])
-                city_similarity = calculate_city_similarity(current_route_id, route['id'])
+                location_name_similarity = calculate_location_similarity(
+                    location_names, poi_sets, current_route_id, route['id']
+                ) if route['id'] in candidates.get(current_route_id, ()) else 0.0
+                city_similarity = calculate_city_similarity(routes_df, current_route_id, route['id'])
 
-                total_similarity = (0.1 * time_similarity + 0.2 * likes_similarity +
-                                    0.2 * description_similarity + 0.2 * location_name_similarity + 0.3 * city_similarity)
+                total_similarity = (WEIGHT_TIME * time_similarity + WEIGHT_LIKES * likes_similarity +
+                                    WEIGHT_DESCRIPTION * description_similarity +
+                                    WEIGHT_LOCATION_NAME * location_name_similarity + WEIGHT_CITY * city_similarity)
 
                 recommendations.append((route['id'], total_similarity))
             except Exception as e:
@@ -108,15 +135,32 @@ def calculate_all_recommendations():
     return recommendations_dict
 
 
-def calculate_and_store_recommendations():
-    print(f"Job started at {datetime.now()}")
-
-    all_recommendations = calculate_all_recommendations()
+def to_recommendation_models(all_recommendations, version):
+    for route_id, recommendations in all_recommendations.items():
+        for rank, (neighbour_id, score) in enumerate(recommendations, start=1):
+            yield RouteRecommendation(route_id=route_id, rank=rank, neighbour_id=neighbour_id, score=score,
+                                      version=version)
 
-    recommend_result = json.dumps(all_recommendations, ensure_ascii=False)
-    hdfs_client.write_file(recommend_result_path, recommend_result)
 
-    print(f"All recommendations have been calculated and stored at {recommend_result_path}.")
+def calculate_and_store_recommendations():
+    print(f"Job started at {datetime.now()}")
+    stages = StageTimer('Recommendation job')
+    version = datetime.now().replace(microsecond=0)
+
+    with stages.stage('load'):
+        routes_df, locations_df = load_data()
+    with stages.stage('minhash'):
+        candidates = find_candidates(locations_df, SignatureStore(hdfs_client))
+    with stages.stage('compute'):
+        all_recommendations = calculate_all_recommendations(routes_df, locations_df, candidates)
+
+    with stages.stage('store'):
+        clickhouse_client = ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL'))
+        # readers take the latest version of each route, so new results go live route by route as they land
+        clickhouse_client.insert(to_recommendation_models(all_recommendations, version), batch_size=10000)
+
+    print(f"All recommendations have been calculated and stored with version {version}.")
+    print(stages.summary())
 
 
 if __name__ == '__main__':
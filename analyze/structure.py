@@ -1,98 +1,327 @@
+import logging
+import os
 import time
 import schedule
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, date
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
 
-from llm.llm import chat
-from logger.logger import logger
-from model.note import NoteInfo
-from model.route import LLMRoutes, LLMRoute
+from analyze.compaction import CHUNK_TOKENS, chunk_note_text, clean_note_text, merge_routes
+from analyze.duplicates import NoteDeduplicator
+from analyze.geocode import LocationEnricher, new_enricher
+from analyze.listing import refresh_route_listings
+from analyze.poi import PoiMatcher
+from analyze.prefilter import NotePrefilter, note_features
+from llm.llm import chat_completion
+from llm.tokens import count_tokens
+from logger.logger import logger, log_sampled
+from metrics.metrics import STRUCTURE_TOKENS, StageTimer
+from model.note import NoteInfo, NoteStructuring
+from model.route import LLMPackedRoutes, LLMRoutes, LLMRoute
 from persistent.clickhouse_client import ClickhouseClient
 from persistent.hdfs_client import HDFSClient
 
 
+RUN_BATCH_NOTES = 500
+MAX_PACK_NOTES = 8
+PACK_NOTE_MARKER = '### note '
+
+
+@dataclass
+class PreparedNote:
+    note: NoteInfo
+    text: str
+    published_at: Optional[date]
+    score: float
+    features: list[float]
+    raw_tokens: int
+    tokens: int
+    # LLM usage, accumulated over the chunks or the packs the note went through
+    requests: float = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    llm_seconds: float = 0
+
+
 class StructureApplication:
-    def __init__(self, hdfs_client: HDFSClient, clickhouse_client: ClickhouseClient):
+    def __init__(self, hdfs_client: HDFSClient, clickhouse_client: ClickhouseClient,
+                 enricher: LocationEnricher = None, poi_matcher: PoiMatcher = None, prefilter: NotePrefilter = None,
+                 deduplicator: NoteDeduplicator = None, pack_tokens: int = 0, chunk_tokens: int = CHUNK_TOKENS):
         self.hdfs_client = hdfs_client
         self.clickhouse_client = clickhouse_client
+        self.enricher = enricher
+        self.poi_matcher = poi_matcher
+        self.prefilter = prefilter or NotePrefilter.load()
+        self.deduplicator = deduplicator or NoteDeduplicator(clickhouse_client)
+        self.pack_tokens = pack_tokens
+        self.chunk_tokens = chunk_tokens
+        self.stages = StageTimer('Structure')
 
-    def process_note(self, note: NoteInfo):
-        logger.info(f"Processing note ID: {note.id}")
+    def prepare_note(self, note: NoteInfo) -> Optional[PreparedNote]:
+        # the note text if the note has to go to the LLM, None if it is skipped. A read or insert error raises, so the
+        # note is retried instead of being taken as empty
+        log_sampled(logging.INFO, "Processing note ID: %s", note.id)
 
-        try:
+        with self.stages.stage('read'):
             html = self.hdfs_client.read_file(note.page_hdfs_path)
-            logger.info(f"Read HTML for note ID: {note.id} from HDFS.")
-        except Exception as e:
-            logger.error(f"Error reading file for note ID {note.id}: {e}")
-            return
 
-        soup = BeautifulSoup(html, 'html.parser')
+        with self.stages.stage('parse'):
+            soup = BeautifulSoup(html, 'html.parser')
 
         note_text_span = soup.select_one('#detail-desc > span > span:nth-child(1)')
         if note_text_span is None:
             logger.warning(f"No note text found for note ID {note.id}. Skipping this note.")
-            return
-        note_text = note_text_span.get_text(strip=True)
+            return None
+        raw_text = note_text_span.get_text(strip=True)
 
         note_create_time_span = soup.select_one(
             '#noteContainer > div.interaction-container > div.note-scroller > div.note-content > div.bottom-container > span.date'
         )
         if note_create_time_span is None:
             logger.warning(f"No creation time found for note ID {note.id}. Skipping this note.")
-            return
+            return None
         note_create_time = extract_date(note_create_time_span.text.strip())
 
-        llm_structured_result = chat(
-            content=note_text,
-            system=STRUCTURED_PROMPT,
-            json_schema=LLMRoutes
-        )
-        llm_routes = LLMRoutes.model_validate_json(llm_structured_result)
+        # hashtags and promotion are dropped before the text is compared or sent, the prefilter still sees them
+        with self.stages.stage('compact'):
+            note_text = clean_note_text(raw_text)
+
+        with self.stages.stage('dedupe'):
+            duplicate_of = self.deduplicator.check(note.id, note_text)
+        if duplicate_of:
+            log_sampled(logging.INFO, "Skipped note ID %s, near-duplicate of %s", note.id, duplicate_of)
+            return None
 
-        for llm_route in llm_routes.routes:
-            logger.info(f"Processing route for note ID {note.id}...")
-            route, locations = llm_route.to_route_model()
-            route.note_id = note.id
+        with self.stages.stage('prefilter'):
+            features = note_features(raw_text)
+            score = self.prefilter.score(features)
+        prepared = PreparedNote(note, note_text, note_create_time, score, features, count_tokens(raw_text),
+                                count_tokens(note_text))
+        if not self.prefilter.should_structure(score, count_tokens(STRUCTURED_PROMPT) + prepared.tokens):
+            log_sampled(logging.INFO, "Skipped note ID %s, prefilter score %.3f", note.id, score)
+            self.record_outcome(prepared, skipped=True)
+            return None
+
+        return prepared
+
+    def call_llm(self, content: str, system: str, json_schema, prepared_notes: list[PreparedNote]) -> str:
+        # the usage of a packed request is split over its notes by their share of the text, every note waited for
+        # the whole request
+        start = time.perf_counter()
+        with self.stages.stage('llm'):
+            result, usage = chat_completion(content=content, system=system, json_schema=json_schema)
+        elapsed = time.perf_counter() - start
+
+        total_tokens = sum(prepared.tokens for prepared in prepared_notes)
+        for prepared in prepared_notes:
+            share = prepared.tokens / total_tokens if total_tokens else 1 / len(prepared_notes)
+            prompt_tokens = round(usage.prompt_tokens * share)
+            completion_tokens = round(usage.completion_tokens * share)
+            prepared.requests += share
+            prepared.prompt_tokens += prompt_tokens
+            prepared.completion_tokens += completion_tokens
+            prepared.llm_seconds += elapsed
+            STRUCTURE_TOKENS.inc(prompt_tokens, city=prepared.note.city, type='prompt')
+            STRUCTURE_TOKENS.inc(completion_tokens, city=prepared.note.city, type='completion')
+        return result
+
+    def structure_note(self, prepared: PreparedNote) -> LLMRoutes:
+        # an oversized note is structured a day or section at a time, the routes of the chunks are merged
+        chunks = chunk_note_text(prepared.text, self.chunk_tokens)
+        parts = [
+            LLMRoutes.model_validate_json(self.call_llm(chunk, STRUCTURED_PROMPT, LLMRoutes, [prepared]))
+            for chunk in chunks
+        ]
+        if len(parts) > 1:
+            log_sampled(logging.INFO, "Structured note ID %s in %d chunks", prepared.note.id, len(parts))
+            return merge_routes(parts)
+        return parts[0]
+
+    def structure_pack(self, pack: list[PreparedNote]) -> dict:
+        # the routes of every note of the pack the LLM answered for, the others are structured one by one
+        content = '\n\n'.join(f'{PACK_NOTE_MARKER}{prepared.note.id}\n{prepared.text}' for prepared in pack)
+        try:
+            llm_structured_result = self.call_llm(content, PACKED_PROMPT, LLMPackedRoutes, pack)
+            packed = LLMPackedRoutes.model_validate_json(llm_structured_result)
+        except Exception as e:
+            logger.warning(f"Error structuring a pack of {len(pack)} notes, falling back to single notes: {e}")
+            return {}
+
+        note_ids = {prepared.note.id for prepared in pack}
+        return {
+            note_routes.note_id: LLMRoutes(routes=note_routes.routes)
+            for note_routes in packed.notes if note_routes.note_id in note_ids
+        }
+
+    def store_routes(self, prepared: PreparedNote, llm_routes: LLMRoutes) -> list[str]:
+        # the ids of the routes inserted for the note. A failed insert raises, the note stays pending since its outcome
+        # is only recorded once every route is in
+        note = prepared.note
+        route_ids = []
+        created_at = datetime.now().replace(microsecond=0)
+        for index, llm_route in enumerate(llm_routes.routes):
+            route, locations = llm_route.to_route_model(note.id, index, created_at)
             route.city = note.city
             route.liked_count = note.liked_count
-            route.published_at = note_create_time
+            route.published_at = prepared.published_at
 
-            try:
+            if self.enricher is not None:
+                try:
+                    with self.stages.stage('geocode'):
+                        self.enricher.enrich(note.city, locations)
+                except Exception as e:
+                    logger.error(f"Error geocoding locations for note ID {note.id}: {e}")
+            if self.poi_matcher is not None:
+                self.poi_matcher.match(note.city, locations)
+
+            with self.stages.stage('insert'):
                 self.clickhouse_client.insert(locations)
                 self.clickhouse_client.insert([route])
-                logger.info(f"Inserted route and locations for note ID {note.id} into Clickhouse.")
+            route_ids.append(str(route.id))
+            log_sampled(logging.INFO, "Inserted route and locations for note ID %s into Clickhouse.", note.id)
+
+        self.record_outcome(prepared, routes=len(route_ids))
+        return route_ids
+
+    def process_note(self, note: NoteInfo) -> list[str]:
+        prepared = self.prepare_note(note)
+        if prepared is None:
+            return []
+        return self.store_routes(prepared, self.structure_note(prepared))
+
+    def pack_notes(self, prepared_notes: list[PreparedNote]) -> list[list[PreparedNote]]:
+        # short notes share a request up to pack_tokens of note text, the prompt and schema are sent once per pack
+        if not self.pack_tokens:
+            return [[prepared] for prepared in prepared_notes]
+
+        groups, pack, pack_tokens = [], [], 0
+        for prepared in sorted(prepared_notes, key=lambda p: p.tokens):
+            if prepared.tokens > min(self.pack_tokens // 2, self.chunk_tokens):
+                groups.append([prepared])
+                continue
+            if pack and (pack_tokens + prepared.tokens > self.pack_tokens or len(pack) >= MAX_PACK_NOTES):
+                groups.append(pack)
+                pack, pack_tokens = [], 0
+            pack.append(prepared)
+            pack_tokens += prepared.tokens
+        if pack:
+            groups.append(pack)
+        return groups
+
+    def process_group(self, group: list[PreparedNote]) -> dict:
+        structured = self.structure_pack(group) if len(group) > 1 else {}
+        results = {}
+        for prepared in group:
+            try:
+                llm_routes = structured[prepared.note.id] if prepared.note.id in structured else \
+                    self.structure_note(prepared)
+                results[prepared.note.id] = self.store_routes(prepared, llm_routes)
             except Exception as e:
-                logger.error(f"Error inserting data for note ID {note.id}: {e}")
+                results[prepared.note.id] = e
+        return results
 
-    def run(self):
-        logger.info("Starting the application...")
+    def try_prepare_note(self, note: NoteInfo):
+        try:
+            return self.prepare_note(note)
+        except Exception as e:
+            return e
+
+    def process_notes(self, notes: list[NoteInfo], return_exceptions: bool = False, concurrency: int = 20) -> dict:
+        # the ids of the routes inserted for each note, or its error with return_exceptions
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            prepared_notes = list(executor.map(self.try_prepare_note, notes))
+            results = {
+                note.id: [] if prepared is None else prepared
+                for note, prepared in zip(notes, prepared_notes) if not isinstance(prepared, PreparedNote)
+            }
+            groups = self.pack_notes([prepared for prepared in prepared_notes if isinstance(prepared, PreparedNote)])
+            for group_results in executor.map(self.process_group, groups):
+                results.update(group_results)
+
+        if not return_exceptions:
+            for result in results.values():
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def record_outcome(self, prepared: PreparedNote, skipped: bool = False, routes: int = 0):
+        # empty LLM results are not structured again, and label the prefilter calibration
+        with self.stages.stage('insert'):
+            self.clickhouse_client.insert([NoteStructuring(
+                note_id=prepared.note.id,
+                city=prepared.note.city,
+                score=prepared.score,
+                features=prepared.features,
+                skipped=int(skipped),
+                routes=routes,
+                raw_tokens=prepared.raw_tokens,
+                text_tokens=prepared.tokens,
+                requests=prepared.requests,
+                prompt_tokens=prepared.prompt_tokens,
+                completion_tokens=prepared.completion_tokens,
+                llm_seconds=prepared.llm_seconds,
+                created_at=datetime.now().replace(microsecond=0),
+            )])
 
+    def load_pois(self):
+        if self.poi_matcher is not None:
+            try:
+                self.poi_matcher.load()
+            except Exception as e:
+                logger.error(f"Error loading POIs: {e}")
+
+    def pending_notes(self) -> list[NoteInfo]:
+        # a note crawled twice has two note_infos rows, it is structured once with the latest one. Notes the LLM found
+        # no route in are not sent again, skipped ones are when the threshold drops below their score. Near-duplicates
+        # of structured notes are never sent
         query = """
         SELECT n.*
         FROM citywalk_aide.note_infos AS n
-        LEFT JOIN citywalk_aide.routes AS r
-        ON n.id = r.note_id
-        WHERE n.id <> r.note_id
-        ORDER BY n.created_at
+        WHERE n.id NOT IN (SELECT note_id FROM citywalk_aide.routes)
+          AND n.id NOT IN (
+            SELECT note_id
+            FROM citywalk_aide.note_structurings FINAL
+            WHERE skipped = 0 OR score < {threshold:Float32}
+          )
+          AND n.id NOT IN (SELECT note_id FROM citywalk_aide.note_fingerprints FINAL WHERE duplicate_of != '')
+        ORDER BY n.created_at DESC
+        LIMIT 1 BY n.id
         """
+        return list(self.clickhouse_client.select(query, model_class=NoteInfo,
+                                                  params={'threshold': self.prefilter.threshold}))
+
+    def run(self):
+        logger.info("Starting the application...")
+        self.stages = StageTimer('Structure')
+        self.prefilter.reset_stats()
+        self.deduplicator.reset_stats()
+        self.load_pois()
 
         try:
-            note_infos = self.clickhouse_client.select(query, model_class=NoteInfo)
+            note_infos = self.pending_notes()
         except Exception as e:
             logger.error(f"Error retrieving note infos: {e}")
             return
 
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            futures = [executor.submit(self.process_note, note) for note in note_infos]
+        for start in range(0, len(note_infos), RUN_BATCH_NOTES):
+            results = self.process_notes(note_infos[start:start + RUN_BATCH_NOTES], return_exceptions=True)
+            for note_id, result in results.items():
+                if isinstance(result, Exception):
+                    logger.error(f"Error in processing note {note_id}: {result}")
 
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logger.error(f"Error in processing note: {e}")
+        try:
+            with self.stages.stage('listing'):
+                refresh_route_listings(self.clickhouse_client)
+        except Exception as e:
+            logger.error(f"Error refreshing route listings: {e}")
+
+        self.stages.log_summary()
+        self.prefilter.log_summary()
+        self.deduplicator.log_summary()
 
 
 def extract_date(data_string):
@@ -142,12 +371,19 @@ Notes:
 4.  If there is no valid route content in the article, {"routes": []} should be returned, and the list of locations for each route should be greater than 1
 """
 
+PACKED_PROMPT = STRUCTURED_PROMPT + f"""
+The message contains several articles, each one starts with a line `{PACK_NOTE_MARKER}<note id>`. Parse every article on its own,
+never mix locations of different articles in one route, and return one entry per article with its note id, in the same
+order. An article without valid route content gets an empty list of routes.
+"""
+
 if __name__ == '__main__':
     load_dotenv()
 
     hdfs_client = HDFSClient('http://localhost:50070', 'root')
     clickhouse_client = ClickhouseClient('citywalk_aide')
-    main_program = StructureApplication(hdfs_client, clickhouse_client)
+    main_program = StructureApplication(hdfs_client, clickhouse_client, new_enricher(), PoiMatcher(clickhouse_client),
+                                        pack_tokens=int(os.getenv('STRUCTURE_PACK_TOKENS', 0)))
 
     print("Scheduler started. Waiting for the job to run...")
 
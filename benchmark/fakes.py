@@ -0,0 +1,354 @@
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+import requests
+
+from llm.tokens import estimate_tokens
+
+WEBHDFS_PREFIX = '/webhdfs/v1'
+
+
+class BackgroundServer:
+    handler_class = None
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.owner = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send_body(self, status: int, body: bytes, content_type: str = 'application/json', headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, data):
+        self.send_body(status, json.dumps(data).encode('utf-8'))
+
+
+class WebHDFSHandler(QuietHandler):
+    def route(self):
+        parsed = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        path = unquote(parsed.path[len(WEBHDFS_PREFIX):]) or '/'
+        owner = self.server.owner
+        if owner.latency:
+            time.sleep(owner.latency)
+        return owner, path, owner.local_path(path), params.get('op', '').upper(), params
+
+    def not_found(self, path: str):
+        self.send_json(404, {'RemoteException': {
+            'exception': 'FileNotFoundException',
+            'javaClassName': 'java.io.FileNotFoundException',
+            'message': f'File {path} does not exist.',
+        }})
+
+    @staticmethod
+    def file_status(local_path: str, suffix: str = '') -> dict:
+        is_dir = os.path.isdir(local_path)
+        return {
+            'pathSuffix': suffix,
+            'type': 'DIRECTORY' if is_dir else 'FILE',
+            'length': 0 if is_dir else os.path.getsize(local_path),
+            'modificationTime': int(os.path.getmtime(local_path) * 1000),
+            'permission': '755',
+            'replication': 1,
+        }
+
+    def do_GET(self):
+        owner, path, local_path, op, params = self.route()
+        if not os.path.exists(local_path):
+            return self.not_found(path)
+
+        if op == 'OPEN':
+            with open(local_path, 'rb') as f:
+                f.seek(int(params.get('offset', 0)))
+                length = params.get('length')
+                data = f.read(int(length)) if length else f.read()
+            owner.stats['bytes_read'] += len(data)
+            return self.send_body(200, data, 'application/octet-stream')
+        if op == 'GETFILESTATUS':
+            return self.send_json(200, {'FileStatus': self.file_status(local_path)})
+        if op == 'LISTSTATUS':
+            statuses = [
+                self.file_status(os.path.join(local_path, name), name) for name in sorted(os.listdir(local_path))
+            ]
+            return self.send_json(200, {'FileStatuses': {'FileStatus': statuses}})
+        self.send_json(400, {'RemoteException': {'exception': 'IllegalArgumentException', 'message': op}})
+
+    def do_PUT(self):
+        owner, path, local_path, op, params = self.route()
+
+        if op == 'CREATE' and 'datanode' not in params:
+            # the namenode answers with a redirect, like WebHDFS does
+            location = f'{owner.url}{WEBHDFS_PREFIX}{self.path[len(WEBHDFS_PREFIX):]}&datanode=true'
+            self.read_body()
+            return self.send_body(307, b'', headers={'Location': location})
+        if op == 'CREATE':
+            data = self.read_body()
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with open(local_path, 'wb') as f:
+                f.write(data)
+            owner.stats['bytes_written'] += len(data)
+            return self.send_body(201, b'')
+        if op == 'MKDIRS':
+            os.makedirs(local_path, exist_ok=True)
+            return self.send_json(200, {'boolean': True})
+        if op == 'RENAME':
+            if not os.path.exists(local_path):
+                return self.send_json(200, {'boolean': False})
+            destination = owner.local_path(params['destination'])
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.rename(local_path, destination)
+            return self.send_json(200, {'boolean': True})
+        self.send_json(400, {'RemoteException': {'exception': 'IllegalArgumentException', 'message': op}})
+
+    def do_DELETE(self):
+        owner, path, local_path, op, params = self.route()
+        if not os.path.exists(local_path):
+            return self.send_json(200, {'boolean': False})
+        if os.path.isdir(local_path):
+            shutil.rmtree(local_path)
+        else:
+            os.remove(local_path)
+        self.send_json(200, {'boolean': True})
+
+
+class FakeWebHDFS(BackgroundServer):
+    handler_class = WebHDFSHandler
+
+    def __init__(self, root: str = None, latency: float = 0):
+        super().__init__()
+        self.root = root or tempfile.mkdtemp(prefix='fake-webhdfs-')
+        self.latency = latency
+        self.stats = defaultdict(int)
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip('/'))
+
+
+class OpenAIHandler(QuietHandler):
+    def do_POST(self):
+        owner = self.server.owner
+        body = json.loads(self.read_body() or b'{}')
+        messages = body.get('messages', [])
+        schema_name = (body.get('response_format') or {}).get('json_schema', {}).get('name', '')
+
+        if owner.latency:
+            time.sleep(owner.latency)
+
+        content = owner.responder(messages, schema_name)
+        prompt_tokens = sum(estimate_tokens(message.get('content') or '') for message in messages)
+        prompt_tokens += estimate_tokens(json.dumps(body.get('response_format') or {}))
+        completion_tokens = estimate_tokens(content)
+
+        with owner.lock:
+            owner.stats['requests'] += 1
+            owner.stats['prompt_tokens'] += prompt_tokens
+            owner.stats['completion_tokens'] += completion_tokens
+
+        self.send_json(200, {
+            'id': f'chatcmpl-{owner.stats["requests"]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'mock'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content, 'refusal': None},
+                'logprobs': None,
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        })
+
+
+def synthetic_routes(content: str) -> dict:
+    # the synthetic notes mark every stop with a pin, anything without pins is not an itinerary
+    stops = re.findall(r'📍([^\s，。]+)', content)
+    if len(stops) < 2:
+        return {'routes': []}
+
+    title = content.strip().splitlines()[0][:30]
+    return {'routes': [{
+        'title': title,
+        'summary': f'{title}，途经{"、".join(stops[:3])}',
+        'tags': ['citywalk'],
+        'start_time': '09:00',
+        'end_time': '18:00',
+        'total_duration': 60 * len(stops),
+        'notes': None,
+        'locations': [{
+            'name': stop,
+            'description': f'{stop}打卡',
+            'latitude': None,
+            'longitude': None,
+            'address': None,
+            'tags': ['景点'],
+            'entry_fee': None,
+            'time_range': None,
+            'duration': 60,
+            'activities': [{'name': '参观', 'description': None, 'duration': 30, 'optional': False}],
+            'transportation': [{'mode': '步行', 'distance': 1.0, 'duration': 15, 'notes': None}] if order else None,
+        } for order, stop in enumerate(stops)],
+    }]}
+
+
+def packed_routes(content: str) -> dict:
+    # the user message of a packed request is every note text after a `### note <id>` line
+    parts = re.split(r'^### note (\S+)$', content, flags=re.MULTILINE)
+    return {'notes': [
+        {'note_id': note_id, 'routes': synthetic_routes(text)['routes']}
+        for note_id, text in zip(parts[1::2], parts[2::2])
+    ]}
+
+
+def default_responder(messages: list, schema_name: str) -> str:
+    content = next((m.get('content') or '' for m in reversed(messages) if m.get('role') == 'user'), '')
+    if schema_name == 'LLMPackedRoutes':
+        return json.dumps(packed_routes(content), ensure_ascii=False)
+    if schema_name:
+        return json.dumps(synthetic_routes(content), ensure_ascii=False)
+    return 'ok'
+
+
+class MockOpenAI(BackgroundServer):
+    handler_class = OpenAIHandler
+
+    def __init__(self, latency: float = 0, responder=default_responder):
+        super().__init__()
+        self.latency = latency
+        self.responder = responder
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    @property
+    def base_url(self) -> str:
+        return f'{self.url}/v1'
+
+
+class RecordingClickhouse:
+    """In-process stand-in for ClickhouseClient when the SQL itself is not under test."""
+
+    def __init__(self, select_results: list = None):
+        self.select_results = select_results or []
+        self.lock = threading.Lock()
+        self.inserted = defaultdict(list)
+
+    def insert(self, model_instances, batch_size=1000):
+        instances = list(model_instances)
+        if not instances:
+            return
+        with self.lock:
+            self.inserted[instances[0].table_name()].extend(instances)
+
+    def select(self, query, model_class=None, settings=None, params=None):
+        return iter(self.select_results)
+
+    def count(self, model_class, conditions=None, params=None):
+        return 0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ClickhouseServer:
+    """Local clickhouse-server fixture, used when a clickhouse binary is installed."""
+
+    def __init__(self, binary: str = None):
+        self.binary = binary or os.getenv('CLICKHOUSE_BINARY') or shutil.which('clickhouse') or \
+            shutil.which('clickhouse-server')
+        self.process = None
+        self.path = None
+        self.http_port = None
+
+    @property
+    def available(self) -> bool:
+        return self.binary is not None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.http_port}/'
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='bench-clickhouse-')
+        self.http_port = free_port()
+        command = [self.binary] + (['server'] if os.path.basename(self.binary) == 'clickhouse' else []) + [
+            '--',
+            f'--http_port={self.http_port}',
+            f'--tcp_port={free_port()}',
+            '--mysql_port=',
+            '--postgresql_port=',
+            f'--path={self.path}/',
+            '--logger.console=0',
+            f'--logger.log={self.path}/server.log',
+            f'--logger.errorlog={self.path}/error.log',
+        ]
+        self.process = subprocess.Popen(command, cwd=self.path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                if requests.get(f'{self.url}ping', timeout=1).ok:
+                    return self
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError('clickhouse server did not start')
+
+    def __exit__(self, *exc):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(timeout=30)
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,515 @@
+# Pipeline benchmarks against local stand-ins, see benchmark/README.md
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmark.fakes import FakeWebHDFS, MockOpenAI, RecordingClickhouse, ClickhouseServer
+from benchmark.synthetic import CITIES, CITY_CENTRES, make_notes, make_note_html, make_recommend_frames, \
+    make_route_models, make_geo_locations
+from logger.logger import logger
+from persistent.hdfs_client import HDFSClient
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class Metric:
+    def __init__(self, value: float, unit: str, higher_is_better: bool):
+        self.value = value
+        self.unit = unit
+        self.higher_is_better = higher_is_better
+
+
+class FakeDriver:
+    def __init__(self, pages: dict):
+        self.pages = pages
+        self.page_source = ''
+
+    def get(self, url: str):
+        note_id = url.split('/explore/')[-1].split('?')[0]
+        self.page_source = self.pages.get(note_id, '<html></html>')
+
+
+def bench_crawl_ingest(notes_count: int = 300) -> dict:
+    from spider.frontier import CrawlFrontier
+    from spider.xhs import XHSSpider
+
+    class BenchSpider(XHSSpider):
+        sleep = staticmethod(lambda secs=3: None)
+
+    notes = make_notes(notes_count)
+    pages = {note.id: make_note_html(note) for note in notes}
+
+    with FakeWebHDFS() as webhdfs, tempfile.TemporaryDirectory() as path:
+        frontier = CrawlFrontier(os.path.join(path, 'frontier.db'))
+        clickhouse = RecordingClickhouse()
+        spider = BenchSpider(FakeDriver(pages), CITIES, HDFSClient(webhdfs.url, 'root'), clickhouse, frontier,
+                             'bench')
+
+        start = time.perf_counter()
+        for city in CITIES:
+            frontier.add(city, [note for note in notes if note.city == city])
+            while leased := frontier.lease('bench', city):
+                for note in leased:
+                    spider.crawl_note(city, note)
+        elapsed = time.perf_counter() - start
+
+        assert len(clickhouse.inserted['note_infos']) == notes_count
+
+    return {'crawl_ingest.notes_per_sec': Metric(notes_count / elapsed, 'notes/s', True)}
+
+
+def bench_structure(notes_count: int = 200, llm_latency: float = 0.05) -> dict:
+    from analyze.structure import StructureApplication
+    from llm import llm
+
+    notes = make_notes(notes_count)
+
+    with FakeWebHDFS() as webhdfs, MockOpenAI(latency=llm_latency) as openai:
+        llm.BASE_URL, llm.API_KEY = openai.base_url, 'bench'
+        hdfs_client = HDFSClient(webhdfs.url, 'root')
+        hdfs_client.write_many({note.page_hdfs_path: make_note_html(note) for note in notes})
+
+        clickhouse = RecordingClickhouse()
+        application = StructureApplication(hdfs_client, clickhouse)
+
+        # same fan-out as StructureApplication.run, without the pending-note query
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            list(executor.map(application.process_note, notes))
+        elapsed = time.perf_counter() - start
+
+        assert clickhouse.inserted['routes'], 'no route was structured'
+
+    return {
+        'structure.notes_per_sec': Metric(notes_count / elapsed, 'notes/s', True),
+        'structure.llm_requests_per_note': Metric(openai.stats['requests'] / notes_count, 'requests', False),
+        'structure.prompt_tokens_per_note': Metric(openai.stats['prompt_tokens'] / notes_count, 'tokens', False),
+    }
+
+
+def bench_packing(notes_count: int = 200, llm_latency: float = 0.05, pack_tokens: int = 1500) -> dict:
+    # the same notes structured one request per note and packed, the packed routes have to match
+    from analyze.structure import StructureApplication
+    from llm import llm
+
+    notes = make_notes(notes_count)
+
+    metrics = {}
+    routes = {}
+    with FakeWebHDFS() as webhdfs:
+        hdfs_client = HDFSClient(webhdfs.url, 'root')
+        hdfs_client.write_many({note.page_hdfs_path: make_note_html(note) for note in notes})
+
+        for mode, tokens in (('single', 0), ('packed', pack_tokens)):
+            with MockOpenAI(latency=llm_latency) as openai:
+                llm.BASE_URL, llm.API_KEY = openai.base_url, 'bench'
+                clickhouse = RecordingClickhouse()
+                application = StructureApplication(hdfs_client, clickhouse, pack_tokens=tokens)
+
+                start = time.perf_counter()
+                application.process_notes(notes)
+                elapsed = time.perf_counter() - start
+
+                routes[mode] = sorted((route.note_id, route.title) for route in clickhouse.inserted['routes'])
+                metrics[f'packing.{mode}_notes_per_sec'] = Metric(notes_count / elapsed, 'notes/s', True)
+                metrics[f'packing.{mode}_requests_per_note'] = Metric(
+                    openai.stats['requests'] / notes_count, 'requests', False)
+                metrics[f'packing.{mode}_prompt_tokens_per_note'] = Metric(
+                    openai.stats['prompt_tokens'] / notes_count, 'tokens', False)
+
+    assert routes['packed'] == routes['single'], 'packed routes differ from single-note routes'
+    return metrics
+
+
+def bench_workers(notes_count: int = 120, llm_latency: float = 0.3, worker_counts: tuple = (1, 4),
+                  concurrency: int = 2) -> dict:
+    # structure workers sharing one leased queue, LLM-latency bound like production
+    from analyze.structure import StructureApplication
+    from llm import llm
+    from pipeline.events import EventQueue, TOPIC_NOTES
+    from pipeline.orchestrator import Orchestrator
+
+    class NoteClickhouse(RecordingClickhouse):
+        def select(self, query, model_class=None, settings=None, params=None):
+            return iter(by_id[note_id] for note_id in (params or {}).get('note_ids', []))
+
+    notes = make_notes(notes_count)
+    by_id = {note.id: note for note in notes}
+
+    metrics = {}
+    with FakeWebHDFS() as webhdfs, MockOpenAI(latency=llm_latency) as openai, tempfile.TemporaryDirectory() as path:
+        llm.BASE_URL, llm.API_KEY = openai.base_url, 'bench'
+        hdfs_client = HDFSClient(webhdfs.url, 'root')
+        hdfs_client.write_many({note.page_hdfs_path: make_note_html(note) for note in notes})
+
+        for workers in worker_counts:
+            clickhouse = NoteClickhouse()
+            events = EventQueue(os.path.join(path, f'queue-{workers}.db'))
+            events.put(TOPIC_NOTES, [note.id for note in notes])
+            application = StructureApplication(hdfs_client, clickhouse)
+            orchestrators = [
+                Orchestrator(events, application, clickhouse, None, batch_size=concurrency, concurrency=concurrency,
+                             worker_id=f'bench-{worker}')
+                for worker in range(workers)
+            ]
+
+            def drain(orchestrator):
+                while orchestrator.structure_batch():
+                    pass
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(drain, orchestrators))
+            elapsed = time.perf_counter() - start
+
+            assert events.lag(TOPIC_NOTES)[0] == 0, 'notes left in the queue'
+            assert not events.dead_letters(TOPIC_NOTES), 'notes were dead-lettered'
+            assert clickhouse.inserted['routes'], 'no route was structured'
+            metrics[f'workers.notes_per_sec_{workers}'] = Metric(notes_count / elapsed, 'notes/s', True)
+
+    first, last = worker_counts[0], worker_counts[-1]
+    metrics['workers.scaling'] = Metric(
+        metrics[f'workers.notes_per_sec_{last}'].value / metrics[f'workers.notes_per_sec_{first}'].value, 'x', True)
+    return metrics
+
+
+def bench_recommend(routes_count: int = 40) -> dict:
+    from analyze.recommend import calculate_all_recommendations
+
+    routes_df, locations_df = make_recommend_frames(routes_count)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        recommendations = calculate_all_recommendations(routes_df, locations_df)
+    elapsed = time.perf_counter() - start
+
+    assert len(recommendations) == routes_count
+
+    return {'recommend.build_secs': Metric(elapsed, 's', False)}
+
+
+def bench_index(routes_count: int = 100000, requests_count: int = 500) -> dict:
+    from server.index import RouteIndex, RouteFeatures
+
+    routes_df, locations_df = make_recommend_frames(routes_count)
+    names = locations_df.groupby('route_id')['name'].agg(' '.join)
+    features = [
+        RouteFeatures(route.summary, names.get(route.id, ''), route.city, route.liked_count, route.published_at)
+        for route in routes_df.itertuples()
+    ]
+
+    # python objects (ids, vocabularies) included, measured apart from the timed build
+    tracemalloc.start()
+    traced = RouteIndex(list(routes_df['id']), features)
+    heap_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+
+    start = time.perf_counter()
+    index = RouteIndex(list(routes_df['id']), features)
+    build_secs = time.perf_counter() - start
+
+    route_latencies, query_latencies = [], []
+    for i in range(requests_count):
+        route_id = routes_df['id'].iat[i * 7919 % routes_count]
+        start = time.perf_counter()
+        index.recommend_route(route_id)
+        route_latencies.append((time.perf_counter() - start) * 1000)
+
+        city = CITIES[i % len(CITIES)]
+        start = time.perf_counter()
+        index.recommend_query(f'{city} {features[i].location_names.split()[0]} citywalk', city)
+        query_latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'index.build_secs': Metric(build_secs, 's', False),
+        'index.memory_mb': Metric(index.memory_bytes / 1024 / 1024, 'MB', False),
+        'index.heap_mb': Metric(heap_bytes / 1024 / 1024, 'MB', False),
+        'index.route_p50_ms': Metric(percentile(route_latencies, 0.5), 'ms', False),
+        'index.route_p99_ms': Metric(percentile(route_latencies, 0.99), 'ms', False),
+        'index.query_p50_ms': Metric(percentile(query_latencies, 0.5), 'ms', False),
+        'index.query_p99_ms': Metric(percentile(query_latencies, 0.99), 'ms', False),
+    }
+
+
+def bench_geo(locations_count: int = 1000000, requests_count: int = 500) -> dict:
+    from server.geo import GeoIndex
+
+    route_ids, latitudes, longitudes, liked_counts = make_geo_locations(locations_count)
+
+    start = time.perf_counter()
+    index = GeoIndex(route_ids, latitudes, longitudes, liked_counts)
+    build_secs = time.perf_counter() - start
+
+    centres = list(CITY_CENTRES.values())
+    latencies = {1000: [], 5000: [], 20000: []}
+    for i in range(requests_count):
+        latitude, longitude = centres[i % len(centres)]
+        latitude, longitude = latitude + (i % 17 - 8) * 0.005, longitude + (i % 13 - 6) * 0.005
+        for radius, values in latencies.items():
+            start = time.perf_counter()
+            index.nearby(latitude, longitude, radius)
+            values.append((time.perf_counter() - start) * 1000)
+
+    metrics = {
+        'geo.build_secs': Metric(build_secs, 's', False),
+        'geo.memory_mb': Metric(index.memory_bytes / 1024 / 1024, 'MB', False),
+    }
+    for radius, values in latencies.items():
+        metrics[f'geo.nearby_{radius // 1000}km_p50_ms'] = Metric(percentile(values, 0.5), 'ms', False)
+        metrics[f'geo.nearby_{radius // 1000}km_p99_ms'] = Metric(percentile(values, 0.99), 'ms', False)
+    return metrics
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+# tables as they were before model/migrations/0002_query_patterns.py, for the before/after schema benchmark
+LEGACY_TABLES = [
+    """
+    CREATE TABLE citywalk_aide.note_infos (
+        id String, xsec_token String, url String, type String, display_title String, liked_count Int32,
+        cover String, image_list String, user String, page_hdfs_path String, city String, created_at DateTime
+    ) ENGINE = MergeTree PARTITION BY toYYYYMM(created_at) ORDER BY (id, created_at)
+    """,
+    """
+    CREATE TABLE citywalk_aide.routes (
+        id UUID, note_id String, city String, title String, summary String, tags Array(String), start_time String,
+        end_time String, total_duration Int32, liked_count Int32, notes String, published_at Date,
+        created_at DateTime
+    ) ENGINE = MergeTree PARTITION BY toYYYYMM(created_at) ORDER BY (note_id, created_at)
+    """,
+    """
+    CREATE TABLE citywalk_aide.note_stats (
+        note_id String, city String, liked_count Int32, liked_velocity Float64, sampled_at DateTime,
+        next_refresh_at DateTime
+    ) ENGINE = ReplacingMergeTree(sampled_at) ORDER BY note_id
+    """,
+]
+
+
+def seed_clickhouse(clickhouse, notes: list, routes: list, locations: list, legacy: bool = False):
+    from model.note import NoteInfo, NoteStat
+    from analyze.listing import refresh_route_listings
+    from model.route import Route, Location, RouteRecommendation, Poi, RouteListing, RouteListingCount
+
+    if legacy:
+        for ddl in LEGACY_TABLES:
+            clickhouse.raw(ddl)
+    for model in (NoteInfo, Route, Location, NoteStat, RouteRecommendation, Poi, RouteListing, RouteListingCount):
+        clickhouse.create_table(model)
+    clickhouse.insert(notes)
+    clickhouse.insert(routes)
+    clickhouse.insert(locations)
+
+    route_ids = [str(route.id) for route in routes]
+    version = datetime.now().replace(microsecond=0)
+    clickhouse.insert(
+        RouteRecommendation(route_id=route_id, rank=rank, neighbour_id=neighbour, score=1 / rank, version=version)
+        for index, route_id in enumerate(route_ids)
+        for rank, neighbour in enumerate(route_ids[index + 1:index + 21], start=1)
+    )
+    refresh_route_listings(clickhouse)
+
+
+def api_client(clickhouse):
+    # the api module keeps its client from the first import, point it at this run's server
+    from server import api
+    api.clickhouse_client = api.route_index.clickhouse_client = api.geo_index.clickhouse_client = clickhouse
+    api.route_index.index = api.geo_index.index = None
+    return api, api.app.test_client()
+
+
+def api_endpoints(routes: list, locations: list) -> dict:
+    route_ids = [str(route.id) for route in routes]
+    return {
+        'search': lambda i: f'/search?city={CITIES[i % len(CITIES)]}&page={i % 3 + 1}',
+        'search_keyword': lambda i: f'/search?city={CITIES[i % len(CITIES)]}&keyword={routes[i].tags[1]}',
+        'route': lambda i: f'/route/{route_ids[i]}',
+        'recommendation': lambda i: f'/recommendation?route_id={route_ids[i]}',
+        'realtime_route': lambda i: f'/recommendation/realtime?route_id={route_ids[i]}',
+        'realtime_query': lambda i: f'/recommendation/realtime?city={CITIES[i % len(CITIES)]}&q={routes[i].summary}',
+        'nearby': lambda i: f'/nearby?lat={locations[i].latitude}&lng={locations[i].longitude}&radius=2000',
+    }
+
+
+def bench_api(notes_count: int = 500, requests_count: int = 50) -> dict:
+    clickhouse_server = ClickhouseServer()
+    if not clickhouse_server.available:
+        logger.warning('No clickhouse binary found, skip api benchmark')
+        return {}
+
+    notes = make_notes(notes_count)
+    routes, locations = make_route_models(notes)
+
+    with clickhouse_server:
+        os.environ['CLICKHOUSE_URL'] = clickhouse_server.url
+
+        from persistent.clickhouse_client import ClickhouseClient
+
+        clickhouse = ClickhouseClient('citywalk_aide', clickhouse_server.url)
+        seed_clickhouse(clickhouse, notes, routes, locations)
+        _, client = api_client(clickhouse)
+
+        metrics = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name, url in api_endpoints(routes, locations).items():
+                latencies = []
+                for i in range(requests_count):
+                    start = time.perf_counter()
+                    response = client.get(url(i))
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    assert response.status_code == 200, f'{url(i)}: {response.status_code}'
+
+                metrics[f'api.{name}_p50_ms'] = Metric(percentile(latencies, 0.5), 'ms', False)
+                metrics[f'api.{name}_p95_ms'] = Metric(percentile(latencies, 0.95), 'ms', False)
+
+    return metrics
+
+
+def rows_read_per_request(clickhouse, client, endpoints: dict, phase: str, requests_count: int) -> dict:
+    for name, url in endpoints.items():
+        clickhouse.add_setting('log_comment', f'bench.{phase}.{name}')
+        for i in range(requests_count):
+            response = client.get(url(i))
+            assert response.status_code == 200, f'{url(i)}: {response.status_code}'
+    clickhouse.add_setting('log_comment', None)
+
+    clickhouse.raw('SYSTEM FLUSH LOGS')
+    rows = clickhouse.select("""
+    SELECT log_comment, sum(read_rows) AS read_rows
+    FROM system.query_log
+    WHERE type = 'QueryFinish' AND startsWith(log_comment, {prefix:String})
+    GROUP BY log_comment
+    """, params={'prefix': f'bench.{phase}.'})
+    return {row.log_comment.split('.')[-1]: row.read_rows / requests_count for row in rows}
+
+
+def bench_schema(notes_count: int = 5000, requests_count: int = 20) -> dict:
+    # rows read per API request on the legacy tables, then again after migrating them in place
+    clickhouse_server = ClickhouseServer()
+    if not clickhouse_server.available:
+        logger.warning('No clickhouse binary found, skip schema benchmark')
+        return {}
+
+    notes = make_notes(notes_count)
+    routes, locations = make_route_models(notes)
+
+    with clickhouse_server:
+        os.environ['CLICKHOUSE_URL'] = clickhouse_server.url
+
+        from model.init import init_schema
+        from persistent.clickhouse_client import ClickhouseClient
+
+        clickhouse = ClickhouseClient('citywalk_aide', clickhouse_server.url)
+        seed_clickhouse(clickhouse, notes, routes, locations, legacy=True)
+        api, client = api_client(clickhouse)
+        endpoints = api_endpoints(routes, locations)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            api.route_index.get()
+            api.geo_index.get()
+            before = rows_read_per_request(clickhouse, client, endpoints, 'before', requests_count)
+            init_schema(clickhouse)
+            after = rows_read_per_request(clickhouse, client, endpoints, 'after', requests_count)
+
+    metrics = {}
+    for name in endpoints:
+        metrics[f'schema.{name}_rows_before'] = Metric(before.get(name, 0), 'rows', False)
+        metrics[f'schema.{name}_rows_after'] = Metric(after.get(name, 0), 'rows', False)
+    return metrics
+
+
+BENCHMARKS = {
+    'crawl_ingest': bench_crawl_ingest,
+    'structure': bench_structure,
+    'packing': bench_packing,
+    'workers': bench_workers,
+    'recommend': bench_recommend,
+    'index': bench_index,
+    'geo': bench_geo,
+    'api': bench_api,
+    'schema': bench_schema,
+}
+
+
+def run_benchmarks(names: list[str], repeat: int) -> dict:
+    results = {}
+    for name in names:
+        runs = [BENCHMARKS[name]() for _ in range(repeat)]
+        for metric_name in runs[0]:
+            first = runs[0][metric_name]
+            value = statistics.median(run[metric_name].value for run in runs)
+            results[metric_name] = Metric(value, first.unit, first.higher_is_better)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, metric in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        if metric.higher_is_better:
+            regressed = metric.value < base['value'] * (1 - tolerance)
+        else:
+            regressed = metric.value > base['value'] * (1 + tolerance)
+        if regressed:
+            regressions.append(f'{name}: {metric.value:.3f} {metric.unit}, baseline {base["value"]:.3f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Citywalk-aide pipeline benchmarks')
+    parser.add_argument('--only', action='append', choices=BENCHMARKS.keys(), help='Benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the median is reported')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.3, help='Allowed relative slowdown')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    results = run_benchmarks(args.only or list(BENCHMARKS), args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    for name, metric in results.items():
+        base = baseline.get(name, {}).get('value')
+        print(f'{name:40s} {metric.value:12.3f} {metric.unit:10s}' +
+              (f' baseline {base:12.3f}' if base is not None else ''))
+
+    if args.update_baseline:
+        baseline.update({
+            name: {'value': round(metric.value, 4), 'unit': metric.unit, 'higher_is_better': metric.higher_is_better}
+            for name, metric in results.items()
+        })
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('Regressions:\n  ' + '\n  '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import random
+from datetime import date, datetime, timedelta
+from uuid import UUID
+
+import numpy as np
+import pandas as pd
+
+from model.note import NoteInfo, ImageInfo, UserInfo
+from model.route import Route, Location
+from utils.geo import location_geohash
+from utils.utils import json_encode
+
+CITIES = ['天津', '上海', '北京', '杭州', '成都', '广州']
+
+PLACES = {
+    '天津': ['解放桥', '世纪钟', '意大利风情街', '北安桥', '瓷房子', '五大道', '西开教堂', '古文化街', '天津之眼', '民园广场'],
+    '上海': ['外滩', '武康路', '安福路', '豫园', '新天地', '田子坊', '思南公馆', '徐家汇书院', '陆家嘴', '苏州河'],
+    '北京': ['故宫', '景山公园', '北海公园', '南锣鼓巷', '什刹海', '鼓楼', '国子监', '雍和宫', '前门大街', '天坛'],
+    '杭州': ['西湖', '断桥', '白堤', '孤山', '南宋御街', '河坊街', '小河直街', '湖滨步行街', '灵隐寺', '龙井村'],
+    '成都': ['宽窄巷子', '人民公园', '春熙路', '太古里', '大慈寺', '锦里', '武侯祠', '杜甫草堂', '玉林路', '望江楼'],
+    '广州': ['沙面', '永庆坊', '北京路', '陈家祠', '东山口', '海心沙', '广州塔', '上下九', '越秀公园', '荔枝湾'],
+}
+
+CITY_CENTRES = {
+    '天津': (39.1256, 117.1902),
+    '上海': (31.2304, 121.4737),
+    '北京': (39.9042, 116.4074),
+    '杭州': (30.2741, 120.1551),
+    '成都': (30.5728, 104.0668),
+    '广州': (23.1291, 113.2644),
+}
+
+FILLERS = ['强烈推荐', '人不多', '适合拍照', '吃了好多小吃', '天气很好', '走累了歇一会', '晚上更好看', '记得预约']
+
+NOTE_HTML = """<html><body>
+<div id="noteContainer"><div class="interaction-container"><div class="note-scroller"><div class="note-content">
+<div id="detail-desc"><span><span>{text}</span></span></div>
+<div class="bottom-container"><span class="date">{date}</span></div>
+</div></div></div></div>
+</body></html>"""
+
+
+def make_note_text(rng: random.Random, city: str, stops: int) -> str:
+    places = rng.sample(PLACES[city], stops)
+    lines = [f'{city}citywalk一日游，{rng.choice(FILLERS)}']
+    hour = 9
+    for place in places:
+        lines.append(f'{hour:02d}:00 📍{place} {rng.choice(FILLERS)}，{rng.choice(FILLERS)}')
+        hour += 1
+    return '\n'.join(lines)
+
+
+def make_notes(count: int, seed: int = 7) -> list[NoteInfo]:
+    rng = random.Random(seed)
+    notes = []
+    for index in range(count):
+        note_id = f'{seed:04x}{index:020x}'
+        city = CITIES[index % len(CITIES)]
+        notes.append(NoteInfo(
+            id=note_id,
+            xsec_token=f'token{index}',
+            url=f'/explore/{note_id}?xsec_token=token{index}&xsec_source=pc_search&source=',
+            type='note',
+            display_title=f'{city}citywalk路线{index}',
+            liked_count=rng.randint(0, 20000),
+            cover=json_encode(ImageInfo(width=1080, height=1440, url=f'https://example.com/{note_id}.jpg')),
+            image_list=json_encode([]),
+            user=json_encode(UserInfo(nick_name='bench', avatar='', user_id=str(index), nickname='bench',
+                                      xsec_token='')),
+            page_hdfs_path=f'/user/spider/xhs/note/{note_id}.html',
+            city=city,
+            created_at=datetime(2024, 1, 1) + timedelta(minutes=index),
+        ))
+    return notes
+
+
+def make_note_html(note: NoteInfo, seed: int = 7) -> str:
+    rng = random.Random(f'{seed}-{note.id}')
+    # roughly one in ten notes is not an itinerary at all
+    text = f'{note.city}{rng.choice(FILLERS)}' if rng.random() < 0.1 else \
+        make_note_text(rng, note.city, rng.randint(3, 8))
+    published = date(2024, 1, 1) + timedelta(days=rng.randint(0, 300))
+    return NOTE_HTML.format(text=text, date=f'编辑于 {published.isoformat()}')
+
+
+def make_recommend_frames(count: int, seed: int = 7) -> tuple[pd.DataFrame, pd.DataFrame]:
+    rng = random.Random(seed)
+    routes, locations = [], []
+    for index in range(count):
+        route_id = str(UUID(int=rng.getrandbits(128)))
+        city = CITIES[index % len(CITIES)]
+        places = rng.sample(PLACES[city], rng.randint(3, 6))
+        routes.append({
+            'id': route_id,
+            'city': city,
+            'summary': f'{city}citywalk，途经{"、".join(places)}，{rng.choice(FILLERS)}',
+            'liked_count': rng.randint(0, 20000),
+            'published_at': date(2024, 1, 1) + timedelta(days=rng.randint(0, 300)),
+        })
+        locations.extend({'route_id': route_id, 'name': place} for place in places)
+    return pd.DataFrame(routes), pd.DataFrame(locations)
+
+
+def place_coordinates(city: str, place: str) -> tuple[float, float]:
+    # a fixed spot within ~5km of the city centre
+    rng = random.Random(place)
+    latitude, longitude = CITY_CENTRES[city]
+    return latitude + rng.uniform(-0.045, 0.045), longitude + rng.uniform(-0.05, 0.05)
+
+
+def make_geo_locations(count: int, seed: int = 7) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # route ids, latitudes, longitudes and route likes of `count` stops, ~5 per route, spread around the centres
+    rng = np.random.default_rng(seed)
+    route_rows = np.sort(rng.integers(0, count // 5, count))
+    centres = np.array(list(CITY_CENTRES.values()))[route_rows % len(CITY_CENTRES)]
+    latitudes = centres[:, 0] + rng.normal(0, 0.05, count)
+    longitudes = centres[:, 1] + rng.normal(0, 0.06, count)
+    liked_counts = rng.integers(0, 20000, count // 5)[route_rows]
+    route_ids = np.array([f'{row:032x}' for row in range(count // 5)], dtype=object)[route_rows]
+    return route_ids, latitudes, longitudes, liked_counts
+
+
+def make_route_models(notes: list[NoteInfo], seed: int = 7) -> tuple[list[Route], list[Location]]:
+    rng = random.Random(seed)
+    routes, locations = [], []
+    for note in notes:
+        route_id = UUID(int=rng.getrandbits(128))
+        places = rng.sample(PLACES[note.city], rng.randint(3, 6))
+        routes.append(Route(
+            id=route_id,
+            note_id=note.id,
+            city=note.city,
+            title=note.display_title,
+            summary=f'{note.city}citywalk，途经{"、".join(places)}',
+            tags=['citywalk', rng.choice(FILLERS)],
+            start_time='09:00',
+            end_time='18:00',
+            total_duration=60 * len(places),
+            liked_count=note.liked_count,
+            notes='',
+            published_at=date(2024, 1, 1) + timedelta(days=rng.randint(0, 300)),
+            created_at=note.created_at,
+        ))
+        for order, place in enumerate(places):
+            latitude, longitude = place_coordinates(note.city, place)
+            locations.append(Location(
+                id=UUID(int=rng.getrandbits(128)),
+                route_id=str(route_id),
+                order=order + 1,
+                name=place,
+                description=f'{place}打卡',
+                latitude=latitude,
+                longitude=longitude,
+                geohash=location_geohash(latitude, longitude),
+                tags=['景点'],
+                duration=60,
+                activities=[('参观', None, 30, 0)],
+                transportation=[('步行', 1.0, 15, None)] if order else [],
+                created_at=note.created_at,
+            ))
+    return routes, locations
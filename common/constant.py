@@ -1 +1,5 @@
-HDFS_PATH_XHS='/user/spider/xhs/note'
\ No newline at end of file
+HDFS_PATH_XHS='/user/spider/xhs/note'
+SPIDER_FRONTIER_PATH='data/spider_frontier.db'
+GEOCODE_CACHE_PATH='data/geocode_cache.db'
+PIPELINE_QUEUE_PATH='data/pipeline_queue.db'
+PREFILTER_MODEL_PATH='data/note_prefilter.json'
\ No newline at end of file
@@ -0,0 +1,18 @@
+import os
+
+# weights of the route similarity, the same for the batch recommendation jobs and the in-memory route index
+WEIGHT_TIME = 0.1
+WEIGHT_LIKES = 0.2
+WEIGHT_DESCRIPTION = 0.2
+WEIGHT_LOCATION_NAME = 0.2
+WEIGHT_CITY = 0.3
+
+STOPWORDS_PATH = os.path.join(os.path.dirname(__file__), 'chinese_stopwords.txt')
+
+
+def load_chinese_stopwords(path: str = STOPWORDS_PATH) -> list[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f]
+
+
+chinese_stopwords = load_chinese_stopwords()
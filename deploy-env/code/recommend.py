@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+from pyspark.ml import Pipeline
+from pyspark.ml.feature import HashingTF, IDF, Normalizer, RegexTokenizer, StopWordsRemover
+from pyspark.sql import SparkSession, Window
+from pyspark.sql import functions as F
+from pyspark.sql.types import DoubleType
+
+from logger.logger import logger
+from model.route import RouteRecommendation
+from persistent.clickhouse_client import ClickhouseClient
+from persistent.hdfs_client import HDFSClient, LocalFSClient
+
+WEIGHT_TIME = 0.1
+WEIGHT_LIKES = 0.2
+WEIGHT_DESCRIPTION = 0.2
+WEIGHT_LOCATION_NAME = 0.2
+WEIGHT_CITY = 0.3
+
+# same token pattern as sklearn's TfidfVectorizer, (?U) makes \w match CJK characters in Java regex
+TOKEN_PATTERN = r'(?U)\w\w+'
+
+
+def current_table_path(spark, path):
+    # analyze/export.py publishes every export as a version directory of the table, the latest one is read
+    table = spark._jvm.org.apache.hadoop.fs.Path(path)
+    fs = table.getFileSystem(spark._jsc.hadoopConfiguration())
+    versions = sorted(name for name in (status.getPath().getName() for status in fs.listStatus(table))
+                      if name.isdigit())
+    return f'{path}/{versions[-1]}' if versions else path
+
+
+def load_chinese_stopwords(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f.readlines() if line.strip()]
+
+
+def tfidf_stages(input_col, output_col, stopwords, num_features):
+    return [
+        RegexTokenizer(inputCol=input_col, outputCol=f'{input_col}_tokens', pattern=TOKEN_PATTERN, gaps=False),
+        StopWordsRemover(inputCol=f'{input_col}_tokens', outputCol=f'{input_col}_terms', stopWords=stopwords),
+        HashingTF(inputCol=f'{input_col}_terms', outputCol=f'{input_col}_tf', numFeatures=num_features),
+        IDF(inputCol=f'{input_col}_tf', outputCol=f'{input_col}_tfidf'),
+        Normalizer(inputCol=f'{input_col}_tfidf', outputCol=output_col, p=2.0),
+    ]
+
+
+@F.udf(returnType=DoubleType())
+def cosine_similarity(vector1, vector2):
+    # vectors are L2-normalized, so the dot product is the cosine similarity
+    if vector1 is None or vector2 is None:
+        return 0.0
+    return float(vector1.dot(vector2))
+
+
+class RecommendApplication:
+    def __init__(self, spark, input_path, stopwords, top_k=20, num_features=1 << 18):
+        self.spark = spark
+        self.input_path = input_path
+        self.stopwords = stopwords
+        self.top_k = top_k
+        self.num_features = num_features
+
+    def load_features(self):
+        routes = self.spark.read.parquet(current_table_path(self.spark, f'{self.input_path}/routes')) \
+            .select('id', 'city', 'summary', 'liked_count', 'published_at') \
+            .fillna({'summary': ''})
+
+        # collect_set skips the nulls, i.e. locations without a POI yet
+        location_names = self.spark.read.parquet(current_table_path(self.spark, f'{self.input_path}/locations')) \
+            .where(F.col('name').isNotNull()) \
+            .groupBy('route_id') \
+            .agg(F.concat_ws(' ', F.collect_list('name')).alias('location_names'),
+                 F.collect_set(F.when(F.col('poi_id') != '', F.col('poi_id'))).alias('pois'))
+
+        routes = routes.join(location_names, routes.id == location_names.route_id, 'left') \
+            .drop('route_id') \
+            .fillna({'location_names': ''}) \
+            .withColumn('pois', F.coalesce(F.col('pois'), F.array().cast('array<string>')))
+
+        pipeline = Pipeline(stages=tfidf_stages('summary', 'summary_vector', self.stopwords, self.num_features) +
+                                   tfidf_stages('location_names', 'location_vector', self.stopwords,
+                                                self.num_features))
+
+        return pipeline.fit(routes).transform(routes) \
+            .select('id', 'city', 'liked_count', 'published_at', 'summary_vector', 'location_vector', 'pois')
+
+    def run(self):
+        features = self.load_features().repartition('city').cache()
+        max_likes = features.agg(F.max('liked_count')).first()[0] or 1
+        logger.info(f'Loaded features of {features.count()} routes, max liked count {max_likes}')
+
+        # candidates only come from the same city: the city weight dominates the score, and it keeps the
+        # pairwise join bounded by the largest city instead of the whole table
+        current = features.alias('a')
+        candidate = features.alias('b')
+        pairs = current.join(candidate, (F.col('a.city') == F.col('b.city')) & (F.col('a.id') != F.col('b.id')))
+
+        time_similarity = 1 - F.abs(F.datediff(F.col('a.published_at'), F.col('b.published_at'))) / 365
+        likes_similarity = 1 - F.abs(F.col('a.liked_count') - F.col('b.liked_count')) / max_likes
+        description_similarity = cosine_similarity(F.col('a.summary_vector'), F.col('b.summary_vector'))
+        # Jaccard of the POI ids, names only for routes without POIs yet
+        location_name_similarity = F.when(
+            (F.size('a.pois') > 0) & (F.size('b.pois') > 0),
+            F.size(F.array_intersect('a.pois', 'b.pois')) / F.size(F.array_union('a.pois', 'b.pois')),
+        ).otherwise(cosine_similarity(F.col('a.location_vector'), F.col('b.location_vector')))
+
+        scores = pairs.select(
+            F.col('a.id').alias('route_id'),
+            F.col('b.id').alias('neighbour_id'),
+            (WEIGHT_TIME * F.coalesce(time_similarity, F.lit(0.0)) +
+             WEIGHT_LIKES * likes_similarity +
+             WEIGHT_DESCRIPTION * description_similarity +
+             WEIGHT_LOCATION_NAME * location_name_similarity +
+             WEIGHT_CITY).alias('score'),
+        )
+
+        window = Window.partitionBy('route_id').orderBy(F.col('score').desc(), F.col('neighbour_id'))
+        return scores.withColumn('rank', F.row_number().over(window)) \
+            .where(F.col('rank') <= self.top_k) \
+            .groupBy('route_id') \
+            .agg(F.sort_array(F.collect_list(F.struct('rank', 'neighbour_id', 'score'))).alias('recommendations'))
+
+
+class RecommendationWriter:
+    def __init__(self, clickhouse_url, version, batch_size=10000):
+        self.clickhouse_url = clickhouse_url
+        self.version = version
+        self.batch_size = batch_size
+
+    def __call__(self, rows):
+        # one client per partition on the executor, every route's top-K is written as one version
+        clickhouse_client = ClickhouseClient('citywalk_aide', self.clickhouse_url)
+        clickhouse_client.insert((
+            RouteRecommendation(route_id=row.route_id, rank=item.rank, neighbour_id=item.neighbour_id,
+                                score=item.score, version=self.version)
+            for row in rows for item in row.recommendations
+        ), batch_size=self.batch_size)
+
+
+def iter_recommend_json(rows):
+    # same layout as analyze/recommend.py: {route_id: [[neighbour_id, score], ...]}, streamed row by row
+    yield b'{'
+    for index, row in enumerate(rows):
+        recommendations = [[item.neighbour_id, item.score] for item in row.recommendations]
+        entry = json.dumps(row.route_id) + ': ' + json.dumps(recommendations)
+        yield ((', ' if index else '') + entry).encode('utf-8')
+    yield b'}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Citywalk-aide Spark recommendation job')
+    parser.add_argument('--master', help='Spark master, e.g. local[*]; defaults to the spark-submit setting')
+    parser.add_argument('--input', default='hdfs://namenode:8020/user/data', help='Exported Parquet tables')
+    parser.add_argument('--clickhouse-url', default=os.getenv('CLICKHOUSE_URL', 'http://localhost:8123/'),
+                        help='ClickHouse url to write the route_recommendations table, empty to skip')
+    parser.add_argument('--output', default='', help='Also write the result as json to this path')
+    parser.add_argument('--webhdfs', default='http://namenode:50070',
+                        help='WebHDFS url to write the json result, empty to write to the local filesystem')
+    parser.add_argument('--stopwords', default='chinese_stopwords.txt')
+    parser.add_argument('--top-k', type=int, default=20)
+    args = parser.parse_args()
+
+    builder = SparkSession.builder.appName("Citywalk-aide Recommendation")
+    if args.master:
+        builder = builder.master(args.master)
+    spark = builder.getOrCreate()
+    logger.info("Spark Session initialized successfully.")
+
+    application = RecommendApplication(spark, args.input, load_chinese_stopwords(args.stopwords), args.top_k)
+    recommendations = application.run().cache()
+
+    if args.clickhouse_url:
+        version = datetime.now().replace(microsecond=0)
+        recommendations.foreachPartition(RecommendationWriter(args.clickhouse_url, version))
+        logger.info(f"Recommendations have been calculated and stored with version {version}.")
+
+    if args.output:
+        fs_client = HDFSClient(args.webhdfs, 'root') if args.webhdfs else LocalFSClient('/')
+        fs_client.write_stream(args.output, iter_recommend_json(recommendations.toLocalIterator()))
+        logger.info(f"Recommendations have been stored at {args.output}.")
+
+    spark.stop()
+    logger.info("Spark Session stopped. Application terminated.")
@@ -1,96 +1,194 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from pyspark.sql import SparkSession
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType
 from datetime import datetime, timedelta, date
 import re
 
-from llm.llm import chat
-from logger.logger import logger
-from model.note import NoteInfo
-from model.route import LLMRoutes, LLMRoute
+from llm.llm import chat, new_client
+from logger.logger import logger, log_sampled
+from metrics.metrics import StageTimer
+from model.route import LLMRoutes
 from persistent.clickhouse_client import ClickhouseClient
 from persistent.hdfs_client import HDFSClient
 
 
+NOTE_SCHEMA = StructType([
+    StructField('id', StringType()),
+    StructField('city', StringType()),
+    StructField('liked_count', IntegerType()),
+    StructField('page_hdfs_path', StringType()),
+])
+
+
 class StructureApplication:
-    def __init__(self, spark, hdfs_client, clickhouse_client):
+    def __init__(self, spark, config):
         self.spark = spark
-        self.hdfs_client = hdfs_client
-        self.clickhouse_client = clickhouse_client
+        self.config = config
+
+    def load_notes(self):
+        # every task reads its own id shard of the unprocessed notes, nothing is collected on the driver
+        num_partitions = self.config['num_partitions']
+        shards = self.spark.sparkContext.parallelize(range(num_partitions), num_partitions)
+        notes = shards.mapPartitions(PendingNoteReader(self.config))
+        return self.spark.createDataFrame(notes, NOTE_SCHEMA)
 
     def run(self):
         logger.info("Starting the Spark job to process unstructured articles.")
 
-        query = """
-        SELECT n.*
-        FROM citywalk_aide.note_infos AS n
-        LEFT JOIN citywalk_aide.routes AS r
-        ON n.id = r.note_id
-        WHERE n.id <> r.note_id
-        """
+        stages = StageTimer('Structure job')
+        notes = self.load_notes()
+        stats = notes.rdd.mapPartitions(PartitionProcessor(self.config)).collect()
 
-        logger.info("Querying ClickHouse for unprocessed notes...")
-        note_infos = self.clickhouse_client.select(query, model_class=NoteInfo)
-        logger.info("Fetched {} notes for processing.".format(len(note_infos)))
+        total = {key: sum(stat[key] for stat in stats) for key in ('notes', 'routes', 'locations', 'errors')}
+        logger.info("Completed processing all notes: {}".format(total))
 
-        # Parallelize notes processing using Spark RDD
-        note_rdd = self.spark.sparkContext.parallelize(note_infos)
-        results = note_rdd.map(self.process_note).collect()
+        # stage times are summed over the partitions, so they add up to executor time rather than wall time
+        for stat in stats:
+            for name, (seconds, calls) in stat['stages'].items():
+                stages.add(name, seconds, calls)
+        stages.log_summary()
 
-        # Handle batch insertion into ClickHouse
-        for route_batch, location_batch in results:
-            if route_batch:
-                self.clickhouse_client.insert(route_batch)
-            if location_batch:
-                self.clickhouse_client.insert(location_batch)
 
-        logger.info("Completed processing all notes.")
+class PendingNoteReader:
+    def __init__(self, config):
+        self.config = config
 
-    def process_note(self, note):
-        try:
-            logger.info("Processing note ID: {}, City: {}".format(note.id, note.city))
-            html = self.hdfs_client.read_file(note.page_hdfs_path)
-
-            soup = BeautifulSoup(html, 'html.parser')
-
-            note_text_span = soup.select_one('#detail-desc > span > span:nth-child(1)')
-            if note_text_span is None:
-                logger.warning("Note ID {} - No text found in the HTML structure.".format(note.id))
-                return [], []
-            note_text = note_text_span.get_text(strip=True)
-
-            note_create_time_span = soup.select_one(
-                '#noteContainer > div.interaction-container > div.note-scroller > div.note-content > div.bottom-container > span.date'
-            )
-            if note_create_time_span is None:
-                logger.warning("Note ID {} - No creation date found in the HTML structure.".format(note.id))
-                return [], []
-            note_create_time = extract_date(note_create_time_span.text.strip())
-
-            logger.info("Note ID {} - Extracted text and creation date successfully.".format(note.id))
-
-            llm_structured_result = chat(
-                content=note_text,
-                system=STRUCTURED_PROMPT,
-                json_schema=LLMRoutes
-            )
-            llm_routes = LLMRoutes.model_validate_json(llm_structured_result)
-            logger.info("Note ID {} - Successfully structured data using LLM.".format(note.id))
-
-            route_batch = []
-            location_batch = []
-            for llm_route in llm_routes.routes:
-                route, locations = llm_route.to_route_model()
-                route.city = note.city
-                route.published_at = note_create_time
-                route_batch.append(route)
-                location_batch.extend(locations)
-
-            return route_batch, location_batch
-
-        except Exception as e:
-            logger.error("Error processing note ID {}: {}".format(note.id, str(e)), exc_info=True)
+    def __call__(self, shard_ids):
+        clickhouse_client = ClickhouseClient(self.config['clickhouse_db'], self.config['clickhouse_url'])
+        num_partitions = self.config['num_partitions']
+
+        for shard_id in shard_ids:
+            query = """
+            SELECT id, city, liked_count, page_hdfs_path
+            FROM citywalk_aide.note_infos
+            WHERE cityHash64(id) % {} = {}
+              AND id NOT IN (SELECT note_id FROM citywalk_aide.routes)
+            ORDER BY created_at DESC
+            LIMIT 1 BY id
+            """.format(num_partitions, shard_id)
+
+            for note in clickhouse_client.select(query):
+                yield note.id, note.city, note.liked_count, note.page_hdfs_path
+
+
+class PartitionProcessor:
+    def __init__(self, config):
+        self.config = config
+
+    def __call__(self, notes):
+        # clients are created once per partition on the executor, never pickled from the driver
+        clickhouse_client = ClickhouseClient(self.config['clickhouse_db'], self.config['clickhouse_url'])
+        hdfs_client = HDFSClient(self.config['hdfs_url'], self.config['hdfs_user'])
+        llm_client = new_client()
+
+        batch_size = self.config['batch_size']
+        stats = {'notes': 0, 'routes': 0, 'locations': 0, 'errors': 0}
+        stages = StageTimer('Structure partition')
+        route_batch, location_batch = [], []
+
+        with ThreadPoolExecutor(max_workers=self.config['llm_concurrency']) as executor:
+            for chunk in chunked(notes, self.config['read_batch_size']):
+                with stages.stage('read'):
+                    htmls = hdfs_client.read_many([note.page_hdfs_path for note in chunk], return_exceptions=True)
+                with stages.stage('structure'):
+                    results = list(executor.map(
+                        lambda note: process_note(note, htmls[note.page_hdfs_path], llm_client), chunk
+                    ))
+
+                for routes, locations in results:
+                    stats['notes'] += 1
+                    if routes is None:
+                        stats['errors'] += 1
+                        continue
+                    route_batch.extend(routes)
+                    location_batch.extend(locations)
+
+                if len(route_batch) + len(location_batch) >= batch_size:
+                    with stages.stage('insert'):
+                        flush(clickhouse_client, route_batch, location_batch, stats)
+                    route_batch, location_batch = [], []
+
+        with stages.stage('insert'):
+            flush(clickhouse_client, route_batch, location_batch, stats)
+        stats['stages'] = stages.stages
+        yield stats
+
+
+def chunked(iterator, size):
+    chunk = []
+    for item in iterator:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def flush(clickhouse_client, route_batch, location_batch, stats):
+    if not route_batch and not location_batch:
+        return
+
+    # locations go first so a visible route always has its locations
+    clickhouse_client.insert(location_batch)
+    clickhouse_client.insert(route_batch)
+    stats['routes'] += len(route_batch)
+    stats['locations'] += len(location_batch)
+    logger.info("Inserted {} routes and {} locations.".format(len(route_batch), len(location_batch)))
+
+
+def process_note(note, html, llm_client):
+    try:
+        log_sampled(logging.INFO, "Processing note ID: %s, City: %s", note.id, note.city)
+        if isinstance(html, Exception):
+            raise html
+
+        soup = BeautifulSoup(html, 'html.parser')
+
+        note_text_span = soup.select_one('#detail-desc > span > span:nth-child(1)')
+        if note_text_span is None:
+            logger.warning("Note ID {} - No text found in the HTML structure.".format(note.id))
+            return [], []
+        note_text = note_text_span.get_text(strip=True)
+
+        note_create_time_span = soup.select_one(
+            '#noteContainer > div.interaction-container > div.note-scroller > div.note-content > div.bottom-container > span.date'
+        )
+        if note_create_time_span is None:
+            logger.warning("Note ID {} - No creation date found in the HTML structure.".format(note.id))
             return [], []
+        note_create_time = extract_date(note_create_time_span.text.strip())
+
+        llm_structured_result = chat(
+            content=note_text,
+            system=STRUCTURED_PROMPT,
+            json_schema=LLMRoutes,
+            client=llm_client,
+        )
+        llm_routes = LLMRoutes.model_validate_json(llm_structured_result)
+        log_sampled(logging.INFO, "Note ID %s - Successfully structured data using LLM.", note.id)
+
+        route_batch = []
+        location_batch = []
+        created_at = datetime.now().replace(microsecond=0)
+        for index, llm_route in enumerate(llm_routes.routes):
+            route, locations = llm_route.to_route_model(note.id, index, created_at)
+            route.city = note.city
+            route.liked_count = note.liked_count
+            route.published_at = note_create_time
+            route_batch.append(route)
+            location_batch.extend(locations)
+
+        return route_batch, location_batch
+
+    except Exception as e:
+        logger.error("Error processing note ID {}: {}".format(note.id, str(e)), exc_info=True)
+        return None, None
 
 
 def extract_date(data_string):
@@ -152,10 +250,18 @@ if __name__ == '__main__':
         .getOrCreate()
     logger.info("Spark Session initialized successfully.")
 
-    hdfs_client = HDFSClient('http://localhost:50070', 'root')
-    clickhouse_client = ClickhouseClient('citywalk_aide')
+    config = {
+        'clickhouse_db': 'citywalk_aide',
+        'clickhouse_url': os.getenv('CLICKHOUSE_URL', 'http://localhost:8123/'),
+        'hdfs_url': os.getenv('HDFS_URL', 'http://localhost:50070'),
+        'hdfs_user': 'root',
+        'num_partitions': int(os.getenv('STRUCTURE_PARTITIONS', 16)),
+        'llm_concurrency': int(os.getenv('STRUCTURE_LLM_CONCURRENCY', 4)),
+        'read_batch_size': 20,
+        'batch_size': 1000,
+    }
 
-    main_program = StructureApplication(spark, hdfs_client, clickhouse_client)
+    main_program = StructureApplication(spark, config)
     main_program.run()
 
     spark.stop()
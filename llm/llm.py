@@ -1,8 +1,10 @@
 import os
+from dataclasses import dataclass
 
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from metrics.metrics import LLM_REQUEST_SECONDS, LLM_TOKENS, LLM_ERRORS
 from model.route import LLMRoutes, LLMRoute
 
 load_dotenv()
@@ -12,29 +14,56 @@ BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
 MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
 
 
-def chat(content: str, system: str = '', json_schema=None) -> str:
-    client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-
-    if json_schema:
-        response = client.beta.chat.completions.parse(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": content}
-            ],
-            response_format=json_schema,
-        )
-    else:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": content}
-            ]
-        )
+@dataclass
+class Usage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def new_client() -> OpenAI:
+    return OpenAI(api_key=API_KEY, base_url=BASE_URL)
+
+
+def chat(content: str, system: str = '', json_schema=None, client: OpenAI = None) -> str:
+    return chat_completion(content, system, json_schema, client)[0]
+
+
+def chat_completion(content: str, system: str = '', json_schema=None, client: OpenAI = None) -> tuple[str, Usage]:
+    # the answer and its token usage, zero when the endpoint does not report it
+    client = client or new_client()
+    kind = 'structured' if json_schema else 'chat'
+
+    try:
+        with LLM_REQUEST_SECONDS.time(model=MODEL, kind=kind):
+            if json_schema:
+                response = client.beta.chat.completions.parse(
+                    model=MODEL,
+                    messages=[
+                        {"role": "system", "content": system},
+                        {"role": "user", "content": content}
+                    ],
+                    response_format=json_schema,
+                )
+            else:
+                response = client.chat.completions.create(
+                    model=MODEL,
+                    messages=[
+                        {"role": "system", "content": system},
+                        {"role": "user", "content": content}
+                    ]
+                )
+    except Exception:
+        LLM_ERRORS.inc(model=MODEL, kind=kind)
+        raise
+
+    usage = Usage()
+    if response.usage:
+        usage = Usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+        LLM_TOKENS.inc(usage.prompt_tokens, model=MODEL, type='prompt')
+        LLM_TOKENS.inc(usage.completion_tokens, model=MODEL, type='completion')
 
     result = response.choices[0].message.content
-    return result
+    return result, usage
 
 
 if __name__ == '__main__':
@@ -93,6 +122,6 @@ Notes:
     print(routes_raw)
 
     routes = LLMRoutes.model_validate_json(routes_raw)
-    for route in routes.routes:
-        r, ls = route.to_route_model()
+    for index, route in enumerate(routes.routes):
+        r, ls = route.to_route_model('example', index)
         print(r.to_dict(), [l.to_dict() for l in ls])
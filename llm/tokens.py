@@ -0,0 +1,32 @@
+import re
+from functools import lru_cache
+
+from llm import llm
+
+CJK = re.compile(r'[一-鿿]')
+
+
+@lru_cache(maxsize=None)
+def encoding(model: str):
+    # tiktoken is optional, without it counts are estimated
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+
+
+def estimate_tokens(text: str) -> int:
+    # CJK characters are roughly one token each, other text roughly four characters per token
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    tokenizer = encoding(model or llm.MODEL)
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
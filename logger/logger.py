@@ -1,7 +1,9 @@
 import logging
+import os
+import random
 
 logger = logging.getLogger('logger')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
 
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.DEBUG)
@@ -16,5 +18,15 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 # logger.addHandler(file_handler)
 
+# share of hot-path log lines (per request, per note) that are actually written
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))
+
+
+def log_sampled(level: int, msg: str, *args, rate: float = None):
+    # the level check and the dice roll come first, so a dropped line costs no formatting
+    if logger.isEnabledFor(level) and random.random() < (LOG_SAMPLE_RATE if rate is None else rate):
+        logger.log(level, msg, *args)
+
+
 if __name__ == '__main__':
     logger.info('hello world')
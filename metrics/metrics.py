@@ -0,0 +1,248 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logger.logger import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(tuple(labels.get(name, '') for name in self.label_names), 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}' for key, value in items]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def set(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels) -> float:
+        return self.values.get(tuple(labels.get(name, '') for name in self.label_names), 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}' for key, value in items]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels) -> tuple[float, int]:
+        state = self.values.get(tuple(labels.get(name, '') for name in self.label_names))
+        return (state[1], state[2]) if state else (0.0, 0)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self.values.items())
+
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            # modules re-imported under another name must not register a second copy
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str, label_names: tuple = ()) -> Counter:
+        return self.register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, label_names: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, description, label_names))
+
+    def histogram(self, name: str, description: str, label_names: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, label_names, buckets))
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    # /metrics of a long-running job without a web app of its own
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+CLICKHOUSE_QUERY_SECONDS = registry.histogram(
+    'clickhouse_query_seconds', 'ClickHouse request latency until the response starts', ('statement',))
+CLICKHOUSE_ERRORS = registry.counter('clickhouse_errors_total', 'Failed ClickHouse requests', ('statement',))
+
+HDFS_OPERATION_SECONDS = registry.histogram('hdfs_operation_seconds', 'HDFS operation latency, retries included',
+                                            ('action',))
+HDFS_RETRIES = registry.counter('hdfs_retries_total', 'Retried HDFS operations', ('action',))
+HDFS_ERRORS = registry.counter('hdfs_errors_total', 'Failed HDFS operations', ('action',))
+
+LLM_REQUEST_SECONDS = registry.histogram('llm_request_seconds', 'LLM chat completion latency', ('model', 'kind'))
+LLM_TOKENS = registry.counter('llm_tokens_total', 'LLM tokens used', ('model', 'type'))
+LLM_ERRORS = registry.counter('llm_errors_total', 'Failed LLM requests', ('model', 'kind'))
+PREFILTER_NOTES = registry.counter('prefilter_notes_total', 'Notes scored by the structuring prefilter', ('result',))
+NEAR_DUPLICATE_NOTES = registry.counter('near_duplicate_notes_total', 'Notes checked for near-duplicates by result',
+                                        ('result',))
+PREFILTER_TOKENS_SAVED = registry.counter('prefilter_tokens_saved_total',
+                                          'Prompt tokens of the LLM calls skipped by the prefilter')
+STRUCTURE_TOKENS = registry.counter('structure_tokens_total', 'LLM tokens used to structure notes by city',
+                                    ('city', 'type'))
+
+GEOCODE_LOOKUPS = registry.counter('geocode_lookups_total', 'Location name lookups by result', ('result',))
+
+PAGE_LOAD_SECONDS = registry.histogram('page_load_seconds', 'WebDriver page load latency', ('page',))
+
+HTTP_REQUEST_SECONDS = registry.histogram('http_request_seconds', 'API request latency',
+                                          ('endpoint', 'method', 'status'))
+
+# from a note being crawled until its routes are structured / recommended
+FRESHNESS_BUCKETS = (60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600, 48 * 3600)
+PIPELINE_FRESHNESS_SECONDS = registry.histogram('pipeline_freshness_seconds', 'Time since a note was crawled',
+                                                ('stage',), FRESHNESS_BUCKETS)
+PIPELINE_QUEUE_DEPTH = registry.gauge('pipeline_queue_depth', 'Pending pipeline events', ('topic',))
+PIPELINE_QUEUE_LAG_SECONDS = registry.gauge('pipeline_queue_lag_seconds', 'Age of the oldest pending event',
+                                            ('topic',))
+PIPELINE_EVENTS = registry.counter('pipeline_events_total', 'Processed pipeline events', ('topic', 'result'))
+
+
+class StageTimer:
+    """Accumulates per-stage wall time of a batch job, logged as one summary line at the end."""
+
+    def __init__(self, job: str):
+        self.job = job
+        self.lock = threading.Lock()
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float, count: int = 1):
+        with self.lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + count)
+
+    def summary(self) -> str:
+        with self.lock:
+            stages = list(self.stages.items())
+        parts = [
+            f'{name} {total:.2f}s/{calls} ({total / calls * 1000:.1f}ms avg)' for name, (total, calls) in stages if calls
+        ]
+        return f'{self.job} finished in {time.perf_counter() - self.started_at:.2f}s: ' + ', '.join(parts)
+
+    def log_summary(self):
+        logger.info(self.summary())
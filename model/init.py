@@ -1,9 +1,45 @@
-from model.note import NoteInfo
-from model.route import Route, Location
+import importlib
+import pkgutil
+from datetime import date
+
+from clickhouse_orm.migrations import MigrationHistory
+
+from model.note import NoteInfo, NoteStat, NoteStructuring, NoteFingerprint
+from model.route import Route, Location, RouteRecommendation, Poi, RouteListing, RouteListingCount
 from persistent.clickhouse_client import ClickhouseClient
 
+MIGRATIONS_PACKAGE = 'model.migrations'
+
+
+def migration_names(package_name: str = MIGRATIONS_PACKAGE) -> list[str]:
+    package = importlib.import_module(package_name)
+    return sorted(name for _, name, _ in pkgutil.iter_modules(package.__path__))
+
+
+def init_schema(client: ClickhouseClient):
+    # new tables are created from the models, existing ones are brought up to date by the pending migrations. On a
+    # fresh install the models already are the migrated schema, every migration is only recorded as applied: e.g.
+    # the projection of 0002 cannot be added to the ReplacingMergeTree routes of the current model
+    fresh = not client.does_table_exist(Route)
+    for model in (NoteInfo, Route, Location, NoteStat, RouteRecommendation, Poi, RouteListing, RouteListingCount,
+                  NoteStructuring, NoteFingerprint):
+        client.create_table(model)
+
+    if fresh:
+        client.create_table(MigrationHistory)
+        client.insert([
+            MigrationHistory(package_name=MIGRATIONS_PACKAGE, module_name=name, applied=date.today())
+            for name in migration_names()
+        ])
+        return
+
+    # each mutation finishes before the next step, e.g. the geohash index is materialized from the backfilled column
+    client.add_setting('mutations_sync', 1)
+    try:
+        client.migrate(MIGRATIONS_PACKAGE)
+    finally:
+        client.add_setting('mutations_sync', None)
+
+
 if __name__ == '__main__':
-    client = ClickhouseClient('citywalk_aide')
-    client.create_table(NoteInfo)
-    client.create_table(Route)
-    client.create_table(Location)
+    init_schema(ClickhouseClient('citywalk_aide'))
@@ -0,0 +1,22 @@
+from clickhouse_orm.migrations import RunSQL
+
+# geohash and poi_id columns, locations structured before them get the geohash of their coordinates,
+# same cells as utils.geo.location_geohash. poi_id is assigned by the next analyze/poi.py run.
+# The statements are spelled out instead of AlterTable/AlterIndexes, which would apply the current model, i.e. the
+# changes of later migrations too
+operations = [
+    RunSQL([
+        'ALTER TABLE citywalk_aide.locations ADD COLUMN IF NOT EXISTS geohash String AFTER longitude',
+        'ALTER TABLE citywalk_aide.locations ADD COLUMN IF NOT EXISTS poi_id String AFTER geohash',
+        """
+        ALTER TABLE citywalk_aide.locations
+        ADD INDEX IF NOT EXISTS geohash_index geohash TYPE bloom_filter(0.025) GRANULARITY 4
+        """,
+        """
+        ALTER TABLE citywalk_aide.locations
+        UPDATE geohash = geohashEncode(longitude, latitude, 7)
+        WHERE geohash = '' AND (latitude != 0 OR longitude != 0)
+        """,
+        'ALTER TABLE citywalk_aide.locations MATERIALIZE INDEX geohash_index',
+    ]),
+]
@@ -0,0 +1,20 @@
+from clickhouse_orm.migrations import RunSQL
+
+# city as LowCardinality(String), a bloom filter on routes.id and a projection for the per-city listing ordered by
+# likes. The sorting keys stay: changing them rewrites the tables, the projection and the index cover the reads.
+# Every step is a mutation of the existing parts, the tables stay online
+operations = [
+    RunSQL([
+        f'ALTER TABLE citywalk_aide.{table} MODIFY COLUMN city LowCardinality(String)'
+        for table in ('note_infos', 'note_stats', 'routes', 'pois')
+    ]),
+    RunSQL([
+        'ALTER TABLE citywalk_aide.routes ADD INDEX IF NOT EXISTS id_index id TYPE bloom_filter(0.01) GRANULARITY 1',
+        'ALTER TABLE citywalk_aide.routes MATERIALIZE INDEX id_index',
+        """
+        ALTER TABLE citywalk_aide.routes
+        ADD PROJECTION IF NOT EXISTS routes_by_city_likes (SELECT * ORDER BY city, liked_count)
+        """,
+        'ALTER TABLE citywalk_aide.routes MATERIALIZE PROJECTION routes_by_city_likes',
+    ]),
+]
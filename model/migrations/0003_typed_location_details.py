@@ -0,0 +1,32 @@
+from clickhouse_orm.migrations import ModelOperation
+
+from model.route import Location
+
+
+class JSONToTypedColumn(ModelOperation):
+    # a String column of JSON becomes the model's typed column in place: the JSON column is renamed, the typed one
+    # is materialized from it with JSONExtract, then the JSON column is dropped
+    def __init__(self, model_class, column: str):
+        super().__init__(model_class)
+        self.column = column
+
+    def apply(self, database):
+        types = {row.name: row.type for row in database.select('DESC %s' % self._qualified_table_name(database))}
+        if types.get(self.column) != 'String':
+            return
+
+        typed = self.model_class.fields()[self.column].get_sql(with_default_expression=False)
+        json_column = f'{self.column}_json'
+        self._alter_table(database, f'RENAME COLUMN {self.column} TO {json_column}')
+        self._alter_table(database, f"ADD COLUMN {self.column} {typed} DEFAULT JSONExtract({json_column}, '{typed}') "
+                                    f'AFTER {json_column}')
+        self._alter_table(database, f'MATERIALIZE COLUMN {self.column}')
+        self._alter_table(database, f'MODIFY COLUMN {self.column} REMOVE DEFAULT')
+        self._alter_table(database, f'DROP COLUMN {json_column}')
+
+
+# activities and transportation as Array(Tuple(...)) instead of JSON strings
+operations = [
+    JSONToTypedColumn(Location, 'activities'),
+    JSONToTypedColumn(Location, 'transportation'),
+]
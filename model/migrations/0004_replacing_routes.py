@@ -0,0 +1,52 @@
+from clickhouse_orm.compiler import qualified_name
+from clickhouse_orm.migrations import ModelOperation, RunSQL
+
+from model.route import Location, Route
+
+
+class RebuildTable(ModelOperation):
+    # the engine and the sorting key of a table cannot be altered: the rows matching `where` are copied into a table
+    # created from the model and the two are swapped
+    def __init__(self, model_class, where: str):
+        super().__init__(model_class)
+        self.where = where
+
+    def apply(self, database):
+        engine = next(iter(database.select(
+            'SELECT engine FROM system.tables WHERE database = {db:String} AND name = {table:String}',
+            params={'db': database.db_name, 'table': self.table_name},
+        ))).engine
+        if engine == self.model_class.engine.__class__.__name__:
+            return
+
+        table = self._qualified_table_name(database)
+        rebuilt = qualified_name(database.db_name, f'{self.table_name}_rebuilt')
+        legacy = qualified_name(database.db_name, f'{self.table_name}_legacy')
+        columns = ', '.join(f'`{name}`' for name in self.model_class.fields())
+
+        database.raw(f'DROP TABLE IF EXISTS {rebuilt}')
+        database.raw(self.model_class.create_table_sql(database.db_name, database.capabilities)
+                     .replace(table, rebuilt, 1))
+        database.raw(f'INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table} WHERE {self.where}')
+        database.raw(f'RENAME TABLE {table} TO {legacy}, {rebuilt} TO {table}')
+        database.raw(f'DROP TABLE {legacy}')
+
+
+# routes and locations as ReplacingMergeTree keyed on their deterministic ids. Routes written before carry random
+# ids, of those only the last structuring run of a note is kept, and one route per title where runs overlapped.
+# The per-city listing projection of 0002 goes first: the listing is served from route_listings, and a projection
+# is not supported by ReplacingMergeTree without extra settings
+operations = [
+    RunSQL(['ALTER TABLE citywalk_aide.routes DROP PROJECTION IF EXISTS routes_by_city_likes']),
+    RebuildTable(Route, """
+    id IN (
+        SELECT argMax(r.id, r.created_at)
+        FROM citywalk_aide.routes AS r
+        JOIN (SELECT note_id, max(created_at) AS last_run FROM citywalk_aide.routes GROUP BY note_id) AS l
+        ON l.note_id = r.note_id
+        WHERE r.created_at >= l.last_run - INTERVAL 10 MINUTE
+        GROUP BY r.note_id, r.title
+    )
+    """),
+    RebuildTable(Location, 'route_id IN (SELECT toString(id) FROM citywalk_aide.routes)'),
+]
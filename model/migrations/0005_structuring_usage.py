@@ -0,0 +1,18 @@
+from clickhouse_orm.migrations import RunSQL
+
+# city and LLM usage of every structured note: text tokens before and after compaction, requests and tokens in and
+# out, packed requests split by note text. Cost and latency per city are sums over these
+operations = [
+    RunSQL([
+        'ALTER TABLE citywalk_aide.note_structurings '
+        'ADD COLUMN IF NOT EXISTS city LowCardinality(String) AFTER note_id',
+        'ALTER TABLE citywalk_aide.note_structurings ADD COLUMN IF NOT EXISTS raw_tokens UInt32 AFTER routes',
+        'ALTER TABLE citywalk_aide.note_structurings ADD COLUMN IF NOT EXISTS text_tokens UInt32 AFTER raw_tokens',
+        'ALTER TABLE citywalk_aide.note_structurings ADD COLUMN IF NOT EXISTS requests Float32 AFTER text_tokens',
+        'ALTER TABLE citywalk_aide.note_structurings ADD COLUMN IF NOT EXISTS prompt_tokens UInt32 AFTER requests',
+        'ALTER TABLE citywalk_aide.note_structurings '
+        'ADD COLUMN IF NOT EXISTS completion_tokens UInt32 AFTER prompt_tokens',
+        'ALTER TABLE citywalk_aide.note_structurings '
+        'ADD COLUMN IF NOT EXISTS llm_seconds Float32 AFTER completion_tokens',
+    ]),
+]
@@ -0,0 +1,12 @@
+from clickhouse_orm.migrations import CreateTable, DropTable, RunSQL
+
+from model.route import RouteListing
+
+# route_listings keyed on (city, version, rank): as a ReplacingMergeTree on (city, rank), a merge replaced the rows of
+# the version a reader was still paging through. The listing is derived, the counts are emptied with it so /search
+# falls back to the join until the next refresh
+operations = [
+    DropTable(RouteListing),
+    CreateTable(RouteListing),
+    RunSQL(['TRUNCATE TABLE IF EXISTS citywalk_aide.route_listing_counts']),
+]
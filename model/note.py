@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 
 from clickhouse_orm import models, fields
-from clickhouse_orm.engines import MergeTree
+from clickhouse_orm.engines import MergeTree, ReplacingMergeTree
 
 
 class NoteInfo(models.Model):
@@ -15,7 +15,7 @@ class NoteInfo(models.Model):
     image_list = fields.StringField()
     user = fields.StringField()
     page_hdfs_path = fields.StringField()
-    city = fields.StringField()
+    city = fields.LowCardinalityField(fields.StringField())
     created_at = fields.DateTimeField()
 
     engine = MergeTree('created_at', ('id', 'created_at'))
@@ -25,6 +25,67 @@ class NoteInfo(models.Model):
         return 'note_infos'
 
 
+class NoteStat(models.Model):
+    note_id = fields.StringField()
+    city = fields.LowCardinalityField(fields.StringField())
+    liked_count = fields.Int32Field()
+    liked_velocity = fields.Float64Field()
+    sampled_at = fields.DateTimeField()
+    next_refresh_at = fields.DateTimeField()
+
+    # every re-sample is a new version of the note's row, the latest sampled_at wins on merge
+    engine = ReplacingMergeTree(order_by=('note_id',), ver_col='sampled_at', partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'note_stats'
+
+
+class NoteStructuring(models.Model):
+    # the outcome of structuring a note: skipped by the prefilter, or the number of routes the LLM found. The
+    # prefilter features are kept so that it can be calibrated without reading the pages again. A packed request
+    # counts for its notes in proportion to their text
+    note_id = fields.StringField()
+    city = fields.LowCardinalityField(fields.StringField())
+    score = fields.Float32Field()
+    features = fields.ArrayField(fields.Float32Field())
+    skipped = fields.UInt8Field()
+    routes = fields.UInt16Field()
+    raw_tokens = fields.UInt32Field()
+    text_tokens = fields.UInt32Field()
+    requests = fields.Float32Field()
+    prompt_tokens = fields.UInt32Field()
+    completion_tokens = fields.UInt32Field()
+    llm_seconds = fields.Float32Field()
+    created_at = fields.DateTimeField()
+
+    engine = ReplacingMergeTree(order_by=('note_id',), ver_col='created_at', partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'note_structurings'
+
+
+class NoteFingerprint(models.Model):
+    # MinHash of the note text shingles, see analyze/duplicates.py. A near-duplicate of a structured note is not
+    # structured, duplicate_of is the note whose routes stand for it
+    note_id = fields.StringField()
+    signature = fields.ArrayField(fields.UInt32Field())
+    bands = fields.ArrayField(fields.UInt64Field())
+    length = fields.UInt32Field()
+    duplicate_of = fields.StringField()
+    created_at = fields.DateTimeField()
+
+    # candidates are the notes sharing a band, `hasAny(bands, [...])`
+    bands_index = models.Index(bands, type=models.Index.bloom_filter(), granularity=1)
+
+    engine = ReplacingMergeTree(order_by=('note_id',), ver_col='created_at', partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'note_fingerprints'
+
+
 @dataclass
 class UserInfo:
     nick_name: str
@@ -0,0 +1,41 @@
+from logger.logger import logger
+from persistent.clickhouse_client import ClickhouseClient
+
+# every row of a structuring run shares its created_at, routes of an earlier run of the note that the latest run did
+# not write again, e.g. it returned fewer routes, are dropped with their locations
+STALE_ROUTES = """
+ALTER TABLE citywalk_aide.routes
+DELETE WHERE (note_id, created_at) NOT IN (SELECT note_id, max(created_at) FROM citywalk_aide.routes GROUP BY note_id)
+"""
+
+ORPHAN_LOCATIONS = """
+ALTER TABLE citywalk_aide.locations
+DELETE WHERE route_id NOT IN (SELECT toString(id) FROM citywalk_aide.routes)
+"""
+
+ROW_COUNTS = """
+SELECT (SELECT count() FROM citywalk_aide.routes) AS routes,
+       (SELECT count() FROM citywalk_aide.locations) AS locations
+"""
+
+
+def repair(client: ClickhouseClient):
+    before = next(iter(client.select(ROW_COUNTS)))
+
+    client.add_setting('mutations_sync', 1)
+    try:
+        client.raw(STALE_ROUTES)
+        client.raw(ORPHAN_LOCATIONS)
+        # rows written again under the same ids are only collapsed by a merge
+        client.raw('OPTIMIZE TABLE citywalk_aide.routes FINAL')
+        client.raw('OPTIMIZE TABLE citywalk_aide.locations FINAL')
+    finally:
+        client.add_setting('mutations_sync', None)
+
+    after = next(iter(client.select(ROW_COUNTS)))
+    logger.info(f'Removed {before.routes - after.routes} duplicate routes and '
+                f'{before.locations - after.locations} locations')
+
+
+if __name__ == '__main__':
+    repair(ClickhouseClient('citywalk_aide'))
@@ -1,19 +1,22 @@
-import json
 from datetime import datetime
-from uuid import uuid4
+from uuid import NAMESPACE_URL, uuid5
 
 from clickhouse_orm import models, fields
-from clickhouse_orm.engines import MergeTree
+from clickhouse_orm.engines import MergeTree, ReplacingMergeTree
 from typing import Optional, List
 
 from pydantic import BaseModel, Field
 from enum import Enum
 
+from utils.geo import location_geohash
+
+ROUTE_NAMESPACE = uuid5(NAMESPACE_URL, 'citywalk-aide/route')
+
 
 class Route(models.Model):
     id = fields.UUIDField()
     note_id = fields.StringField()
-    city = fields.StringField()
+    city = fields.LowCardinalityField(fields.StringField())
     title = fields.StringField()
     summary = fields.StringField()
     tags = fields.ArrayField(fields.StringField())
@@ -25,13 +28,32 @@ class Route(models.Model):
     published_at = fields.DateField()
     created_at = fields.DateTimeField()
 
-    engine = MergeTree('created_at', ('note_id', 'created_at'))
+    # routes are looked up by id, searches range over the city prefix of the sorting key
+    id_index = models.Index(id, type=models.Index.bloom_filter(0.01), granularity=1)
+
+    # the ids are derived from the note, structuring a note again replaces its routes on merge
+    engine = ReplacingMergeTree(order_by=('city', 'note_id', 'id'), ver_col='created_at', partition_key=('tuple()',))
 
     @classmethod
     def table_name(cls):
         return 'routes'
 
 
+# typed activities and transportation of a location, e.g. `has(transportation.mode, '地铁')` reads a single subcolumn
+ACTIVITY = fields.TupleField([
+    ('name', fields.StringField()),
+    ('description', fields.NullableField(fields.StringField())),
+    ('duration', fields.NullableField(fields.Int32Field())),
+    ('optional', fields.UInt8Field()),
+])
+TRANSPORTATION = fields.TupleField([
+    ('mode', fields.StringField()),
+    ('distance', fields.NullableField(fields.Float64Field())),
+    ('duration', fields.NullableField(fields.Int32Field())),
+    ('notes', fields.NullableField(fields.StringField())),
+])
+
+
 class Location(models.Model):
     id = fields.UUIDField()
     route_id = fields.StringField()
@@ -40,22 +62,103 @@ class Location(models.Model):
     description = fields.StringField()
     latitude = fields.Float64Field()
     longitude = fields.Float64Field()
+    geohash = fields.StringField()
+    poi_id = fields.StringField()
     address = fields.StringField()
     tags = fields.ArrayField(fields.StringField())
     entry_fee = fields.Float64Field()
     time_range = fields.StringField()
     duration = fields.Int32Field()
-    activities = fields.StringField()
-    transportation = fields.StringField()
+    activities = fields.ArrayField(ACTIVITY)
+    transportation = fields.ArrayField(TRANSPORTATION)
     created_at = fields.DateTimeField()
 
-    engine = MergeTree('created_at', ('route_id', 'order', 'created_at'))
+    # for ad-hoc `geohash IN (...)` cell queries, e.g. on the exported locations. /nearby does not read it, it scans
+    # the 0.02° grid of server/geo.py in memory. An empty geohash means no coordinates
+    geohash_index = models.Index(geohash, type=models.Index.bloom_filter(), granularity=4)
+
+    engine = ReplacingMergeTree(order_by=('route_id', 'order'), ver_col='created_at', partition_key=('tuple()',))
 
     @classmethod
     def table_name(cls):
         return 'locations'
 
 
+class RouteRecommendation(models.Model):
+    route_id = fields.StringField()
+    rank = fields.UInt16Field()
+    neighbour_id = fields.StringField()
+    score = fields.Float64Field()
+    version = fields.DateTimeField()
+
+    # every job run writes a new version, readers only take the latest version of a route
+    engine = ReplacingMergeTree(order_by=('route_id', 'rank'), ver_col='version', partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'route_recommendations'
+
+
+class RouteListing(models.Model):
+    # the keywordless /search listing of a city, ranked by likes with the cover already joined, see analyze/listing.py
+    city = fields.LowCardinalityField(fields.StringField())
+    rank = fields.UInt32Field()
+    id = fields.UUIDField()
+    note_id = fields.StringField()
+    title = fields.StringField()
+    summary = fields.StringField()
+    tags = fields.ArrayField(fields.StringField())
+    start_time = fields.StringField()
+    end_time = fields.StringField()
+    total_duration = fields.Int32Field()
+    liked_count = fields.Int32Field()
+    notes = fields.StringField()
+    published_at = fields.DateField()
+    created_at = fields.DateTimeField()
+    cover = fields.StringField()
+    version = fields.DateTimeField()
+
+    # a page is a range of the (city, version, rank) key, readers only take the version of route_listing_counts.
+    # Versions are kept side by side until analyze/listing.py deletes them, a merge never replaces one with another
+    engine = MergeTree(order_by=('city', 'version', 'rank'), partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'route_listings'
+
+
+class RouteListingCount(models.Model):
+    city = fields.LowCardinalityField(fields.StringField())
+    total = fields.UInt32Field()
+    version = fields.DateTimeField()
+
+    engine = ReplacingMergeTree(order_by=('city',), ver_col='version', partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'route_listing_counts'
+
+
+class Poi(models.Model):
+    # a canonical place, the locations of every route that stop there share its id
+    id = fields.StringField()
+    city = fields.LowCardinalityField(fields.StringField())
+    name = fields.StringField()
+    aliases = fields.ArrayField(fields.StringField())
+    latitude = fields.Float64Field()
+    longitude = fields.Float64Field()
+    geohash = fields.StringField()
+    location_count = fields.UInt32Field()
+    version = fields.DateTimeField()
+
+    # every clustering run writes a new version, readers only take the latest one
+    engine = ReplacingMergeTree(order_by=('city', 'id'), ver_col='version', partition_key=('tuple()',))
+
+    @classmethod
+    def table_name(cls):
+        return 'pois'
+
+
 class LLMTransportationMode(str, Enum):
     WALKING = "步行"
     BICYCLE = "骑行"
@@ -107,45 +210,48 @@ class LLMRoute(BaseModel):
     notes: Optional[str] = Field(None, description="Route-related notes")
     locations: List[LLMLocation] = Field(..., description="List of locations")
 
-    def to_route_model(self) -> tuple[Route, list[Location]]:
+    def to_route_model(self, note_id: str, index: int, created_at: datetime = None) -> tuple[Route, list[Location]]:
+        # ids follow from (note_id, index, order) and every row of a run shares created_at, so rerunning a note
+        # writes the same keys again and its latest run is the one with the latest created_at
+        created_at = created_at or datetime.now().replace(microsecond=0)
         route = Route(
-            id=uuid4(),
+            id=uuid5(ROUTE_NAMESPACE, f'{note_id}/{index}'),
+            note_id=note_id,
             title=self.title,
             summary=self.summary or "",
             start_time=self.start_time or "",
             end_time=self.end_time or "",
             total_duration=self.total_duration or 0,
             notes=self.notes or "",
-            published_at=datetime.now(),
-            created_at=datetime.now()
+            published_at=created_at,
+            created_at=created_at
         )
 
         locations = []
         for order, location_data in enumerate(self.locations):
             location = Location(
-                id=uuid4(),
+                id=uuid5(ROUTE_NAMESPACE, f'{note_id}/{index}/{order + 1}'),
                 route_id=str(route.id),
                 order=order + 1,
                 name=location_data.name,
                 description=location_data.description or "",
                 latitude=location_data.latitude or 0,
                 longitude=location_data.longitude or 0,
+                geohash=location_geohash(location_data.latitude or 0, location_data.longitude or 0),
                 address=location_data.address or "",
                 tags=location_data.tags or [],
                 entry_fee=location_data.entry_fee or 0,
                 time_range=location_data.time_range or "",
                 duration=location_data.duration or 0,
-                activities=json.dumps(
-                    [activity.model_dump() for activity in location_data.activities]
-                    if location_data.activities else [],
-                    ensure_ascii=False,
-                ),
-                transportation=json.dumps(
-                    [transportation.model_dump() for transportation in location_data.transportation]
-                    if location_data.transportation else [],
-                    ensure_ascii=False,
-                ),
-                created_at=datetime.now()
+                activities=[
+                    (activity.name, activity.description, activity.duration, int(activity.optional))
+                    for activity in location_data.activities or []
+                ],
+                transportation=[
+                    (transportation.mode.value, transportation.distance, transportation.duration, transportation.notes)
+                    for transportation in location_data.transportation or []
+                ],
+                created_at=created_at
             )
             locations.append(location)
 
@@ -154,3 +260,12 @@ class LLMRoute(BaseModel):
 
 class LLMRoutes(BaseModel):
     routes: List[LLMRoute] = Field(..., description="List of routes")
+
+
+class LLMNoteRoutes(BaseModel):
+    note_id: str = Field(..., description="ID of the article the routes come from")
+    routes: List[LLMRoute] = Field(..., description="List of routes")
+
+
+class LLMPackedRoutes(BaseModel):
+    notes: List[LLMNoteRoutes] = Field(..., description="Routes of every article")
@@ -1,6 +1,45 @@
+import time
+from contextvars import ContextVar
+
 from clickhouse_orm import Database
 
+from metrics.metrics import CLICKHOUSE_QUERY_SECONDS, CLICKHOUSE_ERRORS
+
+# set while a request is being profiled, every query is tagged with a query_id and reported to it
+query_recorder: ContextVar = ContextVar('query_recorder', default=None)
+
+
+def statement_type(query: str) -> str:
+    words = query.lstrip(' \n\t(').split(None, 1)
+    return words[0].upper() if words else ''
+
 
 class ClickhouseClient(Database):
-    def __init__(self, db_name: str):
-        super().__init__(db_name)
+    def __init__(self, db_name: str, db_url: str = None):
+        super().__init__(db_name, db_url=db_url)
+
+    def _send(self, query, data=None, settings=None, stream=False, params=None):
+        return self.call(query, settings, lambda settings: super(ClickhouseClient, self)._send(
+            query, data=data, settings=settings, stream=stream, params=params))
+
+    def _scalar(self, query, settings=None, params=None):
+        return self.call(query, settings, lambda settings: super(ClickhouseClient, self)._scalar(
+            query, settings=settings, params=params))
+
+    def call(self, query, settings, func):
+        statement = statement_type(query)
+        recorder = query_recorder.get()
+        if recorder is not None:
+            settings = dict(settings or {}, query_id=recorder.new_query_id())
+
+        start = time.perf_counter()
+        try:
+            return func(settings)
+        except Exception:
+            CLICKHOUSE_ERRORS.inc(statement=statement)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            CLICKHOUSE_QUERY_SECONDS.observe(elapsed, statement=statement)
+            if recorder is not None:
+                recorder.record(settings['query_id'], statement, elapsed)
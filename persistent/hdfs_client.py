@@ -1,57 +1,267 @@
-from hdfs import InsecureClient
+import logging
+import os
+import shutil
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Union, IO
 
-from logger.logger import logger
+import requests
+from hdfs import InsecureClient, HdfsError
+from requests.adapters import HTTPAdapter
 
+from logger.logger import logger, log_sampled
+from metrics.metrics import HDFS_OPERATION_SECONDS, HDFS_RETRIES, HDFS_ERRORS
 
-class HDFSClient:
-    def __init__(self, host: str, user: str):
-        self.client = InsecureClient(host, user=user)
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# remote exceptions that will not go away by retrying
+NON_RETRYABLE_EXCEPTIONS = {
+    'FileNotFoundException',
+    'FileAlreadyExistsException',
+    'AccessControlException',
+    'PathIsNotEmptyDirectoryException',
+    'IllegalArgumentException',
+}
+
+
+class HDFSError(Exception):
+    def __init__(self, action: str, path: str, cause: Exception):
+        super().__init__(f'Error {action} {path}: {cause}')
+        self.action = action
+        self.path = path
+        self.cause = cause
+
+
+class BaseFSClient(ABC):
+    max_workers = 8
+
+    @abstractmethod
+    def read_bytes(self, path: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def write_file(self, path: str, data: Union[str, bytes], overwrite: bool = True):
+        ...
+
+    def read_file(self, path: str, encoding: str = 'utf-8') -> str:
+        return self.read_bytes(path).decode(encoding)
+
+    def read_many(self, paths: list[str], encoding: str = 'utf-8', return_exceptions: bool = False) -> dict:
+        def read(path):
+            try:
+                return self.read_file(path, encoding) if encoding else self.read_bytes(path)
+            except HDFSError as e:
+                if return_exceptions:
+                    return e
+                raise
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(paths, executor.map(read, paths)))
+
+    def write_many(self, files: dict, overwrite: bool = True):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.write_file, path, data, overwrite) for path, data in files.items()]
+            for future in futures:
+                future.result()
+
+
+class HDFSClient(BaseFSClient):
+    def __init__(self, host: str, user: str, retries: int = 3, backoff: float = 0.5, timeout: int = 60,
+                 pool_size: int = 16, max_workers: int = 8, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+
+        # one pooled session is shared by every request, including the bulk workers
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.client = InsecureClient(host, user=user, session=session, timeout=timeout)
+
+    def call(self, action: str, path: str, func, retryable: bool = True):
+        with HDFS_OPERATION_SECONDS.time(action=action):
+            return self.call_with_retry(action, path, func, retryable)
+
+    def call_with_retry(self, action: str, path: str, func, retryable: bool):
+        attempts = self.retries + 1 if retryable else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                return func()
+            except (HdfsError, requests.RequestException) as e:
+                if getattr(e, 'exception', None) in NON_RETRYABLE_EXCEPTIONS or attempt == attempts:
+                    HDFS_ERRORS.inc(action=action)
+                    raise HDFSError(action, path, e) from e
+
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.warning(f'Error {action} {path} (attempt {attempt}/{attempts}): {e}, retry in {delay}s')
+                HDFS_RETRIES.inc(action=action)
+                time.sleep(delay)
 
     def list_files(self, path: str = '/') -> list:
-        try:
-            return self.client.list(path)
-        except Exception as e:
-            logger.error(f"Error listing files in {path}: {e}")
-            return []
+        return self.call('listing', path, lambda: self.client.list(path))
 
-    def write_file(self, path: str, data: str, overwrite: bool = True):
-        try:
+    def write_file(self, path: str, data: Union[str, bytes], overwrite: bool = True):
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        self.call('writing', path, lambda: self.client.write(path, data=data, overwrite=overwrite))
+        log_sampled(logging.INFO, "Data written to %s", path)
+
+    def write_stream(self, path: str, data: Union[Iterable[bytes], IO], overwrite: bool = True):
+        # a seekable file can be rewound and sent again, a generator can only be sent once
+        seekable = hasattr(data, 'seek') and hasattr(data, 'seekable') and data.seekable()
+        start = data.tell() if seekable else 0
+
+        def write():
+            if seekable:
+                data.seek(start)
             self.client.write(path, data=data, overwrite=overwrite)
-            logger.info(f"Data written to {path}")
-        except Exception as e:
-            logger.error(f"Error writing to {path}: {e}")
 
-    def read_file(self, path: str) -> str:
+        self.call('writing', path, write, retryable=seekable)
+        log_sampled(logging.INFO, "Data streamed to %s", path)
+
+    @contextmanager
+    def open_write(self, path: str, overwrite: bool = True) -> Iterator[IO]:
         try:
+            with self.call('writing', path, lambda: self.client.write(path, overwrite=overwrite)) as writer:
+                yield writer
+        except (HdfsError, requests.RequestException) as e:
+            raise HDFSError('writing', path, e) from e
+        log_sampled(logging.INFO, "Data streamed to %s", path)
+
+    def read_bytes(self, path: str) -> bytes:
+        def read():
             with self.client.read(path) as reader:
-                return reader.read().decode('utf-8')
-        except Exception as e:
-            logger.error(f"Error reading from {path}: {e}")
-            return ""
+                return reader.read()
+
+        return self.call('reading', path, read)
 
-    def delete_file(self, path: str):
+    @contextmanager
+    def read_stream(self, path: str, chunk_size: int = None) -> Iterator[Iterator[bytes]]:
+        context, chunks = self.enter_read(path, chunk_size=chunk_size or self.chunk_size)
         try:
-            self.client.delete(path)
-            logger.info(f"{path} deleted")
-        except Exception as e:
-            logger.error(f"Error deleting {path}: {e}")
+            yield self.wrap_stream(path, chunks)
+        finally:
+            context.__exit__(None, None, None)
 
-    def make_directory(self, path: str, permission: str = None):
+    @contextmanager
+    def open_read(self, path: str) -> Iterator[IO]:
+        context, reader = self.enter_read(path)
         try:
-            self.client.makedirs(path, permission=permission)
-            logger.info(f"Directory {path} created with permission {permission}")
-        except Exception as e:
-            logger.error(f"Error creating directory {path}: {e}")
+            yield reader
+        finally:
+            context.__exit__(None, None, None)
+
+    def delete_file(self, path: str, recursive: bool = False):
+        self.call('deleting', path, lambda: self.client.delete(path, recursive=recursive))
+        logger.info(f"{path} deleted")
+
+    def rename(self, path: str, new_path: str):
+        self.call('renaming', path, lambda: self.client.rename(path, new_path))
+        logger.info(f"{path} renamed to {new_path}")
+
+    def make_directory(self, path: str, permission: str = None):
+        self.call('creating directory', path, lambda: self.client.makedirs(path, permission=permission))
+        logger.info(f"Directory {path} created with permission {permission}")
 
     def exists(self, path: str) -> bool:
+        return self.call('checking existence of', path, lambda: self.client.status(path, strict=False)) is not None
+
+    def enter_read(self, path: str, **kwargs):
+        # only opening the file is retried, a stream broken halfway is raised to the caller
+        def enter():
+            context = self.client.read(path, **kwargs)
+            return context, context.__enter__()
+
+        return self.call('reading', path, enter)
+
+    @staticmethod
+    def wrap_stream(path: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
         try:
-            self.client.status(path)
-            return True
-        except FileNotFoundError:
-            return False
-        except Exception as e:
-            logger.error(f"Error checking existence of {path}: {e}")
-            return False
+            yield from chunks
+        except (HdfsError, requests.RequestException) as e:
+            raise HDFSError('reading', path, e) from e
+
+
+class LocalFSClient(BaseFSClient):
+    def __init__(self, root: str, max_workers: int = 8, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.root = root
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        os.makedirs(root, exist_ok=True)
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def call(self, action: str, path: str, func):
+        try:
+            return func()
+        except OSError as e:
+            raise HDFSError(action, path, e) from e
+
+    def list_files(self, path: str = '/') -> list:
+        return self.call('listing', path, lambda: sorted(os.listdir(self.local_path(path))))
+
+    def write_file(self, path: str, data: Union[str, bytes], overwrite: bool = True):
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        with self.open_write(path, overwrite) as writer:
+            writer.write(data)
+
+    def write_stream(self, path: str, data: Union[Iterable[bytes], IO], overwrite: bool = True):
+        with self.open_write(path, overwrite) as writer:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, writer, self.chunk_size)
+            else:
+                for chunk in data:
+                    writer.write(chunk)
+
+    @contextmanager
+    def open_write(self, path: str, overwrite: bool = True) -> Iterator[IO]:
+        local_path = self.local_path(path)
+
+        def open_file():
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            return open(local_path, 'wb' if overwrite else 'xb')
+
+        with self.call('writing', path, open_file) as writer:
+            yield writer
+
+    def read_bytes(self, path: str) -> bytes:
+        with self.open_read(path) as reader:
+            return reader.read()
+
+    @contextmanager
+    def read_stream(self, path: str, chunk_size: int = None) -> Iterator[Iterator[bytes]]:
+        with self.open_read(path) as reader:
+            yield iter(lambda: reader.read(chunk_size or self.chunk_size), b'')
+
+    @contextmanager
+    def open_read(self, path: str) -> Iterator[IO]:
+        with self.call('reading', path, lambda: open(self.local_path(path), 'rb')) as reader:
+            yield reader
+
+    def delete_file(self, path: str, recursive: bool = False):
+        local_path = self.local_path(path)
+        if os.path.isdir(local_path):
+            self.call('deleting', path, lambda: shutil.rmtree(local_path) if recursive else os.rmdir(local_path))
+        else:
+            self.call('deleting', path, lambda: os.remove(local_path))
+
+    def rename(self, path: str, new_path: str):
+        local_path = self.local_path(new_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        self.call('renaming', path, lambda: os.rename(self.local_path(path), local_path))
+
+    def make_directory(self, path: str, permission: str = None):
+        local_path = self.local_path(path)
+        self.call('creating directory', path, lambda: os.makedirs(local_path, exist_ok=True))
+        if permission:
+            os.chmod(local_path, int(permission, 8))
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self.local_path(path))
 
 
 if __name__ == '__main__':
@@ -68,4 +278,5 @@ if __name__ == '__main__':
 
     hdfs_client.make_directory('/user/spider/xhs/note', permission='777')
 
-    print(hdfs_client.read_file('/user/data/routes.csv')[:10000])
+    with hdfs_client.read_stream('/user/data/routes.csv', chunk_size=10000) as chunks:
+        print(next(chunks, b'').decode('utf-8', errors='ignore'))
@@ -0,0 +1,178 @@
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+from common.constant import PIPELINE_QUEUE_PATH
+
+# crawled note ids, consumed by structuring
+TOPIC_NOTES = 'notes'
+# structured route ids, consumed by the incremental recommendation
+TOPIC_ROUTES = 'routes'
+# cities whose routes or likes changed, consumed by the listing refresh
+TOPIC_LISTINGS = 'listings'
+
+STATE_READY = 'ready'
+STATE_DEAD = 'dead'
+
+LEASE_COLUMNS = [
+    ('state', "TEXT NOT NULL DEFAULT 'ready'"),
+    ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+    ('visible_at', 'REAL NOT NULL DEFAULT 0'),
+    ('lease_owner', 'TEXT'),
+    ('last_error', 'TEXT'),
+    ('leased_at', 'REAL NOT NULL DEFAULT 0'),
+]
+
+
+@dataclass
+class Event:
+    topic: str
+    key: str
+    # when the note behind the event was crawled, carried through every stage for the freshness metrics
+    origin_at: float
+    enqueued_at: float
+    attempts: int = 0
+
+
+class EventQueue:
+    # durable across restarts, a key that is already queued is not queued twice. A leased event is invisible to other
+    # workers, of this process or of others on this host opening the same file, until it is acked, failed, or its
+    # lease expires, e.g. the worker died. Every lease counts as an attempt, after max_attempts the event is
+    # dead-lettered. SQLite in WAL mode needs shared memory, the file cannot be shared between hosts
+    def __init__(self, path: str = PIPELINE_QUEUE_PATH, visibility_secs: int = 600, max_attempts: int = 3,
+                 retry_base_secs: int = 60):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.visibility_secs = visibility_secs
+        self.max_attempts = max_attempts
+        self.retry_base_secs = retry_base_secs
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            key TEXT NOT NULL,
+            origin_at REAL NOT NULL,
+            enqueued_at REAL NOT NULL,
+            state TEXT NOT NULL DEFAULT 'ready',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            visible_at REAL NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            last_error TEXT,
+            leased_at REAL NOT NULL DEFAULT 0,
+            UNIQUE (topic, key)
+        )
+        """)
+        # queue files written before leases existed
+        columns = {row['name'] for row in self.conn.execute('PRAGMA table_info(events)')}
+        for column, definition in LEASE_COLUMNS:
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE events ADD COLUMN {column} {definition}')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_events_visible ON events (topic, state, visible_at)')
+
+    def put(self, topic: str, keys: list[str], origin_at: float = None) -> int:
+        # a key put again while it is leased is marked dirty by its new enqueued_at, the ack of that lease then makes
+        # it visible again instead of deleting it, so a change made during the processing is not lost
+        now = time.time()
+        rows = [(topic, key, origin_at or now, now) for key in keys]
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany("""
+            INSERT INTO events (topic, key, origin_at, enqueued_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (topic, key) DO UPDATE SET enqueued_at = excluded.enqueued_at
+            WHERE state = 'ready' AND lease_owner IS NOT NULL
+            """, rows)
+            return self.conn.total_changes - before
+
+    def lease(self, topic: str, worker_id: str, limit: int = 10) -> list[Event]:
+        # oldest first; an expired lease is visible again, so is an event waiting out its retry backoff. An event whose
+        # leases all expired, e.g. one that crashes its worker, is dead-lettered instead of delivered again
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute("""
+                UPDATE events SET state = 'dead', lease_owner = NULL, last_error = coalesce(last_error, 'lease expired')
+                WHERE topic = ? AND state = 'ready' AND visible_at <= ? AND attempts >= ?
+                """, (topic, now, self.max_attempts))
+                rows = self.conn.execute("""
+                SELECT id, topic, key, origin_at, enqueued_at, attempts + 1 AS attempts FROM events
+                WHERE topic = ? AND state = 'ready' AND visible_at <= ?
+                ORDER BY id
+                LIMIT ?
+                """, (topic, now, limit)).fetchall()
+                self.conn.executemany("""
+                UPDATE events SET lease_owner = ?, visible_at = ?, leased_at = ?, attempts = attempts + 1
+                WHERE id = ?
+                """, [(worker_id, now + self.visibility_secs, now, row['id']) for row in rows])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+        return [Event(row['topic'], row['key'], row['origin_at'], row['enqueued_at'], row['attempts']) for row in rows]
+
+    def ack(self, topic: str, worker_id: str, keys: list[str]):
+        # a lease that expired and was taken over belongs to the other worker now. A key put again after it was
+        # leased is released for the next lease as a new event
+        rows = [(topic, key, worker_id) for key in keys]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany("""
+                DELETE FROM events WHERE topic = ? AND key = ? AND lease_owner = ? AND enqueued_at <= leased_at
+                """, rows)
+                self.conn.executemany("""
+                UPDATE events SET lease_owner = NULL, visible_at = 0, attempts = 0
+                WHERE topic = ? AND key = ? AND lease_owner = ?
+                """, rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def fail(self, topic: str, worker_id: str, key: str, error: str) -> bool:
+        # True when the event is dead-lettered. The attempt was counted by the lease
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT attempts FROM events WHERE topic = ? AND key = ? AND lease_owner = ?',
+                                    (topic, key, worker_id)).fetchone()
+            if row is None:
+                return False
+
+            attempts = row['attempts']
+            state = STATE_DEAD if attempts >= self.max_attempts else STATE_READY
+            self.conn.execute("""
+            UPDATE events SET state = ?, visible_at = ?, lease_owner = NULL, last_error = ?
+            WHERE topic = ? AND key = ?
+            """, (state, now + self.retry_base_secs * 2 ** (attempts - 1), error[:1000], topic, key))
+            return state == STATE_DEAD
+
+    def dead_letters(self, topic: str) -> list[dict]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, attempts, last_error FROM events WHERE topic = ? AND state = 'dead' ORDER BY id",
+                (topic,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def requeue_dead(self, topic: str) -> int:
+        with self.lock:
+            return self.conn.execute("""
+            UPDATE events SET state = 'ready', attempts = 0, visible_at = 0, lease_owner = NULL
+            WHERE topic = ? AND state = 'dead'
+            """, (topic,)).rowcount
+
+    def lag(self, topic: str) -> tuple[int, float]:
+        # events not dead-lettered yet and the age of the oldest one
+        with self.lock:
+            row = self.conn.execute("SELECT count(*), min(enqueued_at) FROM events WHERE topic = ? AND state = 'ready'",
+                                    (topic,)).fetchone()
+        return row[0], time.time() - row[1] if row[1] is not None else 0.0
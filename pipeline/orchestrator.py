@@ -0,0 +1,231 @@
+import argparse
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+import requests
+from clickhouse_orm import Database
+from dotenv import load_dotenv
+
+from analyze.geocode import new_enricher
+from analyze.listing import refresh_route_listings
+from analyze.poi import PoiMatcher
+from analyze.recommend import to_recommendation_models
+from analyze.structure import StructureApplication
+from common.constant import PIPELINE_QUEUE_PATH
+from logger.logger import logger
+from metrics.metrics import PIPELINE_EVENTS, PIPELINE_FRESHNESS_SECONDS, PIPELINE_QUEUE_DEPTH, \
+    PIPELINE_QUEUE_LAG_SECONDS, serve_metrics
+from model.note import NoteInfo
+from persistent.clickhouse_client import ClickhouseClient
+from persistent.hdfs_client import HDFSClient
+from pipeline.events import Event, EventQueue, TOPIC_LISTINGS, TOPIC_NOTES, TOPIC_ROUTES
+from server.index import INVALIDATE_TOKEN_HEADER, IndexLoader, ROUTES_QUERY, build_route_index, load_features
+
+NOTES_QUERY = """
+SELECT *
+FROM citywalk_aide.note_infos
+WHERE id IN {note_ids:Array(String)}
+ORDER BY created_at DESC
+LIMIT 1 BY id
+"""
+
+NEW_ROUTES_QUERY = ROUTES_QUERY + """
+  AND toString(r.id) IN {route_ids:Array(String)}
+"""
+
+POI_RELOAD_SECS = 3600
+
+
+class Orchestrator:
+    # crawled notes are structured as they arrive, their routes are recommended and the serving caches invalidated
+    # right after, instead of waiting for the nightly jobs which stay as the full-scan backstop. Events are leased, so
+    # any number of orchestrators on this host sharing the queue file split the backlog
+    def __init__(self, events: EventQueue, structure: StructureApplication, clickhouse_client: Database,
+                 route_index: IndexLoader, api_url: str = None, batch_size: int = 20, concurrency: int = 4,
+                 poll_secs: float = 5, top_k: int = 20, worker_id: str = None, invalidate_token: str = ''):
+        self.events = events
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.structure = structure
+        self.clickhouse_client = clickhouse_client
+        self.route_index = route_index
+        self.api_url = api_url
+        self.invalidate_token = invalidate_token
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_secs = poll_secs
+        self.top_k = top_k
+        self.pois_loaded_at = 0.0
+
+    def backfill(self) -> int:
+        # notes crawled while nothing was listening, or before the spider enqueued them
+        notes = self.structure.pending_notes()
+        added = sum(self.events.put(TOPIC_NOTES, [note.id], note.created_at.timestamp()) for note in notes)
+        logger.info(f'Queued {added} of {len(notes)} unstructured notes')
+        return added
+
+    def fail(self, event: Event, error: str):
+        dead = self.events.fail(event.topic, self.worker_id, event.key, error)
+        PIPELINE_EVENTS.inc(topic=event.topic, result='dead' if dead else 'retry')
+        if dead:
+            logger.error(f'Dead-lettered {event.topic} event {event.key} after {event.attempts} attempts: {error}')
+
+    def structure_note(self, note: NoteInfo, event: Event, route_ids):
+        if isinstance(route_ids, Exception):
+            logger.error(f'Error structuring note {note.id}: {route_ids}')
+            self.fail(event, str(route_ids))
+            return
+
+        # the routes are queued before the note is acked, a crash in between structures the note again, which is
+        # idempotent
+        if route_ids:
+            self.events.put(TOPIC_ROUTES, route_ids, event.origin_at)
+            PIPELINE_FRESHNESS_SECONDS.observe(time.time() - event.origin_at, stage='structured')
+        self.events.ack(TOPIC_NOTES, self.worker_id, [note.id])
+        PIPELINE_EVENTS.inc(topic=TOPIC_NOTES, result='routes' if route_ids else 'empty')
+
+    def structure_batch(self) -> int:
+        events = self.events.lease(TOPIC_NOTES, self.worker_id, self.batch_size)
+        if not events:
+            return 0
+
+        if time.time() - self.pois_loaded_at > POI_RELOAD_SECS:
+            self.structure.load_pois()
+            self.pois_loaded_at = time.time()
+
+        by_note = {event.key: event for event in events}
+        notes = list(self.clickhouse_client.select(NOTES_QUERY, model_class=NoteInfo,
+                                                   params={'note_ids': list(by_note)}))
+        found = {note.id for note in notes}
+        for note_id, event in by_note.items():
+            if note_id not in found:
+                self.fail(event, 'note not found')
+
+        results = self.structure.process_notes(notes, return_exceptions=True, concurrency=self.concurrency)
+        for note in notes:
+            self.structure_note(note, by_note[note.id], results[note.id])
+        return len(events)
+
+    def recommend_batch(self) -> int:
+        # only the new routes get neighbours here, existing routes see them after the next batch job
+        events = self.events.lease(TOPIC_ROUTES, self.worker_id, self.batch_size * 5)
+        if not events:
+            return 0
+
+        by_route = {event.key: event for event in events}
+        try:
+            features = load_features(self.clickhouse_client, NEW_ROUTES_QUERY, {'route_ids': list(by_route)})
+            index = self.route_index.get()
+            recommendations = {
+                route_id: index.recommend_route(route_id, route_features, self.top_k)
+                for route_id, route_features in features.items()
+            }
+
+            version = datetime.now().replace(microsecond=0)
+            self.clickhouse_client.insert(to_recommendation_models(recommendations, version))
+            # only the listings of the cities with new routes change, refreshed by the listing role
+            self.events.put(TOPIC_LISTINGS, sorted({route_features.city for route_features in features.values()}),
+                            min(event.origin_at for event in events))
+        except Exception as e:
+            logger.error(f'Error recommending {len(by_route)} routes: {e}')
+            for event in events:
+                self.fail(event, str(e))
+            return len(events)
+
+        self.events.ack(TOPIC_ROUTES, self.worker_id, list(features))
+        for route_id, event in by_route.items():
+            if route_id not in features:
+                self.fail(event, 'route not found')
+        self.invalidate()
+
+        now = time.time()
+        for route_id in features:
+            PIPELINE_FRESHNESS_SECONDS.observe(now - by_route[route_id].origin_at, stage='recommended')
+        PIPELINE_EVENTS.inc(len(features), topic=TOPIC_ROUTES, result='recommended')
+        return len(events)
+
+    def listing_batch(self) -> int:
+        # one refresh for every city queued since the last one, a city queued twice is refreshed once
+        events = self.events.lease(TOPIC_LISTINGS, self.worker_id, self.batch_size * 5)
+        if not events:
+            return 0
+
+        cities = [event.key for event in events]
+        try:
+            refresh_route_listings(self.clickhouse_client, cities)
+        except Exception as e:
+            logger.error(f'Error refreshing the listings of {len(cities)} cities: {e}')
+            for event in events:
+                self.fail(event, str(e))
+            return len(events)
+
+        self.events.ack(TOPIC_LISTINGS, self.worker_id, cities)
+        PIPELINE_EVENTS.inc(len(cities), topic=TOPIC_LISTINGS, result='refreshed')
+        return len(events)
+
+    def invalidate(self):
+        # the next routes are compared with these ones too, and the API serves them from its indexes. Both loaders
+        # debounce, a burst of batches costs one rebuild
+        self.route_index.invalidate()
+        if not self.api_url:
+            return
+        try:
+            requests.post(f'{self.api_url}/cache/invalidate', headers={INVALIDATE_TOKEN_HEADER: self.invalidate_token},
+                          timeout=5).raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f'Error invalidating API caches: {e}')
+
+    def update_lag(self):
+        for topic in (TOPIC_NOTES, TOPIC_ROUTES, TOPIC_LISTINGS):
+            depth, lag = self.events.lag(topic)
+            PIPELINE_QUEUE_DEPTH.set(depth, topic=topic)
+            PIPELINE_QUEUE_LAG_SECONDS.set(lag, topic=topic)
+
+    def loop(self, name: str, step):
+        while True:
+            try:
+                processed = step()
+            except Exception as e:
+                logger.error(f'Error in pipeline stage {name}: {e}')
+                processed = 0
+            self.update_lag()
+            if not processed:
+                time.sleep(self.poll_secs)
+
+    def run(self, roles: tuple = ('structure', 'recommend', 'listing')):
+        steps = {'structure': self.structure_batch, 'recommend': self.recommend_batch, 'listing': self.listing_batch}
+        workers = [threading.Thread(target=self.loop, args=(role, steps[role]), daemon=True) for role in roles]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    # e.g. one process with --role all, more structure workers with --role structure sharing PIPELINE_QUEUE_PATH.
+    # The queue is a SQLite file in WAL mode, all of them have to run on the same host, not over a network filesystem
+    parser = argparse.ArgumentParser(description='Citywalk-aide pipeline orchestrator')
+    parser.add_argument('--role', choices=('all', 'structure', 'recommend', 'listing'), default='all')
+    parser.add_argument('--no-backfill', action='store_true', help='Do not queue the unstructured notes on start')
+    args = parser.parse_args()
+
+    clickhouse_client = ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL'))
+    hdfs_client = HDFSClient(os.getenv('HDFS_URL', 'http://localhost:50070'), 'root')
+    structure = StructureApplication(hdfs_client, clickhouse_client, new_enricher(), PoiMatcher(clickhouse_client),
+                                     pack_tokens=int(os.getenv('STRUCTURE_PACK_TOKENS', 0)))
+    route_index = IndexLoader(clickhouse_client, build_route_index, int(os.getenv('ROUTE_INDEX_REFRESH_SECS', 3600)),
+                              'route index', int(os.getenv('ROUTE_INDEX_DEBOUNCE_SECS', 300)))
+
+    events = EventQueue(os.getenv('PIPELINE_QUEUE_PATH', PIPELINE_QUEUE_PATH))
+    orchestrator = Orchestrator(events, structure, clickhouse_client, route_index, os.getenv('API_URL'),
+                                concurrency=int(os.getenv('PIPELINE_CONCURRENCY', 4)),
+                                worker_id=os.getenv('PIPELINE_WORKER_ID'),
+                                invalidate_token=os.getenv('CACHE_INVALIDATE_TOKEN', ''))
+    serve_metrics(int(os.getenv('PIPELINE_METRICS_PORT', 9108)))
+    if not args.no_backfill:
+        orchestrator.backfill()
+    orchestrator.run(('structure', 'recommend', 'listing') if args.role == 'all' else (args.role,))
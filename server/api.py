@@ -1,37 +1,138 @@
+import hmac
 import json
+import logging
+import os
 import random
+import time
 from datetime import datetime, date
 from uuid import UUID
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 
-from model.note import NoteInfo
-from model.route import Location, Route
+from logger.logger import log_sampled
+from metrics.metrics import registry, HTTP_REQUEST_SECONDS
+from model.note import NoteInfo, NoteStat
+from model.route import ACTIVITY, TRANSPORTATION, Location, Route, RouteListingCount
 from persistent.clickhouse_client import ClickhouseClient
-from server.recommend import get_recommendations
+from server.geo import build_geo_index
+from server.index import INVALIDATE_TOKEN_HEADER, IndexLoader, ROUTE_QUERY, build_route_index, load_features
+from server.profiling import LOG_COMMENT, PROFILING_ENABLED, is_profiling_requested, start_profile, stop_profile, \
+    profile_stage, slow_query_shapes
 
 app = Flask(__name__)
 CORS(app)
 
-clickhouse_client = ClickhouseClient('citywalk_aide')
+clickhouse_client = ClickhouseClient('citywalk_aide', os.getenv('CLICKHOUSE_URL'))
+clickhouse_client.add_setting('log_comment', LOG_COMMENT)
+
+route_index = IndexLoader(clickhouse_client, build_route_index, int(os.getenv('ROUTE_INDEX_REFRESH_SECS', 3600)),
+                          'route index', int(os.getenv('ROUTE_INDEX_DEBOUNCE_SECS', 300)))
+route_index.warm_up()
+geo_index = IndexLoader(clickhouse_client, build_geo_index, int(os.getenv('GEO_INDEX_REFRESH_SECS', 3600)),
+                        'geo index', int(os.getenv('GEO_INDEX_DEBOUNCE_SECS', 300)))
+geo_index.warm_up()
+
+# without a token only callers on this host may invalidate the caches
+CACHE_INVALIDATE_TOKEN = os.getenv('CACHE_INVALIDATE_TOKEN', '')
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
+
+NEARBY_MAX_RADIUS_M = 20000
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+    if is_profiling_requested(request.headers, request.args):
+        g.profile, g.profile_token = start_profile()
+
+
+@app.after_request
+def record_request(response):
+    # the route rule, not the path, keeps route ids out of the label values
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - g.get('start_time', time.perf_counter())
+    HTTP_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    log_sampled(logging.INFO, '%s %s %s %.1fms', request.method, request.full_path, response.status_code,
+                elapsed * 1000)
+    return response
+
+
+@app.after_request
+def attach_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+
+    stop_profile(g.pop('profile_token'))
+    data = response.get_json(silent=True) if response.is_json else None
+    if isinstance(data, dict):
+        data['debug'] = profile.report(clickhouse_client)
+        response.set_data(json.dumps(data, cls=CustomJSONEncoder, ensure_ascii=False))
+    return response
+
+
+@app.teardown_request
+def reset_profile(exc):
+    # after_request handlers are skipped when the view raises
+    if 'profile_token' in g:
+        stop_profile(g.pop('profile_token'))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    # called by the pipeline orchestrator once new routes are recommended
+    if CACHE_INVALIDATE_TOKEN:
+        allowed = hmac.compare_digest(request.headers.get(INVALIDATE_TOKEN_HEADER, ''), CACHE_INVALIDATE_TOKEN)
+    else:
+        allowed = request.remote_addr in LOOPBACK_ADDRESSES
+    if not allowed:
+        return jsonify({'error': 'forbidden'}), 403
+
+    route_index.invalidate()
+    geo_index.invalidate()
+    return jsonify({'invalidated': [route_index.name, geo_index.name]})
+
+
+@app.route('/debug/slow-queries', methods=['GET'])
+def slow_queries():
+    if not PROFILING_ENABLED:
+        return jsonify({'error': 'profiling is disabled'}), 404
+
+    minutes = int(request.args.get('minutes', 60))
+    limit = int(request.args.get('limit', 10))
+    resp = json.dumps({
+        "data": slow_query_shapes(clickhouse_client, minutes, limit),
+        "minutes": minutes,
+    }, cls=CustomJSONEncoder, ensure_ascii=False)
+    return resp, 200, {'Content-Type': 'application/json; charset=utf-8'}
 
 
 @app.route('/route/<route_id>', methods=['GET'])
 def get_route(route_id: str):
-    route = Route.objects_in(clickhouse_client).filter(id=route_id)[0]
-    note = NoteInfo.objects_in(clickhouse_client).filter(id=route.note_id)[0]
+    with profile_stage('route'):
+        route = Route.objects_in(clickhouse_client).filter(id=route_id).final()[0]
+    with profile_stage('note'):
+        note = NoteInfo.objects_in(clickhouse_client).filter(id=route.note_id)[0]
+        # the latest like sample, as in /search, the route keeps the count of when it was structured
+        stats = list(NoteStat.objects_in(clickhouse_client).filter(note_id=route.note_id).final())
 
     result = route.to_dict()
+    if stats:
+        result['liked_count'] = stats[0].liked_count
     result['locations'] = []
     result['cover'] = json.loads(note.cover)
 
-    locations = Location.objects_in(clickhouse_client).filter(route_id=route_id)
+    with profile_stage('locations'):
+        locations = list(Location.objects_in(clickhouse_client).filter(route_id=route_id).final()
+                         .order_by('order'))
     for loc in locations:
-        loc_dict = loc.to_dict()
-        loc_dict['activities'] = json.loads(loc.activities)
-        loc_dict['transportation'] = json.loads(loc.transportation)
-        result['locations'].append(loc_dict)
+        result['locations'].append(location_to_dict(loc))
 
     resp = json.dumps({
         "data": result,
@@ -48,7 +149,14 @@ def search():
 
     offset = (page - 1) * page_size
 
-    location_join = "LEFT JOIN citywalk_aide.locations l ON toString(r.id) = l.route_id" if len(keyword) else ''
+    if not keyword:
+        listing = city_listing(city, offset, page_size)
+        if listing is not None:
+            routes, total = listing
+            return search_response(routes, total, page, page_size)
+
+    location_join = "LEFT JOIN (SELECT * FROM citywalk_aide.locations FINAL) l ON toString(r.id) = l.route_id" \
+        if len(keyword) else ''
     keyword_where = f"""
         AND (r.title LIKE '%{keyword}%'
         OR r.summary LIKE '%{keyword}%'
@@ -68,45 +176,72 @@ def search():
        r.start_time AS start_time,
        r.end_time AS end_time,
        r.total_duration AS total_duration,
-       r.liked_count AS liked_count,
+       if(s.note_id = '', r.liked_count, s.liked_count) AS liked_count,
        r.notes AS notes,
        r.published_at AS published_at,
        r.created_at AS created_at,
        n.cover AS cover
-    FROM citywalk_aide.routes r
+    FROM citywalk_aide.routes r FINAL
     {location_join}
     JOIN citywalk_aide.note_infos n ON n.id = r.note_id
+    LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) s ON s.note_id = r.note_id
     WHERE r.city = '{city}' AND r.title <> '' {keyword_where}
-    ORDER BY r.liked_count DESC
+    ORDER BY liked_count DESC
     LIMIT {page_size} OFFSET {offset}
     """
-    print(route_query)
-    routes = [route.to_dict() for route in clickhouse_client.select(route_query)]
+    log_sampled(logging.DEBUG, 'Search query: %s', route_query)
+    with profile_stage('routes'):
+        routes = [route.to_dict() for route in clickhouse_client.select(route_query)]
+
+    count_query = f"""
+    SELECT COUNT(DISTINCT id) AS total
+    FROM citywalk_aide.routes r FINAL
+    {location_join}
+    WHERE r.city = '{city}' AND r.title <> '' {keyword_where}
+    """
+    with profile_stage('count'):
+        total = [t.to_dict() for t in clickhouse_client.select(count_query)][0]['total']
+
+    return search_response(routes, total, page, page_size)
+
+
+def city_listing(city: str, offset: int, page_size: int):
+    # the precomputed listing of the city, a range of its (city, version, rank) key; None before its first refresh
+    with profile_stage('count'):
+        counts = list(RouteListingCount.objects_in(clickhouse_client).filter(city=city).final())
+    if not counts:
+        return None
+
+    listing_query = """
+    SELECT id, note_id, city, title, summary, tags, start_time, end_time, total_duration, liked_count, notes,
+       published_at, created_at, cover
+    FROM citywalk_aide.route_listings
+    WHERE city = {city:String} AND version = {version:DateTime}
+      AND rank > {offset:UInt32} AND rank <= {offset:UInt32} + {page_size:UInt32}
+    ORDER BY rank
+    """
+    with profile_stage('routes'):
+        routes = [route.to_dict() for route in clickhouse_client.select(listing_query, params={
+            'city': city, 'version': counts[0].version, 'offset': offset, 'page_size': page_size,
+        })]
+    return routes, counts[0].total
+
 
+def search_response(routes: list[dict], total: int, page: int, page_size: int):
     route_map = {str(route.get('id')): route for route in routes}
     for route in route_map.values():
         route['cover'] = json.loads(route.get('cover', '{}'))
         route['locations'] = []
 
-    locations = Location.objects_in(clickhouse_client) \
-        .filter(Location.route_id.isIn(route_map.keys())) \
-        .order_by('route_id', 'order') if len(route_map) else []
+    with profile_stage('locations'):
+        locations = list(Location.objects_in(clickhouse_client)
+                         .filter(Location.route_id.isIn(route_map.keys())).final()
+                         .order_by('route_id', 'order')) if len(route_map) else []
 
     for loc in locations:
         route_id = loc.route_id
         if route_id in route_map:
-            loc_dict = loc.to_dict()
-            loc_dict['activities'] = json.loads(loc.activities)
-            loc_dict['transportation'] = json.loads(loc.transportation)
-            route_map[route_id]['locations'].append(loc_dict)
-
-    count_query = f"""
-    SELECT COUNT(DISTINCT id) AS total
-    FROM citywalk_aide.routes r
-    {location_join}
-    WHERE r.city = '{city}' AND r.title <> '' {keyword_where}
-    """
-    total = [t.to_dict() for t in clickhouse_client.select(count_query)][0]['total']
+            route_map[route_id]['locations'].append(location_to_dict(loc))
 
     resp = json.dumps({
         "data": list(route_map.values()),
@@ -121,40 +256,51 @@ def search():
 def recommendation():
     route_id = request.args.get('route_id', '')
 
-    recommends = {item[0]: item[1] for item in get_recommendations(route_id)}
-    print(recommends)
+    # top-K of the latest version, ranged on the (route_id, rank) key, joined with the neighbour routes
+    recommendation_query = """
+    SELECT toString(r.id) AS id,
+       r.note_id AS note_id,
+       r.city AS city,
+       r.title AS title,
+       r.summary AS summary,
+       r.tags AS tags,
+       r.start_time AS start_time,
+       r.end_time AS end_time,
+       r.total_duration AS total_duration,
+       if(s.note_id = '', r.liked_count, s.liked_count) AS liked_count,
+       r.notes AS notes,
+       r.published_at AS published_at,
+       r.created_at AS created_at,
+       rec.score AS score
+    FROM citywalk_aide.routes r FINAL
+    INNER JOIN (
+        SELECT neighbour_id, rank, score
+        FROM citywalk_aide.route_recommendations
+        WHERE route_id = {route_id:String}
+          AND version = (SELECT max(version) FROM citywalk_aide.route_recommendations WHERE route_id = {route_id:String})
+    ) rec ON rec.neighbour_id = toString(r.id)
+    LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) s ON s.note_id = r.note_id
+    WHERE r.id IN (SELECT toUUID(neighbour_id) FROM citywalk_aide.route_recommendations WHERE route_id = {route_id:String})
+    ORDER BY rec.rank
+    """
+    with profile_stage('routes'):
+        route_list = [route.to_dict() for route in clickhouse_client.select(recommendation_query,
+                                                                            params={'route_id': route_id})]
 
-    if not recommends or len(recommends) == 0:
+    if not route_list:
         return jsonify({'data': []})
 
-    routes = Route.objects_in(clickhouse_client) \
-        .filter(Route.id.isIn(recommends.keys())) \
-        .order_by('created_at')
+    route_map = {route['id']: route for route in route_list}
+    for route in route_list:
+        route['locations'] = []
 
-    locations = Location.objects_in(clickhouse_client) \
-        .filter(Location.route_id.isIn(recommends.keys())) \
-        .order_by('route_id', 'order')
+    with profile_stage('locations'):
+        locations = list(Location.objects_in(clickhouse_client)
+                         .filter(Location.route_id.isIn(route_map.keys())).final()
+                         .order_by('route_id', 'order'))
 
-    location_map = {}
     for loc in locations:
-        route_id = loc.route_id
-        if route_id not in location_map:
-            location_map[route_id] = []
-        loc_dict = loc.to_dict()
-        loc_dict['activities'] = json.loads(loc.activities)
-        loc_dict['transportation'] = json.loads(loc.transportation)
-        location_map[route_id].append(loc_dict)
-
-    route_list = []
-    for route in routes:
-        route_dict = route.to_dict()
-        route_id = str(route.id)
-        route_dict['id'] = route_id
-        route_dict['locations'] = location_map.get(route_id, [])
-        route_dict['score'] = recommends.get(route_id, 0)
-        route_list.append(route_dict)
-
-    route_list.sort(key=lambda x: x['score'], reverse=True)
+        route_map[loc.route_id]['locations'].append(location_to_dict(loc))
 
     resp = json.dumps({
         "data": route_list,
@@ -163,6 +309,124 @@ def recommendation():
     return resp, 200, {'Content-Type': 'application/json; charset=utf-8'}
 
 
+@app.route('/recommendation/realtime', methods=['GET'])
+def realtime_recommendation():
+    route_id = request.args.get('route_id', '')
+    query = request.args.get('q', '')
+    city = request.args.get('city', '')
+    top_k = min(int(request.args.get('top_k', 20)), 100)
+
+    index = route_index.get()
+    start = time.perf_counter()
+    if route_id:
+        features = None
+        if route_id not in index.rows:
+            with profile_stage('route'):
+                features = load_features(clickhouse_client, ROUTE_QUERY, {'route_id': route_id}).get(route_id)
+        recommends = index.recommend_route(route_id, features, top_k)
+    elif query:
+        recommends = index.recommend_query(query, city, top_k)
+    else:
+        return jsonify({'error': 'route_id or q is required'}), 400
+    took_ms = (time.perf_counter() - start) * 1000
+
+    scores = dict(recommends)
+    route_map = load_routes(list(scores))
+    for route_id, route in route_map.items():
+        route['score'] = scores[route_id]
+
+    resp = json.dumps({
+        "data": [route_map[route_id] for route_id, _ in recommends if route_id in route_map],
+        "took_ms": round(took_ms, 2),
+        "index_size": len(index),
+    }, cls=CustomJSONEncoder, ensure_ascii=False)
+    return resp, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+
+@app.route('/nearby', methods=['GET'])
+def nearby():
+    try:
+        latitude = float(request.args['lat'])
+        longitude = float(request.args['lng'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lng are required'}), 400
+    try:
+        radius = float(request.args.get('radius', 1000))
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'radius and limit must be numbers'}), 400
+    if not radius > 0 or limit <= 0:
+        return jsonify({'error': 'radius and limit must be positive'}), 400
+    radius = min(max(radius, 1), NEARBY_MAX_RADIUS_M)
+    limit = min(limit, 100)
+
+    index = geo_index.get()
+    start = time.perf_counter()
+    nearest = index.nearby(latitude, longitude, radius, limit)
+    took_ms = (time.perf_counter() - start) * 1000
+
+    distances = dict(nearest)
+    route_map = load_routes(list(distances))
+    for route_id, route in route_map.items():
+        route['distance_m'] = round(distances[route_id], 1)
+
+    resp = json.dumps({
+        "data": [route_map[route_id] for route_id, _ in nearest if route_id in route_map],
+        "radius": radius,
+        "took_ms": round(took_ms, 2),
+        "index_size": len(index),
+    }, cls=CustomJSONEncoder, ensure_ascii=False)
+    return resp, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+
+def load_routes(route_ids: list[str]) -> dict:
+    # routes ranked by an in-memory index, with their locations
+    route_query = """
+    SELECT toString(r.id) AS id,
+       r.note_id AS note_id,
+       r.city AS city,
+       r.title AS title,
+       r.summary AS summary,
+       r.tags AS tags,
+       r.start_time AS start_time,
+       r.end_time AS end_time,
+       r.total_duration AS total_duration,
+       if(s.note_id = '', r.liked_count, s.liked_count) AS liked_count,
+       r.notes AS notes,
+       r.published_at AS published_at,
+       r.created_at AS created_at
+    FROM citywalk_aide.routes r FINAL
+    LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) s ON s.note_id = r.note_id
+    WHERE r.id IN {route_ids:Array(UUID)}
+    """
+    with profile_stage('routes'):
+        route_map = {
+            route.id: route.to_dict() for route in clickhouse_client.select(route_query,
+                                                                              params={'route_ids': route_ids})
+        } if route_ids else {}
+
+    with profile_stage('locations'):
+        locations = list(Location.objects_in(clickhouse_client)
+                         .filter(Location.route_id.isIn(route_map.keys())).final()
+                         .order_by('route_id', 'order')) if route_map else []
+
+    for route in route_map.values():
+        route['locations'] = []
+    for loc in locations:
+        route_map[loc.route_id]['locations'].append(location_to_dict(loc))
+    return route_map
+
+
+def location_to_dict(location: Location) -> dict:
+    # the typed columns arrive parsed, only the tuples are named for the response
+    result = location.to_dict()
+    result['activities'] = [
+        dict(zip(ACTIVITY.names, activity), optional=bool(activity[3])) for activity in location.activities
+    ]
+    result['transportation'] = [dict(zip(TRANSPORTATION.names, item)) for item in location.transportation]
+    return result
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, UUID):
@@ -0,0 +1,218 @@
+import threading
+import time
+from datetime import date
+from typing import Callable
+
+import numpy as np
+from clickhouse_orm import Database
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from common.similarity import WEIGHT_CITY, WEIGHT_DESCRIPTION, WEIGHT_LIKES, WEIGHT_LOCATION_NAME, WEIGHT_TIME, \
+    chinese_stopwords
+from logger.logger import logger
+
+EPOCH = date(1970, 1, 1)
+
+# sent by the pipeline with the token of CACHE_INVALIDATE_TOKEN to POST /cache/invalidate
+INVALIDATE_TOKEN_HEADER = 'X-Invalidate-Token'
+
+ROUTES_QUERY = """
+SELECT toString(r.id) AS id,
+       r.city AS city,
+       r.summary AS summary,
+       if(s.note_id = '', r.liked_count, s.liked_count) AS liked_count,
+       r.published_at AS published_at,
+       l.names AS location_names
+FROM citywalk_aide.routes r FINAL
+LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) s ON s.note_id = r.note_id
+LEFT JOIN (
+    SELECT route_id, arrayStringConcat(groupArray(name), ' ') AS names
+    FROM citywalk_aide.locations FINAL
+    GROUP BY route_id
+) l ON l.route_id = toString(r.id)
+WHERE r.title <> ''
+"""
+
+# a single route that is not in the index yet, e.g. structured after the last build
+ROUTE_QUERY = """
+SELECT toString(r.id) AS id,
+       r.city AS city,
+       r.summary AS summary,
+       if(s.note_id = '', r.liked_count, s.liked_count) AS liked_count,
+       r.published_at AS published_at,
+       (SELECT arrayStringConcat(groupArray(name), ' ')
+        FROM citywalk_aide.locations FINAL
+        WHERE route_id = {route_id:String}) AS location_names
+FROM citywalk_aide.routes r FINAL
+LEFT JOIN (SELECT note_id, liked_count FROM citywalk_aide.note_stats FINAL) s ON s.note_id = r.note_id
+WHERE r.id = toUUID({route_id:String})
+"""
+
+
+def to_days(value) -> int:
+    # a route without a date is treated as published today
+    return ((value or date.today()) - EPOCH).days
+
+
+class RouteFeatures:
+    def __init__(self, summary: str, location_names: str, city: str, liked_count: int, published_at: date):
+        self.summary = summary or ''
+        self.location_names = location_names or ''
+        self.city = city
+        self.liked_count = liked_count
+        self.published_at = published_at
+
+
+class RouteIndex:
+    def __init__(self, ids: list[str], features: list[RouteFeatures]):
+        self.ids = np.array(ids, dtype=object)
+        self.rows = {route_id: row for row, route_id in enumerate(ids)}
+
+        self.summary_vectorizer = TfidfVectorizer(stop_words=chinese_stopwords, dtype=np.float32)
+        self.location_vectorizer = TfidfVectorizer(stop_words=chinese_stopwords, dtype=np.float32)
+        # rows are L2-normalized, so a sparse dot product is the cosine similarity
+        self.summary_matrix = self.fit(self.summary_vectorizer, [f.summary for f in features])
+        self.location_matrix = self.fit(self.location_vectorizer, [f.location_names for f in features])
+
+        cities = sorted({f.city for f in features})
+        self.city_codes = {city: code for code, city in enumerate(cities)}
+        self.cities = np.array([self.city_codes[f.city] for f in features], dtype=np.int16)
+        self.liked_counts = np.array([f.liked_count for f in features], dtype=np.float32)
+        self.published_days = np.array([to_days(f.published_at) for f in features], dtype=np.int32)
+        self.max_likes = max(float(self.liked_counts.max()), 1.0) if len(features) else 1.0
+        self.built_at = time.time()
+
+    @staticmethod
+    def fit(vectorizer: TfidfVectorizer, texts: list[str]) -> sparse.csr_matrix:
+        try:
+            return vectorizer.fit_transform(texts).tocsr()
+        except ValueError:
+            # empty vocabulary, e.g. no location names at all
+            vectorizer.fit(['placeholder'])
+            return sparse.csr_matrix((len(texts), 1), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def memory_bytes(self) -> int:
+        matrices = (self.summary_matrix, self.location_matrix)
+        arrays = (self.cities, self.liked_counts, self.published_days)
+        return sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in matrices) + \
+            sum(a.nbytes for a in arrays)
+
+    def vectors_of(self, features: RouteFeatures) -> tuple[np.ndarray, np.ndarray]:
+        summary = self.summary_vectorizer.transform([features.summary])
+        locations = self.location_vectorizer.transform([features.location_names])
+        return summary.toarray().ravel(), locations.toarray().ravel()
+
+    def score(self, summary_vector: np.ndarray, location_vector: np.ndarray, city_code: int, liked_count: float,
+              published_days: int) -> np.ndarray:
+        time_similarity = 1 - np.abs(self.published_days - published_days) / 365
+        likes_similarity = 1 - np.abs(self.liked_counts - liked_count) / self.max_likes
+
+        return WEIGHT_TIME * time_similarity + \
+            WEIGHT_LIKES * likes_similarity + \
+            WEIGHT_DESCRIPTION * (self.summary_matrix @ summary_vector) + \
+            WEIGHT_LOCATION_NAME * (self.location_matrix @ location_vector) + \
+            WEIGHT_CITY * (self.cities == city_code)
+
+    def top_k(self, scores: np.ndarray, k: int, exclude: str = None) -> list[tuple[str, float]]:
+        if exclude in self.rows:
+            scores[self.rows[exclude]] = -np.inf
+
+        k = min(k, len(scores) - (1 if exclude in self.rows else 0))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self.ids[row], float(scores[row])) for row in candidates]
+
+    def recommend_route(self, route_id: str, features: RouteFeatures = None, k: int = 20) -> list[tuple[str, float]]:
+        row = self.rows.get(route_id)
+        if row is not None:
+            summary_vector = self.summary_matrix[row].toarray().ravel()
+            location_vector = self.location_matrix[row].toarray().ravel()
+            scores = self.score(summary_vector, location_vector, self.cities[row], self.liked_counts[row],
+                                self.published_days[row])
+        elif features is not None:
+            # routes structured after the index was built are vectorized on the fly
+            summary_vector, location_vector = self.vectors_of(features)
+            scores = self.score(summary_vector, location_vector, self.city_codes.get(features.city, -1),
+                                features.liked_count, to_days(features.published_at))
+        else:
+            return []
+        return self.top_k(scores, k, exclude=route_id)
+
+    def recommend_query(self, text: str, city: str, k: int = 20) -> list[tuple[str, float]]:
+        # a free-text query is treated like a new, popular route: recent and liked routes rank higher
+        summary_vector, location_vector = self.vectors_of(RouteFeatures(text, text, city, 0, None))
+        scores = self.score(summary_vector, location_vector, self.city_codes.get(city, -1), self.max_likes,
+                            to_days(date.today()))
+        return self.top_k(scores, k)
+
+
+def load_features(clickhouse_client: Database, query: str = ROUTES_QUERY, params: dict = None) -> dict:
+    return {
+        row.id: RouteFeatures(row.summary, row.location_names, row.city, row.liked_count, row.published_at)
+        for row in clickhouse_client.select(query, params=params)
+    }
+
+
+def build_route_index(clickhouse_client: Database) -> RouteIndex:
+    features = load_features(clickhouse_client)
+    index = RouteIndex(list(features.keys()), list(features.values()))
+    logger.info(f'Route index built with {len(index)} routes, {index.memory_bytes / 1024 / 1024:.1f}MB')
+    return index
+
+
+class IndexLoader:
+    # holds an in-memory index built from ClickHouse, e.g. build_route_index or server.geo.build_geo_index. An
+    # invalidation rebuilds at most once every debounce_secs, the ones in between are folded into the next rebuild
+    def __init__(self, clickhouse_client: Database, build: Callable, refresh_secs: int = 3600, name: str = 'index',
+                 debounce_secs: int = 0):
+        self.clickhouse_client = clickhouse_client
+        self.build_index = build
+        self.refresh_secs = refresh_secs
+        self.name = name
+        self.debounce_secs = debounce_secs
+        self.index = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.invalidated_at = 0.0
+
+    def build(self):
+        start = time.perf_counter()
+        index = self.build_index(self.clickhouse_client)
+        logger.info(f'Built {self.name} in {time.perf_counter() - start:.2f}s')
+        return index
+
+    def warm_up(self):
+        threading.Thread(target=self.get, daemon=True).start()
+
+    def get(self):
+        with self.lock:
+            if self.index is None:
+                self.index = self.build()
+            elif not self.refreshing and (time.time() - self.index.built_at > self.refresh_secs or
+                                          self.index.built_at < self.invalidated_at and
+                                          time.time() - self.index.built_at >= self.debounce_secs):
+                # a stale index keeps serving while the new one is built in the background
+                self.refreshing = True
+                threading.Thread(target=self.refresh, daemon=True).start()
+            return self.index
+
+    def invalidate(self):
+        # e.g. new routes were structured, the next get() starts a rebuild
+        self.invalidated_at = time.time()
+
+    def refresh(self):
+        try:
+            index = self.build()
+            with self.lock:
+                self.index = index
+        except Exception as e:
+            logger.error(f'Refresh {self.name} error: {e}')
+        finally:
+            self.refreshing = False
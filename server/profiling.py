@@ -0,0 +1,166 @@
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from uuid import uuid4
+
+from clickhouse_orm import Database
+
+from logger.logger import logger
+from persistent.clickhouse_client import query_recorder
+
+# profiling is only honoured when the server enables it, a request then opts in with the header or the flag
+PROFILING_ENABLED = os.getenv('API_PROFILING', '') == '1'
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ARG = 'profile'
+
+# recorded in system.query_log for every query of the API, so the slow shapes can be told apart from other jobs
+LOG_COMMENT = 'citywalk_aide.api'
+
+QUERY_LOG_COLUMNS = """
+    query_id,
+    type,
+    query_duration_ms,
+    read_rows,
+    read_bytes,
+    result_rows,
+    memory_usage,
+    normalizeQuery(query) AS shape,
+    exception
+"""
+
+
+class QueryProfile:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.label = ''
+        self.queries = []
+
+    @staticmethod
+    def new_query_id() -> str:
+        return str(uuid4())
+
+    def record(self, query_id: str, statement: str, seconds: float):
+        self.queries.append({
+            'label': self.label,
+            'query_id': query_id,
+            'statement': statement,
+            'client_ms': round(seconds * 1000, 2),
+        })
+
+    @contextmanager
+    def stage(self, label: str):
+        previous, self.label = self.label, label
+        try:
+            yield
+        finally:
+            self.label = previous
+
+    def report(self, clickhouse_client: Database) -> dict:
+        total_ms = round((time.perf_counter() - self.started_at) * 1000, 2)
+
+        try:
+            query_log = load_query_log(clickhouse_client, [query['query_id'] for query in self.queries])
+        except Exception as e:
+            logger.error(f'Load query log for profiling error: {e}')
+            query_log = {}
+
+        queries = [dict(query, **query_log.get(query['query_id'], {})) for query in self.queries]
+        stages = {}
+        for query in queries:
+            stage = stages.setdefault(query['label'], {'queries': 0, 'client_ms': 0, 'elapsed_ms': 0, 'read_rows': 0,
+                                                       'read_bytes': 0})
+            stage['queries'] += 1
+            stage['client_ms'] = round(stage['client_ms'] + query['client_ms'], 2)
+            for key in ('elapsed_ms', 'read_rows', 'read_bytes'):
+                stage[key] += query.get(key, 0)
+
+        return {
+            'total_ms': total_ms,
+            'clickhouse_ms': round(sum(query['client_ms'] for query in queries), 2),
+            'stages': stages,
+            'queries': queries,
+        }
+
+
+def is_profiling_requested(headers, args) -> bool:
+    return PROFILING_ENABLED and (headers.get(PROFILE_HEADER) == '1' or args.get(PROFILE_ARG) == '1')
+
+
+def start_profile() -> tuple[QueryProfile, object]:
+    profile = QueryProfile()
+    return profile, query_recorder.set(profile)
+
+
+def stop_profile(token):
+    query_recorder.reset(token)
+
+
+def profile_stage(label: str):
+    profile = query_recorder.get()
+    return profile.stage(label) if profile is not None else nullcontext()
+
+
+@contextmanager
+def not_profiled():
+    # the profiling queries themselves must not show up in the breakdown
+    token = query_recorder.set(None)
+    try:
+        yield
+    finally:
+        query_recorder.reset(token)
+
+
+def load_query_log(clickhouse_client: Database, query_ids: list[str]) -> dict:
+    if not query_ids:
+        return {}
+
+    with not_profiled():
+        # query_log is written asynchronously, flushing makes the queries just sent visible
+        clickhouse_client.raw('SYSTEM FLUSH LOGS')
+        rows = clickhouse_client.select(f"""
+        SELECT {QUERY_LOG_COLUMNS}
+        FROM system.query_log
+        WHERE event_date >= yesterday()
+          AND query_id IN {{query_ids:Array(String)}}
+          AND type != 'QueryStart'
+        """, params={'query_ids': query_ids})
+
+        return {
+            row.query_id: {
+                'status': row.type,
+                'elapsed_ms': row.query_duration_ms,
+                'read_rows': row.read_rows,
+                'read_bytes': row.read_bytes,
+                'result_rows': row.result_rows,
+                'memory_usage': row.memory_usage,
+                'shape': row.shape,
+                'exception': row.exception or None,
+            }
+            for row in rows
+        }
+
+
+def slow_query_shapes(clickhouse_client: Database, minutes: int = 60, limit: int = 10) -> list[dict]:
+    with not_profiled():
+        clickhouse_client.raw('SYSTEM FLUSH LOGS')
+        rows = clickhouse_client.select("""
+        SELECT normalized_query_hash,
+               any(normalizeQuery(query)) AS shape,
+               count() AS calls,
+               quantile(0.5)(query_duration_ms) AS p50_ms,
+               quantile(0.95)(query_duration_ms) AS p95_ms,
+               max(query_duration_ms) AS max_ms,
+               sum(query_duration_ms) AS total_ms,
+               avg(read_rows) AS avg_read_rows,
+               avg(read_bytes) AS avg_read_bytes,
+               max(memory_usage) AS max_memory_usage
+        FROM system.query_log
+        WHERE event_time >= now() - toIntervalMinute({minutes:UInt32})
+          AND type = 'QueryFinish'
+          AND log_comment = {log_comment:String}
+        GROUP BY normalized_query_hash
+        ORDER BY total_ms DESC
+        LIMIT {limit:UInt32}
+        """, params={'minutes': minutes, 'limit': limit, 'log_comment': LOG_COMMENT})
+
+        return [dict(row.to_dict(), normalized_query_hash=str(row.normalized_query_hash)) for row in rows]
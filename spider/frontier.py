@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.constant import SPIDER_FRONTIER_PATH
+from logger.logger import logger
+from model.note import NoteInfo
+
+STATE_PENDING = 'pending'
+STATE_FETCHED = 'fetched'
+STATE_FAILED = 'failed'
+
+NOTE_FIELDS = ('id', 'xsec_token', 'url', 'type', 'display_title', 'liked_count', 'cover', 'image_list', 'user')
+
+
+class CrawlFrontier:
+    def __init__(self, path: str, max_attempts: int = 5, retry_base_secs: int = 300, lease_secs: int = 600):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.max_attempts = max_attempts
+        self.retry_base_secs = retry_base_secs
+        self.lease_secs = lease_secs
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS frontier (
+            note_id TEXT PRIMARY KEY,
+            city TEXT NOT NULL,
+            url TEXT NOT NULL,
+            liked_count INTEGER NOT NULL DEFAULT 0,
+            note TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_retry_at REAL NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            discovered_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_frontier_due ON frontier (state, city, liked_count DESC, next_retry_at)'
+        )
+
+    def add(self, city: str, notes: list[NoteInfo]) -> int:
+        now = time.time()
+        rows = [
+            (note.id, city, note.url, note.liked_count, self.encode_note(note), now, now)
+            for note in notes
+        ]
+
+        # url and xsec_token expire, so refresh them for notes that have not been fetched yet
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany("""
+            INSERT INTO frontier (note_id, city, url, liked_count, note, discovered_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (note_id) DO UPDATE SET
+                url = excluded.url,
+                liked_count = excluded.liked_count,
+                note = excluded.note,
+                updated_at = excluded.updated_at
+            WHERE state <> 'fetched'
+            """, rows)
+            return self.conn.total_changes - before
+
+    def lease(self, worker_id: str, city: str = None, limit: int = 10) -> list[NoteInfo]:
+        now = time.time()
+        city_where = 'AND city = ?' if city else ''
+        params = [now, now] + ([city] if city else []) + [limit]
+
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent workers never lease the same note
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.conn.execute(f"""
+                SELECT note_id, note FROM frontier
+                WHERE state = 'pending' AND next_retry_at <= ? AND lease_expires_at <= ? {city_where}
+                ORDER BY liked_count DESC
+                LIMIT ?
+                """, params).fetchall()
+
+                self.conn.executemany(
+                    'UPDATE frontier SET lease_owner = ?, lease_expires_at = ?, updated_at = ? WHERE note_id = ?',
+                    [(worker_id, now + self.lease_secs, now, row['note_id']) for row in rows]
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+        return [self.decode_note(row['note']) for row in rows]
+
+    def mark_fetched(self, worker_id: str, note_id: str):
+        with self.lock:
+            self.conn.execute("""
+            UPDATE frontier
+            SET state = 'fetched', lease_owner = NULL, lease_expires_at = 0, last_error = NULL, updated_at = ?
+            WHERE note_id = ? AND lease_owner = ?
+            """, (time.time(), note_id, worker_id))
+
+    def mark_failed(self, worker_id: str, note_id: str, error: str):
+        now = time.time()
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT attempts FROM frontier WHERE note_id = ? AND lease_owner = ?', (note_id, worker_id)
+            ).fetchone()
+            if row is None:
+                return
+
+            attempts = row['attempts'] + 1
+            state = STATE_FAILED if attempts >= self.max_attempts else STATE_PENDING
+            next_retry_at = now + self.retry_base_secs * 2 ** (attempts - 1)
+
+            self.conn.execute("""
+            UPDATE frontier
+            SET state = ?, attempts = ?, next_retry_at = ?, lease_owner = NULL, lease_expires_at = 0,
+                last_error = ?, updated_at = ?
+            WHERE note_id = ?
+            """, (state, attempts, next_retry_at, error[:1000], now, note_id))
+
+        if state == STATE_FAILED:
+            logger.warning(f'Note {note_id} failed {attempts} times, giving up')
+
+    def release(self, worker_id: str):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE frontier SET lease_owner = NULL, lease_expires_at = 0 WHERE lease_owner = ?', (worker_id,)
+            )
+
+    def retry_failed(self, city: str = None) -> int:
+        city_where = 'AND city = ?' if city else ''
+        with self.lock:
+            cursor = self.conn.execute(f"""
+            UPDATE frontier SET state = 'pending', attempts = 0, next_retry_at = 0
+            WHERE state = 'failed' {city_where}
+            """, [city] if city else [])
+            return cursor.rowcount
+
+    def stats(self, city: str = None) -> dict:
+        city_where = 'WHERE city = ?' if city else ''
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT state, COUNT(*) AS total FROM frontier {city_where} GROUP BY state', [city] if city else []
+            ).fetchall()
+        return {row['state']: row['total'] for row in rows}
+
+    @staticmethod
+    def encode_note(note: NoteInfo) -> str:
+        return json.dumps({field: getattr(note, field) for field in NOTE_FIELDS}, ensure_ascii=False)
+
+    @staticmethod
+    def decode_note(data: str) -> NoteInfo:
+        return NoteInfo(**json.loads(data))
+
+
+if __name__ == '__main__':
+    frontier = CrawlFrontier(os.getenv('SPIDER_FRONTIER_PATH', SPIDER_FRONTIER_PATH))
+    logger.info('Frontier stats: %s', frontier.stats())
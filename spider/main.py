@@ -1,3 +1,5 @@
+import os
+import socket
 from typing import Optional
 import schedule
 import time
@@ -6,19 +8,27 @@ from clickhouse_orm import Database
 from selenium import webdriver
 from selenium.webdriver.remote.webdriver import WebDriver
 
+from common.constant import PIPELINE_QUEUE_PATH, SPIDER_FRONTIER_PATH
 from logger.logger import logger
 from persistent.clickhouse_client import ClickhouseClient
 from persistent.hdfs_client import HDFSClient
+from pipeline.events import EventQueue
+from spider.frontier import CrawlFrontier
+from spider.refresh import LikeRefresher
 from spider.xhs import XHSSpider
 
 from dotenv import load_dotenv
 
 
 class Spider:
-    def __init__(self, hdfs_client: HDFSClient, clickhouse_client: Database):
+    def __init__(self, hdfs_client: HDFSClient, clickhouse_client: Database, frontier: CrawlFrontier,
+                 events: EventQueue = None):
         self.driver: Optional[WebDriver] = None
         self.hdfs_client = hdfs_client
         self.clickhouse_client: Database = clickhouse_client
+        self.frontier = frontier
+        self.events = events
+        self.worker_id = os.getenv('SPIDER_WORKER_ID', f'{socket.gethostname()}-{os.getpid()}')
         self.cities = ["佛山", "杭州", "天津", "东莞"]
 
     def init(self):
@@ -47,7 +57,8 @@ class Spider:
         for city in self.cities:
             try:
                 self.init()
-                xhs_spider = XHSSpider(self.driver, self.cities, self.hdfs_client, self.clickhouse_client)
+                xhs_spider = XHSSpider(self.driver, self.cities, self.hdfs_client, self.clickhouse_client,
+                                       self.frontier, self.worker_id, events=self.events)
                 xhs_spider.run(city)
             except Exception as e:
                 logger.error('Run spider job error: %s', e)
@@ -58,9 +69,27 @@ class Spider:
                 except Exception as e:
                     logger.error('Quit driver error: %s', e)
 
+    def refresh(self):
+        try:
+            self.init()
+            xhs_spider = XHSSpider(self.driver, self.cities, self.hdfs_client, self.clickhouse_client,
+                                   self.frontier, self.worker_id)
+            xhs_spider.driver.get(xhs_spider.base_url)
+            xhs_spider.login_with_cookie()
+            LikeRefresher(xhs_spider, self.clickhouse_client, self.events).run()
+        except Exception as e:
+            logger.error('Run refresh job error: %s', e)
+        finally:
+            try:
+                self.driver.quit()
+                logger.info("Quit driver")
+            except Exception as e:
+                logger.error('Quit driver error: %s', e)
+
     def run(self):
         self.spider()
         schedule.every().day.at("00:00").do(self.spider)
+        schedule.every(6).hours.do(self.refresh)
 
         while True:
             schedule.run_pending()
@@ -72,6 +101,8 @@ if __name__ == '__main__':
 
     hdfs_client = HDFSClient('http://localhost:50070', 'root')
     clickhouse_client = ClickhouseClient('citywalk_aide')
+    frontier = CrawlFrontier(os.getenv('SPIDER_FRONTIER_PATH', SPIDER_FRONTIER_PATH))
+    events = EventQueue(os.getenv('PIPELINE_QUEUE_PATH', PIPELINE_QUEUE_PATH))
 
-    spider = Spider(hdfs_client, clickhouse_client)
+    spider = Spider(hdfs_client, clickhouse_client, frontier, events)
     spider.run()
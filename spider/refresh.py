@@ -0,0 +1,130 @@
+import math
+from datetime import datetime, timedelta
+
+from clickhouse_orm import Database
+
+from logger.logger import logger
+from metrics.metrics import StageTimer
+from model.note import NoteInfo, NoteStat
+from pipeline.events import EventQueue, TOPIC_LISTINGS
+from spider.xhs import XHSSpider
+
+
+class RefreshPolicy:
+    def __init__(self, base_hours: float = 24, min_hours: float = 6, max_hours: float = 24 * 30,
+                 age_scale_days: float = 30, velocity_scale: float = 50):
+        self.base_hours = base_hours
+        self.min_hours = min_hours
+        self.max_hours = max_hours
+        self.age_scale_days = age_scale_days
+        self.velocity_scale = velocity_scale
+
+    def next_interval(self, age_days: float, velocity: float) -> timedelta:
+        # young notes and notes gaining likes quickly are re-sampled more often
+        hours = self.base_hours * (1 + age_days / self.age_scale_days) / (1 + max(velocity, 0) / self.velocity_scale)
+        return timedelta(hours=min(max(hours, self.min_hours), self.max_hours))
+
+    def priority(self, overdue_secs: float, velocity: float, liked_count: int) -> float:
+        overdue = 1 + max(overdue_secs, 0) / 3600 / self.base_hours
+        return overdue * (1 + math.log1p(max(velocity, 0))) * (1 + math.log1p(max(liked_count, 0)))
+
+
+class LikeRefresher:
+    def __init__(self, xhs_spider: XHSSpider, clickhouse_client: Database, events: EventQueue = None,
+                 policy: RefreshPolicy = None, max_title_searches: int = 50, velocity_smoothing: float = 0.5):
+        self.xhs_spider = xhs_spider
+        self.clickhouse_client = clickhouse_client
+        self.events = events
+        self.policy = policy or RefreshPolicy()
+        self.max_title_searches = max_title_searches
+        self.velocity_smoothing = velocity_smoothing
+
+    def load_notes(self) -> dict:
+        query = """
+        SELECT n.id AS note_id,
+               n.city AS city,
+               n.display_title AS display_title,
+               if(s.note_id = '', n.liked_count, s.liked_count) AS liked_count,
+               if(s.note_id = '', 0, s.liked_velocity) AS liked_velocity,
+               dateDiff('second', n.created_at, now()) / 86400 AS age_days,
+               dateDiff('second', if(s.note_id = '', n.created_at, s.sampled_at), now()) AS since_sampled_secs,
+               dateDiff('second', if(s.note_id = '', n.created_at, s.next_refresh_at), now()) AS overdue_secs
+        FROM citywalk_aide.note_infos AS n
+        LEFT JOIN (SELECT * FROM citywalk_aide.note_stats FINAL) AS s ON s.note_id = n.id
+        """
+        return {note.note_id: note for note in self.clickhouse_client.select(query)}
+
+    def sample(self, note, liked_count: int, now: datetime) -> NoteStat:
+        elapsed_days = max(note.since_sampled_secs / 86400, 1 / 24)
+        velocity = (liked_count - note.liked_count) / elapsed_days
+        velocity = self.velocity_smoothing * velocity + (1 - self.velocity_smoothing) * note.liked_velocity
+
+        return NoteStat(
+            note_id=note.note_id,
+            city=note.city,
+            liked_count=liked_count,
+            liked_velocity=velocity,
+            sampled_at=now,
+            next_refresh_at=now + self.policy.next_interval(note.age_days, velocity),
+        )
+
+    def collect(self, hits: list[NoteInfo], notes: dict, samples: dict, now: datetime):
+        for hit in hits:
+            note = notes.get(hit.id)
+            if note is not None and hit.id not in samples:
+                samples[hit.id] = self.sample(note, hit.liked_count, now)
+
+    def run(self):
+        now = datetime.now()
+        stages = StageTimer('Like refresh')
+
+        try:
+            with stages.stage('load'):
+                notes = self.load_notes()
+        except Exception as e:
+            logger.error(f'Load notes for refresh error: {e}')
+            return
+
+        due = [note for note in notes.values() if note.overdue_secs >= 0]
+        due.sort(key=lambda n: self.policy.priority(n.overdue_secs, n.liked_velocity, n.liked_count), reverse=True)
+        logger.info(f'{len(due)}/{len(notes)} notes are due for liked count refresh')
+
+        # one search result page re-samples every known note it lists, so start with the busiest cities
+        city_priority = {}
+        for note in due:
+            city_priority[note.city] = city_priority.get(note.city, 0) + \
+                self.policy.priority(note.overdue_secs, note.liked_velocity, note.liked_count)
+
+        samples = {}
+        for city in sorted(city_priority, key=city_priority.get, reverse=True):
+            try:
+                with stages.stage('search_city'):
+                    self.collect(self.xhs_spider.search_node(f'{city} citywalk'), notes, samples, now)
+            except Exception as e:
+                logger.error(f'Refresh search city {city} error: {e}')
+
+        # the remaining due notes are looked up by title, still only reading the search result json
+        remaining = [note for note in due if note.note_id not in samples][:self.max_title_searches]
+        for note in remaining:
+            try:
+                with stages.stage('search_title'):
+                    self.collect(self.xhs_spider.search_node(note.display_title), notes, samples, now)
+            except Exception as e:
+                logger.error(f'Refresh search note {note.note_id} error: {e}')
+
+        try:
+            with stages.stage('insert'):
+                self.clickhouse_client.insert(samples.values())
+            logger.info(f'Refreshed liked count of {len(samples)} notes, '
+                        f'{len([n for n in due if n.note_id not in samples])} due notes left')
+        except Exception as e:
+            logger.error(f'Insert note stats error: {e}')
+
+        # the listings are ranked by likes, the pipeline refreshes those of the cities that were re-sampled
+        if self.events is not None and samples:
+            try:
+                self.events.put(TOPIC_LISTINGS, sorted({stat.city for stat in samples.values()}))
+            except Exception as e:
+                logger.error(f'Queue listing refresh error: {e}')
+
+        stages.log_summary()
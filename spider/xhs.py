@@ -1,4 +1,5 @@
 import json
+import logging
 import os
 import time
 from datetime import datetime
@@ -9,21 +10,31 @@ from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.webdriver.common.by import By
 
 from common.constant import HDFS_PATH_XHS
-from logger.logger import logger
+from logger.logger import logger, log_sampled
+from metrics.metrics import PAGE_LOAD_SECONDS, StageTimer
 from persistent.hdfs_client import HDFSClient
 from model.note import NoteInfo, UserInfo, ImageInfo
+from pipeline.events import EventQueue, TOPIC_NOTES
+from spider.frontier import CrawlFrontier
 from spider.util import get_networks
 from utils.utils import json_encode
 
 
 class XHSSpider:
-    def __init__(self, driver: WebDriver, cities: list[str], hdfs_client: HDFSClient, clickhouse_client: Database):
+    def __init__(self, driver: WebDriver, cities: list[str], hdfs_client: HDFSClient, clickhouse_client: Database,
+                 frontier: CrawlFrontier, worker_id: str, max_consecutive_errors: int = 5, events: EventQueue = None):
         self.driver = driver
         self.base_url = 'https://www.xiaohongshu.com'
         self.cities = cities
         self.hdfs_client = hdfs_client
         self.hdfs_base_url = '/user/spider/xhs/note'
         self.clickhouse_client = clickhouse_client
+        self.frontier = frontier
+        self.worker_id = worker_id
+        self.max_consecutive_errors = max_consecutive_errors
+        # crawled notes are handed to the structuring worker of pipeline/orchestrator.py
+        self.events = events
+        self.stages = StageTimer('Spider')
 
     def login(self):
         # enter phone number
@@ -86,7 +97,8 @@ class XHSSpider:
 
     def search_node(self, keyword: str) -> list[NoteInfo]:
         encode_keyword = quote(quote(keyword, encoding='utf-8'), encoding='utf-8')
-        self.driver.get(self.base_url + f'/search_result?keyword={encode_keyword}&source=web_explore_feed')
+        with PAGE_LOAD_SECONDS.time(page='search'):
+            self.driver.get(self.base_url + f'/search_result?keyword={encode_keyword}&source=web_explore_feed')
 
         logger.info(f'Searching {keyword} ...')
         self.sleep()
@@ -147,7 +159,8 @@ class XHSSpider:
         return result
 
     def get_node_page(self, note_url: str):
-        self.driver.get(self.base_url + note_url)
+        with PAGE_LOAD_SECONDS.time(page='note'):
+            self.driver.get(self.base_url + note_url)
         self.sleep(1)
         return self.driver.page_source
 
@@ -177,8 +190,11 @@ class XHSSpider:
             return False
 
     def run(self, city: str):
+        self.stages = StageTimer(f'Spider city {city}')
+
         try:
-            self.driver.get(self.base_url)
+            with PAGE_LOAD_SECONDS.time(page='home'):
+                self.driver.get(self.base_url)
             self.login_with_cookie()
             logger.info(f'Logged in {self.base_url}')
         except Exception as e:
@@ -189,41 +205,78 @@ class XHSSpider:
 
         try:
             logger.info(f'Start search city {city} note')
-            note_list = self.search_node(f'{city} citywalk')
+            with self.stages.stage('search'):
+                note_list = self.search_node(f'{city} citywalk')
             logger.info(f'Get city {city} note count {len(note_list)}')
+
+            added = self.frontier.add(city, [note for note in note_list if not self.is_exists_note(note.id)])
+            logger.info(f'Add {added} city {city} notes to frontier')
         except Exception as e:
+            # notes discovered by earlier runs are still pending in the frontier
             logger.error(f'Search city {city} note error: {e}')
-            return
 
-        for note in note_list:
-            if self.is_exists_note(note_id=note.id):
-                continue
+        consecutive_errors = 0
+        try:
+            while consecutive_errors < self.max_consecutive_errors:
+                notes = self.frontier.lease(self.worker_id, city)
+                if not notes:
+                    break
+
+                for note in notes:
+                    if self.crawl_note(city, note):
+                        consecutive_errors = 0
+                        continue
+
+                    consecutive_errors += 1
+                    if consecutive_errors >= self.max_consecutive_errors:
+                        logger.error(f'Too many consecutive errors, stop spider city {city}')
+                        break
+        finally:
+            self.frontier.release(self.worker_id)
+
+        logger.info('Finish spider citywalk data for %s city, frontier: %s', city, self.frontier.stats(city))
+        self.stages.log_summary()
+
+    def crawl_note(self, city: str, note: NoteInfo) -> bool:
+        if self.is_exists_note(note_id=note.id):
+            self.frontier.mark_fetched(self.worker_id, note.id)
+            return True
 
-            try:
-                logger.info(f'Getting note {note.display_title} - {note.url}')
+        try:
+            with self.stages.stage('page'):
                 note_page = self.get_node_page(note_url=note.url)
-                logger.info(f'Get note {note.display_title} success')
-            except Exception as e:
-                logger.error(f'Get note {note.display_title} error: {e}')
-                return
+            log_sampled(logging.INFO, 'Get note %s - %s success', note.display_title, note.url)
+        except Exception as e:
+            logger.error(f'Get note {note.display_title} error: {e}')
+            self.frontier.mark_failed(self.worker_id, note.id, f'get page: {e}')
+            return False
 
-            # Save to HDFS
-            try:
-                note.page_hdfs_path = os.path.join(HDFS_PATH_XHS, f'{note.id}.html')
+        # Save to HDFS
+        try:
+            note.page_hdfs_path = os.path.join(HDFS_PATH_XHS, f'{note.id}.html')
+            with self.stages.stage('hdfs'):
                 self.hdfs_client.write_file(str(note.page_hdfs_path), note_page)
-                logger.info(f'Save note {note.display_title} to hdfs {note.page_hdfs_path} success')
-            except Exception as e:
-                logger.error(f'Save note {note.display_title} to hdfs {note.page_hdfs_path} error: {e}')
-                continue
+        except Exception as e:
+            logger.error(f'Save note {note.display_title} to hdfs {note.page_hdfs_path} error: {e}')
+            self.frontier.mark_failed(self.worker_id, note.id, f'save hdfs: {e}')
+            return False
 
-            # Save to Clickhouse
-            try:
-                note.city = city
-                note.created_at = datetime.now()
+        # Save to Clickhouse
+        try:
+            note.city = city
+            note.created_at = datetime.now()
+            with self.stages.stage('clickhouse'):
                 self.clickhouse_client.insert([note])
-                logger.info(f'Insert note {note.display_title} to clickhouse success')
-            except Exception as e:
-                logger.error(f'Insert note {note.display_title} to clickhouse error: {e}')
-                continue
+        except Exception as e:
+            logger.error(f'Insert note {note.display_title} to clickhouse error: {e}')
+            self.frontier.mark_failed(self.worker_id, note.id, f'insert clickhouse: {e}')
+            return False
 
-        logger.info('Finish spider citywalk data for %s city', city)
+        self.frontier.mark_fetched(self.worker_id, note.id)
+        if self.events is not None:
+            try:
+                self.events.put(TOPIC_NOTES, [note.id], note.created_at.timestamp())
+            except Exception as e:
+                # the nightly structure run still picks the note up
+                logger.error(f'Enqueue note {note.id} error: {e}')
+        return True
@@ -0,0 +1,87 @@
+from unittest import mock
+
+import pytest
+
+from analyze.geocode import (normalize_name, GazetteerGeocoder, AMapGeocoder, GeocodeCache, GeocodeError,
+                             LocationEnricher)
+from model.route import Location
+from utils.geo import location_geohash
+
+GAZETTEER = """city,name,latitude,longitude
+天津,五大道,39.1133,117.2008
+天津,天津之眼,39.1531,117.1798
+"""
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    path = tmp_path / 'gazetteer.csv'
+    path.write_text(GAZETTEER, encoding='utf-8')
+    return GazetteerGeocoder(str(path))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return GeocodeCache(str(tmp_path / 'geocode.db'))
+
+
+def amap_response(data: dict):
+    response = mock.Mock()
+    response.json.return_value = data
+    return response
+
+
+def test_normalize_name():
+    assert normalize_name('天津', '五大道（马场道入口）') == '五大道'
+    assert normalize_name('天津', '天津·五大道') == '五大道'
+    assert normalize_name('天津', '天津市五大道') == '五大道'
+    assert normalize_name('天津', '天津之眼') == '天津之眼'
+
+
+def test_gazetteer_enrich(gazetteer, cache):
+    enricher = LocationEnricher(gazetteer, cache)
+    locations = [
+        Location(name='天津·五大道'),
+        Location(name='天津之眼'),
+        Location(name='不存在的地方'),
+        Location(name='五大道', latitude=39.0, longitude=117.0, geohash='keep'),
+    ]
+
+    assert enricher.enrich('天津', locations) == 2
+
+    assert (locations[0].latitude, locations[0].longitude) == (39.1133, 117.2008)
+    assert locations[0].geohash == location_geohash(39.1133, 117.2008)
+    assert (locations[1].latitude, locations[1].longitude) == (39.1531, 117.1798)
+    assert not locations[2].latitude and not locations[2].geohash
+    assert (locations[3].latitude, locations[3].geohash) == (39.0, 'keep')
+    # names that could not be resolved are cached as well
+    assert cache.get_many([('天津', '五大道'), ('天津', '不存在的地方')]) == {
+        ('天津', '五大道'): (39.1133, 117.2008),
+        ('天津', '不存在的地方'): None,
+    }
+
+
+def test_amap_geocode():
+    geocoder = AMapGeocoder('key')
+    data = {'status': '1', 'geocodes': [{'location': '117.2008,39.1133'}]}
+    with mock.patch.object(geocoder.session, 'get', return_value=amap_response(data)):
+        assert geocoder.geocode('天津', '五大道') == (39.1133, 117.2008)
+
+    with mock.patch.object(geocoder.session, 'get', return_value=amap_response({'status': '1', 'geocodes': []})):
+        assert geocoder.geocode('天津', '不存在的地方') is None
+
+
+def test_amap_error_status_is_not_cached(cache):
+    geocoder = AMapGeocoder('key')
+    enricher = LocationEnricher(geocoder, cache)
+    data = {'status': '0', 'info': 'DAILY_QUERY_OVER_LIMIT', 'infocode': '10003'}
+
+    with mock.patch.object(geocoder.session, 'get', return_value=amap_response(data)):
+        with pytest.raises(GeocodeError, match=r'DAILY_QUERY_OVER_LIMIT \(10003\)'):
+            geocoder.geocode('天津', '五大道')
+
+        location = Location(name='五大道')
+        assert enricher.enrich('天津', [location]) == 0
+
+    assert not location.latitude
+    assert cache.get_many([('天津', '五大道')]) == {}
@@ -0,0 +1,67 @@
+import io
+
+import pytest
+
+from persistent.hdfs_client import LocalFSClient, HDFSError
+
+
+@pytest.fixture
+def client(tmp_path):
+    return LocalFSClient(str(tmp_path), max_workers=4, chunk_size=4)
+
+
+def test_stream_round_trip(client):
+    chunks = [b'city', b'walk', b'-aide']
+    client.write_stream('/notes/a.json', iter(chunks))
+
+    with client.read_stream('/notes/a.json') as stream:
+        read = list(stream)
+
+    assert b''.join(read) == b'citywalk-aide'
+    assert all(len(chunk) <= 4 for chunk in read)
+
+
+def test_write_stream_from_file_object(client):
+    client.write_stream('/notes/b.json', io.BytesIO('路线'.encode('utf-8')))
+
+    assert client.read_file('/notes/b.json') == '路线'
+
+
+def test_write_stream_without_overwrite_raises(client):
+    client.write_file('/notes/a.json', 'first')
+
+    with pytest.raises(HDFSError):
+        client.write_stream('/notes/a.json', [b'second'], overwrite=False)
+    assert client.read_file('/notes/a.json') == 'first'
+
+
+def test_write_many_read_many(client):
+    files = {f'/notes/{i}.json': f'note {i}' for i in range(10)}
+    client.write_many(files)
+
+    assert client.read_many(list(files)) == files
+    assert client.read_many(['/notes/0.json'], encoding=None) == {'/notes/0.json': b'note 0'}
+
+
+def test_read_missing_file_raises(client):
+    with pytest.raises(HDFSError) as info:
+        client.read_file('/notes/missing.json')
+    assert info.value.action == 'reading'
+    assert info.value.path == '/notes/missing.json'
+    assert isinstance(info.value.cause, FileNotFoundError)
+
+    with pytest.raises(HDFSError):
+        with client.read_stream('/notes/missing.json'):
+            pass
+
+
+def test_read_many_missing_file(client):
+    client.write_file('/notes/a.json', 'a')
+    paths = ['/notes/a.json', '/notes/missing.json']
+
+    with pytest.raises(HDFSError):
+        client.read_many(paths)
+
+    result = client.read_many(paths, return_exceptions=True)
+    assert result['/notes/a.json'] == 'a'
+    assert isinstance(result['/notes/missing.json'], HDFSError)
@@ -0,0 +1,86 @@
+import json
+from collections import Counter
+
+import pytest
+
+from analyze.structure import StructureApplication
+from benchmark.fakes import MockOpenAI, RecordingClickhouse, default_responder
+from benchmark.synthetic import make_notes, make_note_html
+from llm import llm
+from persistent.hdfs_client import LocalFSClient
+
+PACK_TOKENS = 1500
+
+
+@pytest.fixture(scope='module')
+def notes():
+    return make_notes(24)
+
+
+@pytest.fixture
+def hdfs_client(tmp_path, notes):
+    client = LocalFSClient(str(tmp_path))
+    client.write_many({note.page_hdfs_path: make_note_html(note) for note in notes})
+    return client
+
+
+def structure(hdfs_client, notes, monkeypatch, pack_tokens: int, responder=default_responder):
+    # the inserted (note_id, title) routes and the number of requests by response schema
+    schemas = Counter()
+
+    def counting_responder(messages, schema_name):
+        schemas[schema_name] += 1
+        return responder(messages, schema_name)
+
+    with MockOpenAI(responder=counting_responder) as openai:
+        monkeypatch.setattr(llm, 'BASE_URL', openai.base_url)
+        monkeypatch.setattr(llm, 'API_KEY', 'test')
+        clickhouse = RecordingClickhouse()
+        application = StructureApplication(hdfs_client, clickhouse, pack_tokens=pack_tokens)
+        application.process_notes(notes)
+
+    return sorted((route.note_id, route.title) for route in clickhouse.inserted['routes']), schemas
+
+
+def test_packed_routes_match_single_notes(hdfs_client, notes, monkeypatch):
+    single, single_schemas = structure(hdfs_client, notes, monkeypatch, pack_tokens=0)
+    packed, packed_schemas = structure(hdfs_client, notes, monkeypatch, pack_tokens=PACK_TOKENS)
+
+    assert single
+    assert packed == single
+    assert 'LLMPackedRoutes' not in single_schemas
+    assert packed_schemas['LLMPackedRoutes'] > 0
+    assert sum(packed_schemas.values()) < sum(single_schemas.values())
+
+
+def test_invalid_pack_falls_back_to_single_notes(hdfs_client, notes, monkeypatch):
+    def responder(messages, schema_name):
+        if schema_name == 'LLMPackedRoutes':
+            return 'not json'
+        return default_responder(messages, schema_name)
+
+    single, single_schemas = structure(hdfs_client, notes, monkeypatch, pack_tokens=0)
+    packed, packed_schemas = structure(hdfs_client, notes, monkeypatch, PACK_TOKENS, responder)
+
+    assert packed == single
+    assert packed_schemas['LLMPackedRoutes'] > 0
+    # every note of a failed pack is sent on its own
+    assert packed_schemas['LLMRoutes'] == single_schemas['LLMRoutes']
+
+
+def test_notes_missing_from_pack_fall_back_to_single_notes(hdfs_client, notes, monkeypatch):
+    # the answer of every pack leaves out its first note and invents one that was not sent
+    def responder(messages, schema_name):
+        content = default_responder(messages, schema_name)
+        if schema_name == 'LLMPackedRoutes':
+            packed = json.loads(content)
+            packed['notes'] = packed['notes'][1:] + [{'note_id': 'unknown', 'routes': []}]
+            return json.dumps(packed, ensure_ascii=False)
+        return content
+
+    single, _ = structure(hdfs_client, notes, monkeypatch, pack_tokens=0)
+    packed, packed_schemas = structure(hdfs_client, notes, monkeypatch, PACK_TOKENS, responder)
+
+    assert packed == single
+    assert 'unknown' not in {note_id for note_id, _ in packed}
+    assert 0 < packed_schemas['LLMRoutes'] < len(notes)
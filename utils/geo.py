@@ -0,0 +1,51 @@
+import math
+
+EARTH_RADIUS_M = 6371008.8
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 7
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    # same cells as ClickHouse's geohashEncode(longitude, latitude, precision)
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+
+    while len(chars) < precision:
+        target, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (target[0] + target[1]) / 2
+        if coordinate >= middle:
+            value = value << 1 | 1
+            target[0] = middle
+        else:
+            value = value << 1
+            target[1] = middle
+        even = not even
+
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+
+    return ''.join(chars)
+
+
+def location_geohash(latitude: float, longitude: float) -> str:
+    # 0/0 is what the structure job stores for a location without coordinates
+    if not latitude and not longitude:
+        return ''
+    return encode_geohash(latitude, longitude)
+
+
+def distance_m(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    # haversine
+    lat1, lat2 = math.radians(latitude1), math.radians(latitude2)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def degrees_around(latitude: float, radius_m: float) -> tuple[float, float]:
+    # latitude and longitude spans of a circle, the longitude span widens towards the poles
+    lat_degrees = math.degrees(radius_m / EARTH_RADIUS_M)
+    lng_degrees = lat_degrees / max(math.cos(math.radians(latitude)), 1e-6)
+    return lat_degrees, min(lng_degrees, 180.0)